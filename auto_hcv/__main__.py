@@ -1,21 +1,106 @@
 #!/usr/bin/env python
 
 import argparse
-import datetime
+import asyncio
 import json
 import logging
 import os
-import time
+
+from typing import Optional
 
 import auto_hcv.config
 import auto_hcv.core as core
+import auto_hcv.daemon
+import auto_hcv.post_analysis
+import auto_hcv.reuse
+import auto_hcv.state
+import auto_hcv.trace
+
+
+def rebuild_state(config: dict[str, object]):
+    """
+    Rebuild the run state store from the filesystem.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    if 'run_state_db' not in config:
+        logging.error(json.dumps({"event_type": "run_state_db_not_configured"}))
+        exit(1)
+    run_state = auto_hcv.state.RunStateStore(config['run_state_db'])
+    core.rebuild_run_state(config, run_state)
+    run_state.close()
+
+
+def report(config: dict[str, object], run_ids: list[str], force: bool=False):
+    """
+    Refresh the reports for previously-analyzed runs, for each configured pipeline.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_ids: Sequencing run IDs.
+    :type run_ids: list[str]
+    :param force: Rebuild all reports, even if their inputs haven't changed.
+    :type force: bool
+    :return: None
+    :rtype: NoneType
+    """
+    for run_id in run_ids:
+        run = {"run_id": run_id}
+        for pipeline in config['pipelines']:
+            auto_hcv.post_analysis.build_reports(config, pipeline, run, force=force)
+
+
+def trace_report(config: dict[str, object], top_n: int, pipeline_name: Optional[str]=None, regression_threshold: float=auto_hcv.trace.DEFAULT_REGRESSION_THRESHOLD, ingest_all: bool=False):
+    """
+    Print a report of process resource usage across runs, from the trace store.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param top_n: Number of processes to list in each section.
+    :type top_n: int
+    :param pipeline_name: Only report on this pipeline.
+    :type pipeline_name: Optional[str]
+    :param regression_threshold: Ratio (new / old) above which a change between pipeline versions is reported.
+    :type regression_threshold: float
+    :param ingest_all: Ingest the traces of all runs in the analysis_output_dir before reporting. Analyses whose outputs were reused from an earlier analysis are skipped, so their processes aren't counted twice.
+    :type ingest_all: bool
+    :return: None
+    :rtype: NoneType
+    """
+    db_path = auto_hcv.trace.get_trace_db_path(config)
+    if db_path is None:
+        logging.error(json.dumps({"event_type": "trace_db_not_configured"}))
+        exit(1)
+    trace_store = auto_hcv.trace.TraceStore(db_path)
+    if ingest_all:
+        for run_id in sorted([d.name for d in os.scandir(config['analysis_output_dir']) if d.is_dir()]):
+            for pipeline in config['pipelines']:
+                trace_path = auto_hcv.trace.get_trace_path(config, pipeline, run_id)
+                if os.path.exists(trace_path) and not auto_hcv.reuse.is_reused_analysis(os.path.dirname(trace_path)):
+                    auto_hcv.trace.ingest_trace(config, pipeline, {"run_id": run_id}, trace_store=trace_store)
+    traces = trace_store.get_traces(pipeline_name)
+    trace_store.close()
+    print(auto_hcv.trace.trace_report(traces, top_n=top_n, regression_threshold=regression_threshold))
 
-DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config')
     parser.add_argument('--log-level')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('rebuild-state', help='Rebuild the run state store from the filesystem, then exit')
+    report_parser = subparsers.add_parser('report', help='Refresh the reports for previously-analyzed runs, then exit')
+    report_parser.add_argument('--run', action='append', default=[], help='Sequencing run ID (may be repeated)')
+    report_parser.add_argument('--all', action='store_true', help='Refresh the reports for all runs in the analysis_output_dir')
+    report_parser.add_argument('--force', action='store_true', help='Rebuild reports even if their inputs have not changed')
+    trace_report_parser = subparsers.add_parser('trace-report', help='Report on process resource usage across runs, then exit')
+    trace_report_parser.add_argument('--top', type=int, default=auto_hcv.trace.DEFAULT_TRACE_REPORT_TOP_N, help='Number of processes to list in each section')
+    trace_report_parser.add_argument('--pipeline', help='Only report on this pipeline (for example, BCCDC-PHL/hcv-nf)')
+    trace_report_parser.add_argument('--regression-threshold', type=float, default=auto_hcv.trace.DEFAULT_REGRESSION_THRESHOLD, help='Report processes whose median realtime or memory grew by more than this ratio between pipeline versions')
+    trace_report_parser.add_argument('--ingest-all', action='store_true', help='Ingest the traces of all runs in the analysis_output_dir first')
     args = parser.parse_args()
 
     config = {}
@@ -33,51 +118,36 @@ def main():
     )
     logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
 
-    quit_when_safe = False
-    scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
-
-    while(True):
-        try:
-            if args.config:
-                try:
-                    config = auto_hcv.config.load_config(args.config)
-                    logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                except json.decoder.JSONDecodeError as e:
-                    # If we fail to load the config file, we continue on with the
-                    # last valid config that was loaded.
-                    logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
-
-            scan_start_timestamp = datetime.datetime.now()
-            for run in core.scan(config):
-
-                if run is not None:
-                    try:
-                        config = auto_hcv.config.load_config(args.config)
-                        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                    except json.decoder.JSONDecodeError as e:
-                        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
-
-                    core.analyze_run(config, run)
-
-                if quit_when_safe:
-                    exit(0)
-            scan_complete_timestamp = datetime.datetime.now()
-            scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
-            scan_duration_seconds = scan_duration_delta.total_seconds()
-            logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
-
-            if quit_when_safe:
-                exit(0)
-
-            if "scan_interval_seconds" in config:
-                try:
-                    scan_interval = float(str(config['scan_interval_seconds']))
-                except ValueError as e:
-                    scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
-            time.sleep(scan_interval)
-        except KeyboardInterrupt as e:
-            logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
-            quit_when_safe = True
+    if args.command == 'rebuild-state':
+        config = auto_hcv.config.load_config(args.config)
+        rebuild_state(config)
+        exit(0)
+
+    if args.command == 'report':
+        config = auto_hcv.config.load_config(args.config)
+        run_ids = args.run
+        if args.all:
+            run_ids = sorted([d.name for d in os.scandir(config['analysis_output_dir']) if d.is_dir()])
+        report(config, run_ids, force=args.force)
+        exit(0)
+
+    if args.command == 'trace-report':
+        config = auto_hcv.config.load_config(args.config)
+        trace_report(config, args.top, pipeline_name=args.pipeline, regression_threshold=args.regression_threshold, ingest_all=args.ingest_all)
+        exit(0)
+
+    if not args.config:
+        logging.error(json.dumps({"event_type": "config_not_provided"}))
+        exit(1)
+    config_manager = auto_hcv.config.ConfigManager(args.config)
+    try:
+        config = config_manager.load()
+    except (OSError, json.decoder.JSONDecodeError, auto_hcv.config.ConfigValidationError, auto_hcv.config.PipelineDependencyError) as e:
+        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config), "error": str(e)}))
+        exit(1)
+    daemon = auto_hcv.daemon.Daemon(config_manager)
+    asyncio.run(daemon.run())
+    exit(0)
 
 if __name__ == '__main__':
     main()
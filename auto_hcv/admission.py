@@ -0,0 +1,253 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import threading
+
+from typing import Optional
+
+DEFAULT_WORK_BYTES_PER_INPUT_BYTE = 10.0
+DEFAULT_DISK_SAFETY_FACTOR = 1.2
+DEFAULT_MEMORY_PER_ANALYSIS_GB = 4.0
+DEFAULT_MIN_FREE_DISK_GB = 0.0
+# Weight given to each new observation of work dir usage, when updating the learned ratio
+WORK_BYTES_PER_INPUT_BYTE_SMOOTHING = 0.2
+ADMISSION_STATS_FILENAME = 'admission_stats.json'
+GB = 1024 ** 3
+# Executors whose pipelines run on other hosts, so they don't use this host's memory or CPU
+BATCH_EXECUTOR_NAMES = ['slurm']
+
+
+def get_fastq_input_bytes(fastq_directory: str) -> int:
+    """
+    :param fastq_directory: Run fastq directory.
+    :type fastq_directory: str
+    :return: Total size of the files in the directory (following symlinks).
+    :rtype: int
+    """
+    input_bytes = 0
+    for entry in os.scandir(fastq_directory):
+        try:
+            if entry.is_file():
+                input_bytes += entry.stat().st_size
+        except OSError as e:
+            continue
+
+    return input_bytes
+
+
+def runs_on_host(analysis: dict[str, object]) -> bool:
+    """
+    :param analysis: Queued or running analysis.
+    :type analysis: dict[str, object]
+    :return: Whether or not the analysis's pipeline runs on this host (rather than on a batch system), and so uses its memory and CPU. Reused analyses only copy files, and don't count.
+    :rtype: bool
+    """
+    if analysis.get('reused_analysis', None) is not None:
+        return False
+    analysis_executor = analysis.get('executor', None)
+
+    return analysis_executor is None or analysis_executor.name not in BATCH_EXECUTOR_NAMES
+
+
+def get_available_memory_bytes() -> Optional[int]:
+    """
+    :return: Memory available for new processes (`MemAvailable` from `/proc/meminfo`), or None if it can't be determined.
+    :rtype: Optional[int]
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError) as e:
+        pass
+
+    return None
+
+
+class AdmissionController:
+    """
+    Decides whether there are enough resources to start an analysis, so that a burst of runs doesn't
+    fill the work filesystem (or exhaust memory) and make every analysis fail together.
+
+    The disk space needed by an analysis is estimated from the size of its run's fastq files, using a ratio of
+    work dir bytes per input byte that is learned from the work dirs of past analyses as they are deleted
+    (see `auto_hcv.cleanup`). Space that running analyses are expected to need is reserved, so a run is only
+    started if its estimate fits in the space that is left. The learned ratio is saved to `admission.stats_path`
+    (default: `admission_stats.json` in the `analysis_work_dir`).
+    """
+    def __init__(self, stats_path: str):
+        self.stats_path = stats_path
+        self.lock = threading.Lock()
+        self.stats = self.load_stats()
+
+
+    def load_stats(self) -> dict[str, object]:
+        try:
+            with open(self.stats_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError as e:
+            return {}
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            logging.error(json.dumps({"event_type": "load_admission_stats_failed", "admission_stats_path": os.path.abspath(self.stats_path), "error": str(e)}))
+            return {}
+
+
+    def get_work_bytes_per_input_byte(self, config: dict[str, object]) -> float:
+        """
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: Learned ratio of work dir bytes per input byte, or `admission.default_work_bytes_per_input_byte` if nothing has been learned yet.
+        :rtype: float
+        """
+        admission_config = config.get('admission', None) or {}
+        with self.lock:
+            ratio = self.stats.get('work_bytes_per_input_byte', None)
+        if ratio is None:
+            ratio = float(admission_config.get('default_work_bytes_per_input_byte', DEFAULT_WORK_BYTES_PER_INPUT_BYTE))
+
+        return ratio
+
+
+    def record_work_dir_usage(self, input_bytes: int, work_dir_bytes: int):
+        """
+        Update the learned ratio of work dir bytes per input byte with the size of a work dir that was
+        just deleted. Called from the cleanup threads.
+
+        :param input_bytes: Size of the analysis's fastq input.
+        :type input_bytes: int
+        :param work_dir_bytes: Size of the analysis's work dir.
+        :type work_dir_bytes: int
+        :return: None
+        :rtype: NoneType
+        """
+        if not input_bytes or input_bytes <= 0 or work_dir_bytes <= 0:
+            return
+        observed_ratio = work_dir_bytes / input_bytes
+        with self.lock:
+            ratio = self.stats.get('work_bytes_per_input_byte', None)
+            if ratio is None:
+                ratio = observed_ratio
+            else:
+                ratio = (1 - WORK_BYTES_PER_INPUT_BYTE_SMOOTHING) * ratio + WORK_BYTES_PER_INPUT_BYTE_SMOOTHING * observed_ratio
+            self.stats['work_bytes_per_input_byte'] = ratio
+            self.stats['num_observations'] = self.stats.get('num_observations', 0) + 1
+            self.stats['timestamp_updated'] = datetime.datetime.now().isoformat()
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.stats_path)), exist_ok=True)
+                with open(self.stats_path + '.tmp', 'w') as f:
+                    json.dump(self.stats, f, indent=2)
+                os.replace(self.stats_path + '.tmp', self.stats_path)
+            except OSError as e:
+                logging.error(json.dumps({"event_type": "save_admission_stats_failed", "admission_stats_path": os.path.abspath(self.stats_path), "error": str(e)}))
+        logging.info(json.dumps({"event_type": "work_bytes_per_input_byte_updated", "observed_ratio": round(observed_ratio, 3), "work_bytes_per_input_byte": round(ratio, 3)}))
+
+
+    def estimate_disk_bytes(self, config: dict[str, object], input_bytes: int) -> int:
+        """
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param input_bytes: Size of the analysis's fastq input.
+        :type input_bytes: int
+        :return: Estimated size of the analysis's work dir, including the `admission.disk_safety_factor` margin.
+        :rtype: int
+        """
+        admission_config = config.get('admission', None) or {}
+        safety_factor = float(admission_config.get('disk_safety_factor', DEFAULT_DISK_SAFETY_FACTOR))
+
+        return int(input_bytes * self.get_work_bytes_per_input_byte(config) * safety_factor)
+
+
+    def check(self, config: dict[str, object], analysis: dict[str, object], running: list[dict[str, object]]) -> list[dict[str, object]]:
+        """
+        Check whether there are enough resources to start an analysis. The analysis's input size and disk
+        estimate are stored in it as `input_bytes` and `estimated_disk_bytes`. Memory and CPU are only checked
+        for analyses that run on this host (see `runs_on_host`), and the memory that running analyses on this host
+        are expected to need is held back, since they may not have reached it yet.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param analysis: Queued analysis.
+        :type analysis: dict[str, object]
+        :param running: Running analyses.
+        :type running: list[dict[str, object]]
+        :return: The resources that are short (each with a `resource` key of `disk`, `memory` or `cpu`). Empty if the analysis can be started.
+        :rtype: list[dict[str, object]]
+        """
+        admission_config = config.get('admission', None) or {}
+        shortages = []
+
+        if 'input_bytes' not in analysis and 'input_bytes' in analysis['run']:
+            # Counted from the run's input manifest, by the preflight checks
+            analysis['input_bytes'] = analysis['run']['input_bytes']
+        if 'input_bytes' not in analysis:
+            fastq_directory = analysis['run'].get('fastq_directory', None)
+            try:
+                analysis['input_bytes'] = get_fastq_input_bytes(fastq_directory) if fastq_directory else 0
+            except OSError as e:
+                analysis['input_bytes'] = 0
+        analysis['estimated_disk_bytes'] = self.estimate_disk_bytes(config, analysis['input_bytes'])
+        try:
+            free_disk_bytes = shutil.disk_usage(config['analysis_work_dir']).free
+        except OSError as e:
+            free_disk_bytes = None
+        if free_disk_bytes is not None:
+            # Running analyses may not have filled their work dirs yet, so the space they are expected to need is held back.
+            reserved_disk_bytes = sum(a.get('estimated_disk_bytes', 0) for a in running)
+            min_free_disk_bytes = int(float(admission_config.get('min_free_disk_gb', DEFAULT_MIN_FREE_DISK_GB)) * GB)
+            available_disk_bytes = free_disk_bytes - reserved_disk_bytes - min_free_disk_bytes
+            if analysis['estimated_disk_bytes'] > available_disk_bytes:
+                shortages.append({
+                    "resource": "disk",
+                    "input_bytes": analysis['input_bytes'],
+                    "required_bytes": analysis['estimated_disk_bytes'],
+                    "available_bytes": max(0, available_disk_bytes),
+                    "free_bytes": free_disk_bytes,
+                    "reserved_bytes": reserved_disk_bytes,
+                })
+
+        if not runs_on_host(analysis):
+            return shortages
+
+        memory_per_analysis_bytes = int(float(admission_config.get('memory_per_analysis_gb', DEFAULT_MEMORY_PER_ANALYSIS_GB)) * GB)
+        free_memory_bytes = get_available_memory_bytes()
+        if free_memory_bytes is not None:
+            reserved_memory_bytes = memory_per_analysis_bytes * len([a for a in running if runs_on_host(a)])
+            available_memory_bytes = free_memory_bytes - reserved_memory_bytes
+            if available_memory_bytes < memory_per_analysis_bytes:
+                shortages.append({
+                    "resource": "memory",
+                    "required_bytes": memory_per_analysis_bytes,
+                    "available_bytes": max(0, available_memory_bytes),
+                    "free_bytes": free_memory_bytes,
+                    "reserved_bytes": reserved_memory_bytes,
+                })
+
+        max_load_per_cpu = admission_config.get('max_load_per_cpu', None)
+        if max_load_per_cpu is not None:
+            load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load_per_cpu > float(max_load_per_cpu):
+                shortages.append({
+                    "resource": "cpu",
+                    "load_per_cpu": round(load_per_cpu, 2),
+                    "max_load_per_cpu": float(max_load_per_cpu),
+                })
+
+        return shortages
+
+
+def create_admission_controller(config: dict[str, object]) -> Optional[AdmissionController]:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Admission controller, or None if `admission.enabled` isn't set.
+    :rtype: Optional[AdmissionController]
+    """
+    admission_config = config.get('admission', None) or {}
+    if not admission_config.get('enabled', False):
+        return None
+    stats_path = admission_config.get('stats_path', None) or os.path.join(config['analysis_work_dir'], ADMISSION_STATS_FILENAME)
+
+    return AdmissionController(stats_path)
@@ -0,0 +1,208 @@
+import datetime
+import html
+import json
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+# Per-sample tables that are collected for each run. Paths are relative to the sample's output dir.
+RUN_TABLES = {
+    "genotype_calls": {
+        "path": "{sample_name}_genotype_calls_nt.csv",
+        "read_csv_kwargs": {"index_col": 0},
+    },
+    "consensus": {
+        "path": "{sample_name}_consensus_seqs_report.tsv",
+        "read_csv_kwargs": {"sep": "\t"},
+    },
+    "demix": {
+        "path": os.path.join("demix", "{sample_name}_demixing_results.tsv"),
+        "read_csv_kwargs": {"sep": "\t"},
+    },
+}
+
+RUN_SUMMARY_STYLE = """
+html, body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7fafc; color: #222; margin: 0; padding: 0; }
+.container { max-width: 1400px; margin: 30px auto; padding: 30px; background: #fff; border-radius: 16px; box-shadow: 0 2px 20px rgba(30,40,80,0.13); }
+h2 { font-size: 1.35em; color: #29598c; border-bottom: 1px solid #e1e7ef; padding-bottom: 3px; margin-top: 40px; }
+.data-table { width: 100%; border-collapse: separate; border-spacing: 0; background: #fafbfc; font-size: 0.95em; display: block; overflow-x: auto; }
+.data-table th, .data-table td { border: 1px solid #dde4ea; padding: 6px 8px; text-align: left; }
+.data-table th { background: #e4ecf6; font-weight: 500; color: #263e5a; }
+"""
+
+
+def load_run_tables(analysis_run_output_dir: str, run_id: str) -> dict[str, pd.DataFrame]:
+    """
+    Load the per-sample result tables for a run, in a single pass over the run's sample directories.
+    Each table has `sequencing_run_id` and `sample_name` columns added, and the tables for all samples are combined.
+
+    :param analysis_run_output_dir: Pipeline output dir for the run.
+    :type analysis_run_output_dir: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Map from table name (see `RUN_TABLES`) to the combined table for the run.
+    :rtype: dict[str, pd.DataFrame]
+    """
+    sample_tables = {table_name: [] for table_name in RUN_TABLES}
+    for sample_dir in sorted(os.scandir(analysis_run_output_dir), key=lambda d: d.name):
+        if not sample_dir.is_dir():
+            continue
+        sample_name = sample_dir.name
+        for table_name, table in RUN_TABLES.items():
+            table_path = os.path.join(sample_dir.path, table['path'].format(sample_name=sample_name))
+            if not os.path.exists(table_path):
+                continue
+            try:
+                df = pd.read_csv(table_path, **table['read_csv_kwargs'])
+            except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+                logging.warning(json.dumps({"event_type": "load_sample_table_failed", "sequencing_run_id": run_id, "sample_name": sample_name, "table_path": table_path, "error": str(e)}))
+                continue
+            df.insert(0, 'sample_name', sample_name)
+            df.insert(0, 'sequencing_run_id', run_id)
+            sample_tables[table_name].append(df)
+
+    run_tables = {}
+    for table_name, dfs in sample_tables.items():
+        if len(dfs) > 0:
+            run_tables[table_name] = pd.concat(dfs, ignore_index=True)
+        else:
+            run_tables[table_name] = pd.DataFrame(columns=['sequencing_run_id', 'sample_name'])
+
+    return run_tables
+
+
+def get_top_genotype_calls(genotype_calls: pd.DataFrame) -> pd.DataFrame:
+    """
+    Select the best-scoring genotype call for each sample and amplicon.
+
+    :param genotype_calls: Combined genotype calls for a run.
+    :type genotype_calls: pd.DataFrame
+    :return: Top genotype call per sample and amplicon.
+    :rtype: pd.DataFrame
+    """
+    if len(genotype_calls) == 0 or 'query_seq_id' not in genotype_calls.columns or 'bitscore' not in genotype_calls.columns:
+        return genotype_calls
+    df = genotype_calls.drop(columns=['subject_strand', 'e_value'], errors='ignore')
+    df['amplicon'] = df['query_seq_id'].astype(str).str.split('|').str[1]
+    df = df.sort_values(['sample_name', 'amplicon', 'bitscore'], ascending=[True, True, False])
+    df = df.groupby(['sample_name', 'amplicon']).head(1).reset_index(drop=True)
+
+    return df
+
+
+def write_run_summary_html(run_id: str, run_tables: dict[str, pd.DataFrame], summary_path: str):
+    """
+    Write a run-level HTML summary page, with the top genotype calls, consensus sequence statistics
+    and mixture analysis results for every sample in the run.
+
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param run_tables: Combined tables for the run, as returned by `load_run_tables`.
+    :type run_tables: dict[str, pd.DataFrame]
+    :param summary_path: Path to write the summary page to.
+    :type summary_path: str
+    :return: None
+    :rtype: NoneType
+    """
+    sections = [
+        ("Genotype Calls (top hit per sample and amplicon)", get_top_genotype_calls(run_tables['genotype_calls'])),
+        ("Consensus Sequences", run_tables['consensus']),
+        ("Freyja Mixture Analysis", run_tables['demix']),
+    ]
+    escaped_run_id = html.escape(run_id)
+    with open(summary_path + '.tmp', 'w') as f:
+        f.write('<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="UTF-8" />\n')
+        f.write(f'<title>{escaped_run_id} HCV Run Summary</title>\n<style>{RUN_SUMMARY_STYLE}</style>\n</head>\n<body>\n<div class="container">\n')
+        f.write(f'<h1>{escaped_run_id} HCV Run Summary</h1>\n<p>Report generated on: {datetime.datetime.now()}</p>\n')
+        for title, df in sections:
+            f.write(f'<section>\n<h2>{title}</h2>\n')
+            if len(df) == 0:
+                f.write("<div style='color:#888'>No results.</div>\n")
+            else:
+                f.write(df.to_html(index=False, classes='data-table', border=0))
+            f.write('\n</section>\n')
+        f.write('</div>\n</body>\n</html>\n')
+    os.replace(summary_path + '.tmp', summary_path)
+
+
+def write_results_store_partition(results_store_dir: str, table_name: str, run_id: str, df: pd.DataFrame) -> str:
+    """
+    Write a run's rows for one table to the cumulative results store. The store is a Parquet dataset per table,
+    partitioned by run (`<results_store_dir>/<table_name>/sequencing_run_id=<run_id>/part-0.parquet`), so that it can be
+    queried across runs with `pandas.read_parquet` or `pyarrow.dataset`. Re-writing a run replaces its partition.
+
+    :param results_store_dir: Results store dir.
+    :type results_store_dir: str
+    :param table_name: Table name.
+    :type table_name: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param df: The run's rows for the table.
+    :type df: pd.DataFrame
+    :return: Path to the partition dir.
+    :rtype: str
+    """
+    partition_dir = os.path.join(results_store_dir, table_name, 'sequencing_run_id=' + run_id)
+    tmp_partition_dir = partition_dir + '.tmp'
+    shutil.rmtree(tmp_partition_dir, ignore_errors=True)
+    os.makedirs(tmp_partition_dir)
+    # The run ID is stored in the partition path, and free-text columns are stored as strings
+    # so that the schema doesn't depend on what happened to be in a particular run.
+    df = df.drop(columns=['sequencing_run_id'])
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype(str)
+    df.to_parquet(os.path.join(tmp_partition_dir, 'part-0.parquet'), index=False)
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    os.replace(tmp_partition_dir, partition_dir)
+
+    return partition_dir
+
+
+def build_run_summary(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object]):
+    """
+    Load the per-sample result tables for a run, write a run-level summary page to
+    `<run_id>_run_summary.html` in the pipeline output dir, and (if `results_store_dir` is configured)
+    add the run's rows to the cumulative results store.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param run: Run.
+    :type run: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    run_id = run['run_id']
+    pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
+    pipeline_minor_version = ''.join(pipeline['pipeline_version'].rsplit('.', 1)[0])
+    pipeline_path_name = '-'.join([pipeline_short_name, pipeline_minor_version, 'output'])
+    analysis_run_output_dir = os.path.join(config['analysis_output_dir'], run_id, pipeline_path_name)
+
+    run_tables = load_run_tables(analysis_run_output_dir, run_id)
+    summary_path = os.path.join(analysis_run_output_dir, run_id + '_run_summary.html')
+    write_run_summary_html(run_id, run_tables, summary_path)
+    logging.info(json.dumps({
+        "event_type": "run_summary_written",
+        "sequencing_run_id": run_id,
+        "run_summary_path": os.path.abspath(summary_path),
+        "num_rows": {table_name: len(df) for table_name, df in run_tables.items()},
+    }))
+
+    results_store_dir = config.get('results_store_dir', None)
+    if results_store_dir is None:
+        return
+    try:
+        import pyarrow
+    except ImportError as e:
+        logging.warning(json.dumps({"event_type": "results_store_unavailable", "sequencing_run_id": run_id, "error": "pyarrow is required to write to the results store"}))
+        return
+    for table_name, df in run_tables.items():
+        df = df.copy()
+        df['pipeline_name'] = pipeline['pipeline_name']
+        df['pipeline_version'] = pipeline['pipeline_version']
+        partition_dir = write_results_store_partition(results_store_dir, table_name, run_id, df)
+        logging.info(json.dumps({"event_type": "results_store_partition_written", "sequencing_run_id": run_id, "table_name": table_name, "partition_dir": os.path.abspath(partition_dir), "num_rows": len(df)}))
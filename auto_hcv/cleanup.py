@@ -0,0 +1,304 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from typing import Optional
+
+import auto_hcv.metrics as metrics
+
+DEFAULT_CLEANUP_WORKERS = 1
+DEFAULT_CLEANUP_MAX_ATTEMPTS = 5
+DEFAULT_CLEANUP_RETRY_DELAY_SECONDS = 60.0
+CLEANUP_QUEUE_FILENAME = 'cleanup_queue.json'
+
+
+class RateLimiter:
+    """
+    Limits the rate of an operation across threads. Each call to `wait` blocks until the
+    operation is allowed to proceed, so that at most `max_per_second` operations happen per second.
+    """
+    def __init__(self, max_per_second: Optional[float]=None):
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            allowed_time = max(now, self.next_time)
+            self.next_time = allowed_time + self.interval
+        delay = allowed_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def delete_work_dir(work_dir: str, rate_limiter: Optional[RateLimiter]=None) -> dict[str, object]:
+    """
+    Delete a work dir, bottom-up, one file at a time, so that the rate of deletions can be limited.
+    A work dir that no longer exists (for example, because an earlier attempt got part of the way through)
+    is not an error.
+
+    :param work_dir: Path to the work dir.
+    :type work_dir: str
+    :param rate_limiter: Limits the rate of unlinks, if provided.
+    :type rate_limiter: Optional[RateLimiter]
+    :return: Dict with keys `bytes_reclaimed`, `num_files_deleted`, `duration_seconds` and `errors`.
+    :rtype: dict[str, object]
+    """
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+    start = time.monotonic()
+    errors = []
+    bytes_reclaimed = 0
+    num_files_deleted = 0
+    for dirpath, dirnames, filenames in os.walk(work_dir, topdown=False, onerror=lambda e: errors.append(str(e))):
+        # Symlinks to directories are listed in dirnames, but are unlinked like files.
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            path = os.path.join(dirpath, name)
+            rate_limiter.wait()
+            try:
+                size = os.lstat(path).st_size
+                os.unlink(path)
+                bytes_reclaimed += size
+                num_files_deleted += 1
+            except FileNotFoundError as e:
+                pass
+            except OSError as e:
+                errors.append(str(e))
+        try:
+            os.rmdir(dirpath)
+        except FileNotFoundError as e:
+            pass
+        except OSError as e:
+            errors.append(str(e))
+
+    # If the work dir is gone, it doesn't matter what went wrong along the way
+    # (os.walk reports a missing work dir through onerror).
+    if not os.path.lexists(work_dir):
+        errors = []
+
+    return {
+        "bytes_reclaimed": bytes_reclaimed,
+        "num_files_deleted": num_files_deleted,
+        "duration_seconds": round(time.monotonic() - start, 3),
+        "errors": errors,
+    }
+
+
+class WorkDirCleaner:
+    """
+    Deletes analysis work dirs in the background, so that the daemon doesn't stop to delete
+    (possibly very large) work dirs before it can start the next analysis.
+
+    Work dirs are deleted by `cleanup_workers` threads (default: 1), and unlinks can be limited to
+    `cleanup_max_files_per_second` across all threads to limit the load on a shared filesystem.
+    The queue of work dirs is saved to a JSON file, so that work dirs that were queued (or partly deleted)
+    when the daemon stopped are deleted after it restarts. Failed deletions are retried, with an increasing
+    delay, up to `cleanup_max_attempts` times.
+
+    If `on_deleted` is set, it is called (from the cleanup thread) with the size of the analysis's input and the
+    number of bytes reclaimed, each time a work dir that was queued with its input size has been deleted.
+    """
+    def __init__(self, queue_path: str, workers: int=DEFAULT_CLEANUP_WORKERS, max_files_per_second: Optional[float]=None, max_attempts: int=DEFAULT_CLEANUP_MAX_ATTEMPTS, retry_delay_seconds: float=DEFAULT_CLEANUP_RETRY_DELAY_SECONDS):
+        self.on_deleted = None
+        self.queue_path = queue_path
+        self.workers = max(1, workers)
+        self.rate_limiter = RateLimiter(max_files_per_second)
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.in_progress = set()
+        self.threads = []
+        self.queue = self.load_queue()
+
+
+    def load_queue(self) -> list[dict[str, object]]:
+        """
+        :return: Queued work dirs, as saved by `save_queue`. Empty if there is no saved queue, or it can't be read.
+        :rtype: list[dict[str, object]]
+        """
+        try:
+            with open(self.queue_path, 'r') as f:
+                queue = json.load(f)
+        except FileNotFoundError as e:
+            return []
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            logging.error(json.dumps({"event_type": "load_cleanup_queue_failed", "cleanup_queue_path": os.path.abspath(self.queue_path), "error": str(e)}))
+            return []
+        # Retry times are stored as wall-clock times, so they remain valid across restarts.
+        for entry in queue:
+            entry.setdefault('attempts', 0)
+            entry.setdefault('next_attempt_time', 0.0)
+
+        return queue
+
+
+    def save_queue(self):
+        """
+        Write the queue to disk. Must be called with `self.condition` held.
+
+        :return: None
+        :rtype: NoneType
+        """
+        queue_dir = os.path.dirname(os.path.abspath(self.queue_path))
+        os.makedirs(queue_dir, exist_ok=True)
+        tmp_queue_path = self.queue_path + '.tmp'
+        with open(tmp_queue_path, 'w') as f:
+            json.dump(self.queue, f, indent=2)
+        os.replace(tmp_queue_path, self.queue_path)
+
+
+    def start(self):
+        """
+        Start the cleanup threads. Threads are daemon threads: if the daemon exits while a work dir is
+        being deleted, the work dir stays in the saved queue and deletion picks up where it left off.
+
+        :return: None
+        :rtype: NoneType
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name='cleanup-' + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if len(self.queue) > 0:
+            logging.info(json.dumps({"event_type": "cleanup_queue_resumed", "cleanup_queue_path": os.path.abspath(self.queue_path), "num_work_dirs_queued": len(self.queue)}))
+
+
+    def stop(self):
+        """
+        Stop the cleanup threads, once they finish the work dirs they are currently deleting.
+
+        :return: None
+        :rtype: NoneType
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+    def enqueue(self, sequencing_run_id: str, analysis_work_dir: str, input_bytes: Optional[int]=None):
+        """
+        Queue a work dir for deletion.
+
+        :param sequencing_run_id: Sequencing run ID.
+        :type sequencing_run_id: str
+        :param analysis_work_dir: Path to the work dir.
+        :type analysis_work_dir: str
+        :param input_bytes: Size of the analysis's input, if known.
+        :type input_bytes: Optional[int]
+        :return: None
+        :rtype: NoneType
+        """
+        with self.condition:
+            if any(entry['analysis_work_dir'] == analysis_work_dir for entry in self.queue):
+                return
+            self.queue.append({
+                "sequencing_run_id": sequencing_run_id,
+                "analysis_work_dir": analysis_work_dir,
+                "timestamp_queued": datetime.datetime.now().isoformat(),
+                "input_bytes": input_bytes,
+                "attempts": 0,
+                "next_attempt_time": 0.0,
+            })
+            self.save_queue()
+            self.condition.notify()
+        logging.info(json.dumps({"event_type": "analysis_work_dir_cleanup_queued", "sequencing_run_id": sequencing_run_id, "analysis_work_dir_path": analysis_work_dir, "num_work_dirs_queued": len(self.queue)}))
+
+
+    def next_entry(self) -> Optional[dict[str, object]]:
+        """
+        Wait until a queued work dir is due to be deleted, and claim it. Must be called with `self.condition` held.
+
+        :return: Queue entry, or None if the cleaner is stopping.
+        :rtype: Optional[dict[str, object]]
+        """
+        while not self.stopping:
+            now = time.time()
+            pending = [entry for entry in self.queue if entry['analysis_work_dir'] not in self.in_progress]
+            due = [entry for entry in pending if entry['next_attempt_time'] <= now]
+            if len(due) > 0:
+                entry = due[0]
+                self.in_progress.add(entry['analysis_work_dir'])
+                return entry
+            timeout = None
+            if len(pending) > 0:
+                timeout = min(entry['next_attempt_time'] for entry in pending) - now
+            self.condition.wait(timeout)
+
+        return None
+
+
+    def worker(self):
+        while True:
+            with self.condition:
+                entry = self.next_entry()
+            if entry is None:
+                return
+            work_dir = entry['analysis_work_dir']
+            result = delete_work_dir(work_dir, self.rate_limiter)
+            with self.condition:
+                self.in_progress.discard(work_dir)
+                entry['attempts'] += 1
+                if len(result['errors']) == 0 or entry['attempts'] >= self.max_attempts:
+                    self.queue.remove(entry)
+                else:
+                    entry['next_attempt_time'] = time.time() + self.retry_delay_seconds * 2 ** (entry['attempts'] - 1)
+                try:
+                    self.save_queue()
+                except OSError as e:
+                    logging.error(json.dumps({"event_type": "save_cleanup_queue_failed", "cleanup_queue_path": os.path.abspath(self.queue_path), "error": str(e)}))
+            self.log_result(entry, result)
+            if self.on_deleted is not None and len(result['errors']) == 0 and entry.get('input_bytes', None):
+                self.on_deleted(entry['input_bytes'], result['bytes_reclaimed'])
+
+
+    def log_result(self, entry: dict[str, object], result: dict[str, object]):
+        event = {
+            "sequencing_run_id": entry['sequencing_run_id'],
+            "analysis_work_dir_path": entry['analysis_work_dir'],
+            "attempts": entry['attempts'],
+            "bytes_reclaimed": result['bytes_reclaimed'],
+            "num_files_deleted": result['num_files_deleted'],
+            "duration_seconds": result['duration_seconds'],
+        }
+        metrics.CLEANUP_DURATION_SECONDS.observe(result['duration_seconds'])
+        metrics.CLEANUP_BYTES_RECLAIMED.inc(result['bytes_reclaimed'])
+        if len(result['errors']) == 0:
+            logging.info(json.dumps(dict({"event_type": "analysis_work_dir_deleted"}, **event)))
+        elif entry['attempts'] >= self.max_attempts:
+            logging.error(json.dumps(dict({"event_type": "delete_analysis_work_dir_failed", "errors": result['errors'][:10], "retrying": False}, **event)))
+        else:
+            logging.warning(json.dumps(dict({"event_type": "delete_analysis_work_dir_failed", "errors": result['errors'][:10], "retrying": True}, **event)))
+
+
+def create_cleaner(config: dict[str, object]) -> WorkDirCleaner:
+    """
+    Create (and start) a work dir cleaner, using the `cleanup_*` settings from the application config.
+    The queue is saved to `cleanup_queue_path` (default: `cleanup_queue.json` in the `analysis_work_dir`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Running cleaner.
+    :rtype: WorkDirCleaner
+    """
+    queue_path = config.get('cleanup_queue_path', None) or os.path.join(config['analysis_work_dir'], CLEANUP_QUEUE_FILENAME)
+    max_files_per_second = config.get('cleanup_max_files_per_second', None)
+    cleaner = WorkDirCleaner(
+        queue_path,
+        workers=int(config.get('cleanup_workers', DEFAULT_CLEANUP_WORKERS)),
+        max_files_per_second=float(max_files_per_second) if max_files_per_second else None,
+        max_attempts=int(config.get('cleanup_max_attempts', DEFAULT_CLEANUP_MAX_ATTEMPTS)),
+    )
+    cleaner.start()
+
+    return cleaner
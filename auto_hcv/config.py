@@ -1,7 +1,395 @@
+import hashlib
 import json
+import logging
+import os
+import re
+import threading
+
+from typing import Optional
+
+import auto_hcv.executor as executor
+import auto_hcv.preflight as preflight
+import auto_hcv.reuse as reuse
+
+# Keys that must be set in the daemon's config
+REQUIRED_CONFIG_KEYS = ['fastq_by_run_dir', 'analysis_output_dir', 'analysis_work_dir', 'pipelines']
+REQUIRED_PIPELINE_KEYS = ['pipeline_name', 'pipeline_version', 'pipeline_parameters']
+# Settings that must be positive integers, if they are set
+POSITIVE_INT_CONFIG_KEYS = ['max_concurrent_analyses', 'max_analysis_attempts', 'report_workers', 'cleanup_workers']
+POSITIVE_INT_PIPELINE_KEYS = ['max_concurrent_analyses', 'max_analysis_attempts', 'num_shards']
+# Settings that must be non-negative numbers, if they are set
+NON_NEGATIVE_NUMBER_CONFIG_KEYS = ['scan_interval_seconds', 'poll_interval_seconds', 'analysis_retry_backoff_seconds']
+
+
+class ConfigValidationError(ValueError):
+    """
+    Raised when the config is missing required settings, or has settings with invalid values.
+    """
+    pass
+
+
+class PipelineDependencyError(ValueError):
+    """
+    Raised when the `dependencies` of the configured pipelines refer to a pipeline that isn't configured,
+    or when they form a cycle.
+    """
+    pass
+
+
+def get_pipeline_key(pipeline: dict[str, object]) -> tuple[str, str]:
+    """
+    Get a key that identifies a pipeline (or a pipeline dependency).
+
+    :param pipeline: Pipeline config, or an entry from a pipeline's `dependencies`.
+    :type pipeline: dict[str, object]
+    :return: (pipeline_name, pipeline_version)
+    :rtype: tuple[str, str]
+    """
+    return (pipeline['pipeline_name'], pipeline['pipeline_version'])
+
+
+def build_pipeline_dag(pipelines: list[dict[str, object]]) -> dict[tuple[str, str], list[tuple[str, str]]]:
+    """
+    Build a directed acyclic graph of the configured pipelines from their `dependencies`.
+
+    :param pipelines: Pipeline configs.
+    :type pipelines: list[dict[str, object]]
+    :return: Map from each pipeline key to the keys of the pipelines that it depends on.
+    :rtype: dict[tuple[str, str], list[tuple[str, str]]]
+    :raises PipelineDependencyError: If a dependency is not one of the configured pipelines.
+    """
+    dag = {}
+    for pipeline in pipelines:
+        dag[get_pipeline_key(pipeline)] = []
+    for pipeline in pipelines:
+        dependencies = pipeline.get('dependencies', None)
+        if dependencies is None:
+            continue
+        for dependency in dependencies:
+            dependency_key = get_pipeline_key(dependency)
+            if dependency_key not in dag:
+                raise PipelineDependencyError(
+                    "Pipeline " + "@".join(get_pipeline_key(pipeline)) + " depends on " + "@".join(dependency_key) + ", which is not a configured pipeline"
+                )
+            dag[get_pipeline_key(pipeline)].append(dependency_key)
+
+    return dag
+
+
+def sort_pipelines_by_dependencies(pipelines: list[dict[str, object]]) -> list[dict[str, object]]:
+    """
+    Sort pipelines so that every pipeline comes after all of the pipelines that it depends on.
+    Pipelines that don't depend on one another keep the order that they were configured in.
+
+    :param pipelines: Pipeline configs.
+    :type pipelines: list[dict[str, object]]
+    :return: Pipeline configs, in dependency order.
+    :rtype: list[dict[str, object]]
+    :raises PipelineDependencyError: If a dependency is not configured, or if the dependencies form a cycle.
+    """
+    dag = build_pipeline_dag(pipelines)
+    sorted_pipelines = []
+    sorted_keys = set()
+    remaining_pipelines = list(pipelines)
+    while len(remaining_pipelines) > 0:
+        ready_pipelines = [p for p in remaining_pipelines if all(dep in sorted_keys for dep in dag[get_pipeline_key(p)])]
+        if len(ready_pipelines) == 0:
+            cycle = ", ".join(["@".join(get_pipeline_key(p)) for p in remaining_pipelines])
+            raise PipelineDependencyError("Pipeline dependencies form a cycle between: " + cycle)
+        for pipeline in ready_pipelines:
+            sorted_pipelines.append(pipeline)
+            sorted_keys.add(get_pipeline_key(pipeline))
+            remaining_pipelines.remove(pipeline)
+
+    return sorted_pipelines
+
 
 def load_config(config_path: str) -> dict[str, object]:
+    """
+    Load the config file. Pipelines are sorted so that each pipeline comes after the pipelines that it depends on.
+
+    :param config_path: Path to the config file.
+    :type config_path: str
+    :return: Application config.
+    :rtype: dict[str, object]
+    :raises json.decoder.JSONDecodeError: If the config file isn't valid JSON.
+    :raises PipelineDependencyError: If the pipeline dependencies are invalid.
+    """
     with open(config_path, 'r') as f:
         config = json.load(f)
 
+    if 'pipelines' in config:
+        config['pipelines'] = sort_pipelines_by_dependencies(config['pipelines'])
+
     return config
+
+
+def check_positive_int(settings: dict[str, object], key: str, context: str):
+    """
+    Check that a setting, if it is set, is a positive integer.
+
+    :param settings: Config, or the section of it that the setting is in.
+    :type settings: dict[str, object]
+    :param key: Name of the setting.
+    :type key: str
+    :param context: Where the setting is, for the error message.
+    :type context: str
+    :return: None
+    :rtype: NoneType
+    :raises ConfigValidationError: If the setting isn't a positive integer.
+    """
+    value = settings.get(key, None)
+    if value is None:
+        return
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ConfigValidationError(context + ": " + key + " must be a positive integer, got " + json.dumps(value))
+
+
+def check_pipeline_key(pipeline: dict[str, object], context: str):
+    """
+    Check that the `pipeline_name` and `pipeline_version` of a pipeline (or a pipeline dependency) are non-empty strings,
+    before they are used to identify it (see `get_pipeline_key`).
+
+    :param pipeline: Pipeline config, or an entry from a pipeline's `dependencies`.
+    :type pipeline: dict[str, object]
+    :param context: Which pipeline (or dependency) it is, for the error message.
+    :type context: str
+    :return: None
+    :rtype: NoneType
+    :raises ConfigValidationError: If the name or version isn't a non-empty string.
+    """
+    for key in ['pipeline_name', 'pipeline_version']:
+        if not isinstance(pipeline[key], str) or pipeline[key] == '':
+            raise ConfigValidationError(context + ": " + key + " must be a non-empty string, got " + json.dumps(pipeline[key]))
+
+
+def validate_pipeline(pipeline: dict[str, object]):
+    """
+    Check the config of one pipeline.
+
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    :raises ConfigValidationError: If the pipeline config is invalid.
+    """
+    if not isinstance(pipeline, dict):
+        raise ConfigValidationError("Pipeline entries must be objects, got " + json.dumps(pipeline))
+    missing_keys = [key for key in REQUIRED_PIPELINE_KEYS if key not in pipeline]
+    if len(missing_keys) > 0:
+        raise ConfigValidationError("Pipeline " + json.dumps(pipeline.get('pipeline_name', None)) + " is missing: " + ", ".join(missing_keys))
+    check_pipeline_key(pipeline, "Pipeline " + json.dumps(pipeline['pipeline_name']))
+    context = "Pipeline " + "@".join(get_pipeline_key(pipeline))
+    if len(pipeline['pipeline_name'].split('/')) != 2:
+        raise ConfigValidationError(context + ": pipeline_name must be of the form <owner>/<repo>")
+    if not isinstance(pipeline['pipeline_parameters'], dict):
+        raise ConfigValidationError(context + ": pipeline_parameters must be an object")
+    for key in POSITIVE_INT_PIPELINE_KEYS:
+        check_positive_int(pipeline, key, context)
+    if not isinstance(pipeline.get('dependencies', None) or [], list):
+        raise ConfigValidationError(context + ": dependencies must be a list")
+    for dependency in pipeline.get('dependencies', None) or []:
+        if not isinstance(dependency, dict) or 'pipeline_name' not in dependency or 'pipeline_version' not in dependency:
+            raise ConfigValidationError(context + ": dependencies must have a pipeline_name and pipeline_version, got " + json.dumps(dependency))
+        check_pipeline_key(dependency, context + ": dependency " + json.dumps(dependency))
+
+
+def check_number(settings: dict[str, object], key: str, context: str):
+    """
+    Check that a setting, if it is set, is a number.
+
+    :param settings: Config, or the section of it that the setting is in.
+    :type settings: dict[str, object]
+    :param key: Name of the setting.
+    :type key: str
+    :param context: Where the setting is, for the error message.
+    :type context: str
+    :return: None
+    :rtype: NoneType
+    :raises ConfigValidationError: If the setting isn't a number.
+    """
+    value = settings.get(key, None)
+    if value is None:
+        return
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ConfigValidationError(context + ": " + key + " must be a number, got " + json.dumps(value))
+
+
+def validate_run_priority(run_priority_config: dict[str, object]):
+    """
+    Check the `run_priority` settings: each rule's `run_id_regex` must compile, and each rule's `priority`
+    (and the `priority_per_day`) must be a number.
+
+    :param run_priority_config: The `run_priority` section of the config.
+    :type run_priority_config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    :raises ConfigValidationError: If the `run_priority` settings are invalid.
+    """
+    if not isinstance(run_priority_config, dict):
+        raise ConfigValidationError("run_priority must be an object")
+    check_number(run_priority_config, 'priority_per_day', "run_priority")
+    control_file = run_priority_config.get('control_file', None)
+    if control_file is not None and not isinstance(control_file, str):
+        raise ConfigValidationError("run_priority: control_file must be a path")
+    rules = run_priority_config.get('rules', None) or []
+    if not isinstance(rules, list):
+        raise ConfigValidationError("run_priority: rules must be a list")
+    for rule in rules:
+        if not isinstance(rule, dict):
+            raise ConfigValidationError("run_priority: rules must be objects, got " + json.dumps(rule))
+        context = "run_priority rule " + json.dumps(rule)
+        check_number(rule, 'priority', context)
+        if 'run_id_regex' in rule:
+            if not isinstance(rule['run_id_regex'], str):
+                raise ConfigValidationError(context + ": run_id_regex must be a string")
+            try:
+                re.compile(rule['run_id_regex'])
+            except re.error as e:
+                raise ConfigValidationError(context + ": run_id_regex is not a valid regular expression: " + str(e))
+
+
+def validate_config(config: dict[str, object]):
+    """
+    Check that the settings needed to run the daemon are present and valid: required paths, pipeline entries,
+    pipeline dependencies (which must refer to configured pipelines, without cycles), executors, preflight checks, input reuse
+    and run priority rules.
+
+    :param config: Application config, as loaded by `load_config`.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    :raises ConfigValidationError: If the config is invalid.
+    :raises PipelineDependencyError: If the pipeline dependencies are invalid.
+    """
+    missing_keys = [key for key in REQUIRED_CONFIG_KEYS if key not in config]
+    if len(missing_keys) > 0:
+        raise ConfigValidationError("Config is missing: " + ", ".join(missing_keys))
+    for key in ['fastq_by_run_dir', 'analysis_output_dir', 'analysis_work_dir']:
+        if not isinstance(config[key], str) or config[key] == '':
+            raise ConfigValidationError(key + " must be a path")
+    if not os.path.isdir(config['fastq_by_run_dir']):
+        raise ConfigValidationError("fastq_by_run_dir is not a directory: " + config['fastq_by_run_dir'])
+    for key in ['analysis_output_dir', 'analysis_work_dir']:
+        if os.path.exists(config[key]) and not os.path.isdir(config[key]):
+            raise ConfigValidationError(key + " is not a directory: " + config[key])
+    for key in POSITIVE_INT_CONFIG_KEYS:
+        check_positive_int(config, key, "Config")
+    for key in NON_NEGATIVE_NUMBER_CONFIG_KEYS:
+        value = config.get(key, None)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+            raise ConfigValidationError(key + " must be a non-negative number, got " + json.dumps(value))
+    preflight_config = config.get('preflight', None) or {}
+    if not isinstance(preflight_config, dict):
+        raise ConfigValidationError("preflight must be an object")
+    check_positive_int(preflight_config, 'workers', "preflight")
+    if preflight_config.get('gzip_check', 'trailer') not in preflight.GZIP_CHECK_MODES:
+        raise ConfigValidationError("preflight: gzip_check must be one of: " + ", ".join(preflight.GZIP_CHECK_MODES))
+    if preflight_config.get('on_bad_sample', 'exclude') not in preflight.ON_BAD_SAMPLE_ACTIONS:
+        raise ConfigValidationError("preflight: on_bad_sample must be one of: " + ", ".join(preflight.ON_BAD_SAMPLE_ACTIONS))
+    reuse_config = config.get('input_reuse', None) or {}
+    if not isinstance(reuse_config, dict):
+        raise ConfigValidationError("input_reuse must be an object")
+    if reuse_config.get('enabled', False) and 'run_state_db' not in config:
+        raise ConfigValidationError("input_reuse needs a run_state_db, to index the inputs of completed analyses")
+    if reuse_config.get('mode', reuse.DEFAULT_REUSE_MODE) not in reuse.REUSE_MODES:
+        raise ConfigValidationError("input_reuse: mode must be one of: " + ", ".join(reuse.REUSE_MODES))
+    validate_run_priority(config.get('run_priority', None) or {})
+    if not isinstance(config['pipelines'], list):
+        raise ConfigValidationError("pipelines must be a list")
+    for pipeline in config['pipelines']:
+        validate_pipeline(pipeline)
+        try:
+            executor.get_executor(config, pipeline)
+        except ValueError as e:
+            raise ConfigValidationError(str(e))
+    build_pipeline_dag(config['pipelines'])
+
+
+class ConfigManager:
+    """
+    Holds the daemon's config, and reloads it when the config file changes (or when a reload is requested, on SIGHUP).
+
+    Checking for changes only needs a `stat` of the config file, so it can be done on every pass of the main loop.
+    Each config is validated (see `validate_config`) when it is loaded. If a reload fails, the error is logged once
+    and the last good config is kept. Each config that is loaded gets a version number, one higher than the last,
+    which is stored in the config as `config_version` (along with `config_sha256`, the hash of the file) so that
+    it can be recorded on the analyses that it was used for.
+    """
+    def __init__(self, config_path: str):
+        self.config_path = config_path
+        self.config = None
+        self.version = 0
+        self.loaded_stat = None
+        self.failed_stat = None
+        self.reload_requested = threading.Event()
+
+
+    def get_stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.config_path)
+        except OSError as e:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+    def request_reload(self, *args):
+        """
+        Reload the config the next time `reload_if_changed` is called, even if the file hasn't changed.
+        Can be used as a signal handler.
+        """
+        self.reload_requested.set()
+
+
+    def load(self) -> dict[str, object]:
+        """
+        Load and validate the config file.
+
+        :return: The new config.
+        :rtype: dict[str, object]
+        :raises OSError: If the config file can't be read.
+        :raises json.decoder.JSONDecodeError: If the config file isn't valid JSON.
+        :raises ConfigValidationError: If the config is invalid.
+        :raises PipelineDependencyError: If the pipeline dependencies are invalid.
+        """
+        config_stat = self.get_stat()
+        with open(self.config_path, 'rb') as f:
+            config_bytes = f.read()
+        config = json.loads(config_bytes)
+        if not isinstance(config, dict):
+            raise ConfigValidationError("Config must be an object")
+        validate_config(config)
+        config['pipelines'] = sort_pipelines_by_dependencies(config['pipelines'])
+        self.version += 1
+        config['config_version'] = self.version
+        config['config_sha256'] = hashlib.sha256(config_bytes).hexdigest()
+        self.config = config
+        self.loaded_stat = config_stat
+        self.failed_stat = None
+        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(self.config_path), "config_version": self.version, "config_sha256": config['config_sha256']}))
+
+        return config
+
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reload the config if the file has changed since it was last loaded, or if a reload was requested.
+
+        :return: Whether or not a new config was loaded.
+        :rtype: bool
+        """
+        reload_requested = self.reload_requested.is_set()
+        self.reload_requested.clear()
+        config_stat = self.get_stat()
+        if not reload_requested and (config_stat == self.loaded_stat or config_stat == self.failed_stat):
+            return False
+        try:
+            self.load()
+        except (OSError, json.decoder.JSONDecodeError, ConfigValidationError, PipelineDependencyError) as e:
+            # The last valid config that was loaded stays in use. The error is only logged once for each version of the file.
+            self.failed_stat = config_stat
+            logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(self.config_path), "config_version": self.version, "error": str(e)}))
+            return False
+
+        return True
@@ -3,57 +3,295 @@ import glob
 import json
 import logging
 import os
+import pathlib
 import re
 import shutil
 import subprocess
 
 from typing import Iterator, Optional
+import auto_hcv.executor as executor
+import auto_hcv.metrics as metrics
+import auto_hcv.nextflow_output as nextflow_output
 import auto_hcv.post_analysis as post_analysis
+import auto_hcv.preflight as preflight
+import auto_hcv.sharding as sharding
+import auto_hcv.state as state
 
-def find_fastq_dirs(config, check_symlinks_complete=True):
-    miseq_run_id_regex = "\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}"
-    nextseq_run_id_regex = "\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}"
-    
+MISEQ_RUN_ID_REGEX = "\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}"
+NEXTSEQ_RUN_ID_REGEX = "\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}"
+
+# By default, failed analyses are not retried.
+DEFAULT_MAX_ANALYSIS_ATTEMPTS = 1
+DEFAULT_ANALYSIS_RETRY_BACKOFF_SECONDS = 600.0
+ANALYSIS_ATTEMPTS_FILENAME = 'analysis_attempts.json'
+# Recorded as the `returncode` of attempts whose pipeline couldn't be launched at all
+LAUNCH_FAILED_RETURNCODE = -1
+
+
+def matches_illumina_run_id_format(run_id: str) -> bool:
+    """
+    :param run_id: Directory name.
+    :type run_id: str
+    :return: Whether or not the name matches the MiSeq or NextSeq run ID format.
+    :rtype: bool
+    """
+    matches_miseq_regex = re.match(MISEQ_RUN_ID_REGEX, run_id)
+    matches_nextseq_regex = re.match(NEXTSEQ_RUN_ID_REGEX, run_id)
+
+    return (matches_miseq_regex is not None) or (matches_nextseq_regex is not None)
+
+
+def get_marker_mtime(subdir) -> Optional[float]:
+    """
+    :param subdir: Directory entry, as returned by `os.scandir` (or a `pathlib.Path`).
+    :type subdir: os.DirEntry | pathlib.Path
+    :return: Modification time of the run's `symlinks_complete.json`, or None if there isn't one.
+    :rtype: Optional[float]
+    """
+    try:
+        return os.stat(os.path.join(subdir, "symlinks_complete.json")).st_mtime
+    except OSError as e:
+        return None
+
+
+def is_run_dir_unchanged(config: dict[str, object], subdir: os.DirEntry, known_run: Optional[dict[str, object]]) -> bool:
+    """
+    Use the run's record from the run state store to decide whether a directory can be skipped without re-checking it.
+
+    Directories that aren't sequencing runs never need to be re-checked. Neither do runs that have finished, unless
+    the configured pipelines have changed, or the run failed and failed analyses may be retried. Runs that are waiting
+    for `symlinks_complete.json` are only re-checked if the modification time of the run directory, or of the
+    `symlinks_complete.json` in it, has changed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param subdir: Directory entry, as returned by `os.scandir` (or a `pathlib.Path`).
+    :type subdir: os.DirEntry | pathlib.Path
+    :param known_run: Run record from the run state store, or None if the run isn't in the store.
+    :type known_run: Optional[dict[str, object]]
+    :return: Whether or not the directory can be skipped.
+    :rtype: bool
+    """
+    if known_run is None:
+        return False
+    if known_run['status'] == state.RUN_STATUS_IGNORED:
+        return True
+    if known_run['status'] == state.RUN_STATUS_FAILED and retries_enabled(config):
+        # Failed analyses may be due to be retried.
+        return False
+    if known_run['status'] in state.FINISHED_RUN_STATUSES:
+        return known_run['pipelines_key'] == state.get_pipelines_key(config)
+    if known_run['status'] == state.RUN_STATUS_DISCOVERED:
+        return subdir.stat().st_mtime == known_run['dir_mtime'] and get_marker_mtime(subdir) == known_run['marker_mtime']
+
+    return False
+
+
+def check_fastq_dir(config: dict[str, object], subdir, check_symlinks_complete: bool=True, run_state=None, known_run: Optional[dict[str, object]]=None) -> Optional[dict[str, object]]:
+    """
+    Check whether a directory under `fastq_by_run_dir` is a sequencing run that is ready to analyze.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param subdir: Directory entry, as returned by `os.scandir` (or a `pathlib.Path`).
+    :type subdir: os.DirEntry | pathlib.Path
+    :param check_symlinks_complete: Whether or not to require a `symlinks_complete.json` file in the run directory.
+    :type check_symlinks_complete: bool
+    :param run_state: Run state store.
+    :type run_state: Optional[auto_hcv.state.RunStateStore]
+    :param known_run: Run record from the run state store, or None if the run isn't in the store.
+    :type known_run: Optional[dict[str, object]]
+    :return: A run directory to analyze, or None
+    :rtype: Optional[dict[str, object]]
+    """
+    run_id = subdir.name
+    run_fastq_directory = os.path.abspath(subdir)
+
+    if is_run_dir_unchanged(config, subdir, known_run):
+        logging.debug(json.dumps({"event_type": "directory_skipped_unchanged", "fastq_directory": run_fastq_directory, "run_status": known_run['status']}))
+        metrics.DIRECTORIES_SKIPPED.inc(reason='unchanged')
+        return None
+
+    print(subdir)
+    is_directory = subdir.is_dir()
+    if check_symlinks_complete and is_directory:
+        ready_to_analyze = os.path.exists(os.path.join(run_fastq_directory, "symlinks_complete.json"))
+    else:
+        ready_to_analyze = not check_symlinks_complete
+    conditions_checked = {
+        "is_directory": is_directory,
+        "matches_illumina_run_id_format": matches_illumina_run_id_format(run_id),
+        "ready_to_analyze": ready_to_analyze,
+    }
+    conditions_met = list(conditions_checked.values())
+
+    if run_state is not None:
+        record_run_dir_state(run_state, subdir, conditions_checked, known_run)
+
+    analysis_parameters = {}
+    if all(conditions_met):
+
+        logging.info(json.dumps({"event_type": "fastq_directory_found", "sequencing_run_id": run_id, "fastq_directory_path": run_fastq_directory}))
+        analysis_parameters['fastq_input'] = run_fastq_directory
+        run = {
+            "run_id": run_id,
+            "fastq_directory": run_fastq_directory,
+            "analysis_parameters": analysis_parameters
+        }
+        # The run's fastq files are checked before it is analyzed (see `auto_hcv.preflight`), if enabled.
+        return preflight.preflight_run(config, run)
+    else:
+        logging.debug(json.dumps({"event_type": "directory_skipped", "fastq_directory": run_fastq_directory, "conditions_checked": conditions_checked}))
+        metrics.DIRECTORIES_SKIPPED.inc(reason='not_ready')
+        return None
+
+
+def find_fastq_dirs(config, check_symlinks_complete=True, run_state=None):
+    """
+    Find run directories under `fastq_by_run_dir` that are ready to analyze.
+
+    If a run state store is provided, runs that have finished and directories that haven't changed since
+    they were last checked are skipped, and the status of each directory that is checked is recorded.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param check_symlinks_complete: Whether or not to require a `symlinks_complete.json` file in the run directory.
+    :type check_symlinks_complete: bool
+    :param run_state: Run state store.
+    :type run_state: Optional[auto_hcv.state.RunStateStore]
+    :return: A run directory to analyze, or None
+    :rtype: Iterator[Optional[dict[str, object]]]
+    """
     fastq_by_run_dir = config['fastq_by_run_dir']
     subdirs = os.scandir(fastq_by_run_dir)
     if 'analyze_runs_in_reverse_order' in config and config['analyze_runs_in_reverse_order']:
         subdirs = sorted(subdirs, key=lambda x: os.path.basename(x.path), reverse=True)
+    known_runs = {}
+    if run_state is not None:
+        known_runs = run_state.get_runs()
     for subdir in subdirs:
-        print(subdir)
-        run_id = subdir.name
-        run_fastq_directory = os.path.abspath(subdir.path)
+        known_run = known_runs.get(subdir.name, None)
+        metrics.DIRECTORIES_SEEN.inc()
+        yield check_fastq_dir(config, subdir, check_symlinks_complete, run_state, known_run)
 
-        matches_miseq_regex = re.match(miseq_run_id_regex, run_id)
-        matches_nextseq_regex = re.match(nextseq_run_id_regex, run_id)
 
-        if check_symlinks_complete:
-            ready_to_analyze = os.path.exists(os.path.join(subdir.path, "symlinks_complete.json"))
-        else:
-            ready_to_analyze = True
-        conditions_checked = {
-            "is_directory": subdir.is_dir(),
-            "matches_illumina_run_id_format": ((matches_miseq_regex is not None) or (matches_nextseq_regex is not None)),
-            "ready_to_analyze": ready_to_analyze,
-        }
-        conditions_met = list(conditions_checked.values())
-        
-        analysis_parameters = {}
-        if all(conditions_met):
-
-            logging.info(json.dumps({"event_type": "fastq_directory_found", "sequencing_run_id": run_id, "fastq_directory_path": os.path.abspath(subdir.path)}))
-            analysis_parameters['fastq_input'] = run_fastq_directory
-            run = {
-                "run_id": run_id,
-                "fastq_directory": run_fastq_directory,
-                "analysis_parameters": analysis_parameters
-            }
-            yield run
-        else:
-            logging.debug(json.dumps({"event_type": "directory_skipped", "fastq_directory": run_fastq_directory, "conditions_checked": conditions_checked}))
-            yield None
-    
+def record_run_dir_state(run_state, subdir: os.DirEntry, conditions_checked: dict[str, bool], known_run: Optional[dict[str, object]]):
+    """
+    Record the status of a directory that was checked by `find_fastq_dirs` in the run state store.
+    Runs that have already been started keep their status, which is updated as their analyses progress.
+
+    :param run_state: Run state store.
+    :type run_state: auto_hcv.state.RunStateStore
+    :param subdir: Directory entry, as returned by `os.scandir` (or a `pathlib.Path`).
+    :type subdir: os.DirEntry | pathlib.Path
+    :param conditions_checked: Conditions checked by `find_fastq_dirs`.
+    :type conditions_checked: dict[str, bool]
+    :param known_run: Run record from the run state store, or None if the run isn't in the store.
+    :type known_run: Optional[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    if known_run is not None and known_run['status'] not in [state.RUN_STATUS_IGNORED, state.RUN_STATUS_DISCOVERED]:
+        return
+    run_fastq_directory = os.path.abspath(subdir)
+    if not (conditions_checked['is_directory'] and conditions_checked['matches_illumina_run_id_format']):
+        run_state.set_run_status(subdir.name, state.RUN_STATUS_IGNORED, fastq_directory=run_fastq_directory)
+    elif conditions_checked['ready_to_analyze']:
+        run_state.set_run_status(subdir.name, state.RUN_STATUS_READY, fastq_directory=run_fastq_directory, dir_mtime=subdir.stat().st_mtime, marker_mtime=get_marker_mtime(subdir))
+    else:
+        run_state.set_run_status(subdir.name, state.RUN_STATUS_DISCOVERED, fastq_directory=run_fastq_directory, dir_mtime=subdir.stat().st_mtime, marker_mtime=get_marker_mtime(subdir))
+
+
+def refresh_run_state(config: dict[str, object], run_state, run_id: str) -> Optional[str]:
+    """
+    Update the status of each of a run's analyses in the run state store by checking its analysis output dirs.
+    Pipeline completion is determined by the presence of an `analysis_complete.json` file in the analysis output directory.
+    Analyses that are already recorded as finished are not checked again.
 
-def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_state: Run state store.
+    :type run_state: auto_hcv.state.RunStateStore
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Updated run status, or None if the run isn't in the store.
+    :rtype: Optional[str]
+    """
+    analysis_run_output_dir = os.path.join(config['analysis_output_dir'], run_id)
+    known_analyses = run_state.get_analyses(run_id)
+    for pipeline in config.get('pipelines', []):
+        known_analysis = known_analyses.get((pipeline['pipeline_name'], pipeline['pipeline_version']), None)
+        if known_analysis is not None and known_analysis['status'] in state.FINISHED_RUN_STATUSES:
+            continue
+        analysis_pipeline_output_dir = os.path.abspath(os.path.join(analysis_run_output_dir, get_analysis_output_dir_name(pipeline)))
+        if os.path.exists(os.path.join(analysis_pipeline_output_dir, 'analysis_complete.json')):
+            run_state.set_analysis_status(config, run_id, pipeline, state.RUN_STATUS_COMPLETE, analysis_pipeline_output_dir)
+            index_analysis_input(run_state, run_id, pipeline, analysis_pipeline_output_dir)
+        elif os.path.exists(analysis_pipeline_output_dir) and known_analysis is None:
+            attempts = load_analysis_attempts(analysis_pipeline_output_dir)
+            if len(attempts) > 0 and attempts[-1].get('returncode', None) not in [None, 0]:
+                run_state.set_analysis_status(config, run_id, pipeline, state.RUN_STATUS_FAILED, analysis_pipeline_output_dir)
+            else:
+                run_state.set_analysis_status(config, run_id, pipeline, state.RUN_STATUS_STARTED, analysis_pipeline_output_dir)
+    known_run = run_state.get_run(run_id)
+    if known_run is None:
+        return None
+
+    return known_run['status']
+
+
+def index_analysis_input(run_state, run_id: str, pipeline: dict[str, object], analysis_pipeline_output_dir: str):
+    """
+    Record the input of a completed analysis in the run state store, from its `analysis_complete.json`, so that
+    its outputs can be reused (see `auto_hcv.reuse`). Analyses that were themselves reused, or that were run
+    without an input fingerprint, aren't recorded.
+
+    :param run_state: Run state store.
+    :type run_state: auto_hcv.state.RunStateStore
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param analysis_pipeline_output_dir: Analysis output dir.
+    :type analysis_pipeline_output_dir: str
+    :return: None
+    :rtype: NoneType
+    """
+    try:
+        with open(os.path.join(analysis_pipeline_output_dir, 'analysis_complete.json'), 'r') as f:
+            analysis_complete = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        return
+    if analysis_complete.get('reuse_key', None) is None or analysis_complete.get('reused_from', None) is not None:
+        return
+    run_state.record_analysis_input(analysis_complete['reuse_key'], analysis_complete['input_fingerprint'], run_id, pipeline, analysis_pipeline_output_dir)
+
+
+def rebuild_run_state(config: dict[str, object], run_state) -> int:
+    """
+    Discard the contents of the run state store, then re-populate it by checking every run directory
+    (and every analysis output dir) on the filesystem.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_state: Run state store.
+    :type run_state: auto_hcv.state.RunStateStore
+    :return: Number of directories recorded.
+    :rtype: int
+    """
+    logging.info(json.dumps({"event_type": "rebuild_run_state_start", "run_state_db": os.path.abspath(run_state.db_path)}))
+    run_state.clear()
+    num_dirs = 0
+    for run in find_fastq_dirs(config, run_state=run_state):
+        num_dirs += 1
+        if run is not None:
+            refresh_run_state(config, run_state, run['run_id'])
+    logging.info(json.dumps({"event_type": "rebuild_run_state_complete", "run_state_db": os.path.abspath(run_state.db_path), "num_directories": num_dirs}))
+
+    return num_dirs
+
+
+def scan(config: dict[str, object], run_state=None) -> Iterator[Optional[dict[str, object]]]:
     """
     Scanning involves looking for all existing runs and storing them to the database,
     then looking for all existing symlinks and storing them to the database.
@@ -61,14 +299,41 @@ def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
 
     :param config: Application config.
     :type config: dict[str, object]
+    :param run_state: Run state store. If provided, runs that have finished or haven't changed are skipped.
+    :type run_state: Optional[auto_hcv.state.RunStateStore]
     :return: A run directory to analyze, or None
     :rtype: Iterator[Optional[dict[str, object]]]
     """
     logging.info(json.dumps({"event_type": "scan_start"}))
-    for symlinks_dir in find_fastq_dirs(config):    
+    for symlinks_dir in find_fastq_dirs(config, run_state=run_state):
         yield symlinks_dir
 
 
+def watch(config: dict[str, object], watcher, timeout: float, run_state=None) -> Iterator[Optional[dict[str, object]]]:
+    """
+    Wait for up to `timeout` seconds for filesystem events under `fastq_by_run_dir`, then check each
+    run directory that an event was reported for. This lets a run be analyzed within seconds of its
+    `symlinks_complete.json` file being created, rather than at the next scan.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param watcher: Watcher for the `fastq_by_run_dir`.
+    :type watcher: auto_hcv.watch.RunDirWatcher
+    :param timeout: Maximum time to wait for events, in seconds.
+    :type timeout: float
+    :param run_state: Run state store.
+    :type run_state: Optional[auto_hcv.state.RunStateStore]
+    :return: A run directory to analyze, or None
+    :rtype: Iterator[Optional[dict[str, object]]]
+    """
+    for run_id in watcher.wait(timeout):
+        known_run = None
+        if run_state is not None:
+            known_run = run_state.get_run(run_id)
+        subdir = pathlib.Path(config['fastq_by_run_dir'], run_id)
+        yield check_fastq_dir(config, subdir, run_state=run_state, known_run=known_run)
+
+
 def check_analysis_dependencies_complete(pipeline: dict[str, object], analysis: dict[str, object], analysis_run_output_dir: str):
     """
     Check that all of the entries in the pipeline's `dependencies` config have completed. If so, return True. Return False otherwise.
@@ -91,9 +356,7 @@ def check_analysis_dependencies_complete(pipeline: dict[str, object], analysis:
     dependencies_complete = []
     dependency_infos = []
     for dependency in dependencies:
-        dependency_pipeline_short_name = dependency['pipeline_name'].split('/')[1]
-        dependency_pipeline_minor_version = ''.join(dependency['pipeline_version'].rsplit('.', 1)[0])
-        dependency_analysis_output_dir_name = '-'.join([dependency_pipeline_short_name, dependency_pipeline_minor_version, 'output'])
+        dependency_analysis_output_dir_name = get_analysis_output_dir_name(dependency)
         dependency_analysis_complete_path = os.path.join(analysis_run_output_dir, dependency_analysis_output_dir_name, 'analysis_complete.json')
         dependency_analysis_complete = os.path.exists(dependency_analysis_complete_path)
         dependency_info = {
@@ -111,114 +374,448 @@ def check_analysis_dependencies_complete(pipeline: dict[str, object], analysis:
     return all_dependencies_complete
 
 
-def analyze_run(config: dict[str, object], run: dict[str, object]):
+def get_analysis_output_dir_name(pipeline: dict[str, object]) -> str:
     """
-    Initiate an analysis on one directory of fastq files. We assume that the directory of fastq files is named using
-    a sequencing run ID.
+    Get the name of the directory (under the run's analysis output dir) that a pipeline writes its outputs to.
+    For example: `hcv-nf-v0.1-output`.
 
-    Runs the pipeline as defined in the config, with parameters configured for the run to be analyzed. Skips any
-    analyses that have already been initiated (whether completed or not).
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: Analysis output directory name.
+    :rtype: str
+    """
+    pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
+    pipeline_minor_version = ''.join(pipeline['pipeline_version'].rsplit('.', 1)[0])
+    analysis_output_dir_name = '-'.join([pipeline_short_name, pipeline_minor_version, 'output'])
 
-    Some pipelines may specify that they depend on the outputs of another through their 'dependencies' config.
-    For those pipelines, we confirm that all of the upstream analyses that we depend on are complete, or the analysis will be skipped.
+    return analysis_output_dir_name
 
-    :param config:
+
+def get_retry_policy(config: dict[str, object], pipeline: dict[str, object]) -> tuple[int, float]:
+    """
+    Get the retry policy for analyses by a pipeline. `max_analysis_attempts` and `analysis_retry_backoff_seconds`
+    can be set in the pipeline's config, or in the application config to apply to all pipelines.
+
+    :param config: Application config.
     :type config: dict[str, object]
-    :param analysis:
-    :type analysis: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: (max_attempts, backoff_seconds). The delay before each retry is `backoff_seconds`, doubled for each previous failure.
+    :rtype: tuple[int, float]
+    """
+    max_attempts = pipeline.get('max_analysis_attempts', config.get('max_analysis_attempts', DEFAULT_MAX_ANALYSIS_ATTEMPTS))
+    backoff_seconds = pipeline.get('analysis_retry_backoff_seconds', config.get('analysis_retry_backoff_seconds', DEFAULT_ANALYSIS_RETRY_BACKOFF_SECONDS))
+
+    return (max(1, int(max_attempts)), float(backoff_seconds))
+
+
+def retries_enabled(config: dict[str, object]) -> bool:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Whether or not failed analyses by any of the configured pipelines may be retried.
+    :rtype: bool
+    """
+    return any(get_retry_policy(config, pipeline)[0] > 1 for pipeline in config.get('pipelines', []))
+
+
+def load_analysis_attempts(analysis_pipeline_output_dir: str) -> list[dict[str, object]]:
+    """
+    :param analysis_pipeline_output_dir: Analysis output dir.
+    :type analysis_pipeline_output_dir: str
+    :return: Attempt history for the analysis, oldest first. Empty if there is no history.
+    :rtype: list[dict[str, object]]
+    """
+    try:
+        with open(os.path.join(analysis_pipeline_output_dir, ANALYSIS_ATTEMPTS_FILENAME), 'r') as f:
+            return json.load(f).get('attempts', [])
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        return []
+
+
+def write_analysis_attempts(analysis_pipeline_output_dir: str, attempts: list[dict[str, object]]):
+    """
+    :param analysis_pipeline_output_dir: Analysis output dir.
+    :type analysis_pipeline_output_dir: str
+    :param attempts: Attempt history for the analysis, oldest first.
+    :type attempts: list[dict[str, object]]
     :return: None
     :rtype: NoneType
     """
+    attempts_path = os.path.join(analysis_pipeline_output_dir, ANALYSIS_ATTEMPTS_FILENAME)
+    with open(attempts_path + '.tmp', 'w') as f:
+        json.dump({"attempts": attempts}, f, indent=2)
+    os.replace(attempts_path + '.tmp', attempts_path)
+
+
+def is_analysis_retry_due(config: dict[str, object], pipeline: dict[str, object], attempts: list[dict[str, object]]) -> bool:
+    """
+    Decide whether a failed analysis should be retried now. An analysis is retried if its last attempt
+    failed, it hasn't used up its `max_analysis_attempts`, and the backoff delay since the last attempt has passed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param attempts: Attempt history for the analysis, as returned by `load_analysis_attempts`.
+    :type attempts: list[dict[str, object]]
+    :return: Whether or not the analysis should be retried.
+    :rtype: bool
+    """
+    if len(attempts) == 0:
+        return False
+    last_attempt = attempts[-1]
+    if last_attempt.get('returncode', None) in [None, 0]:
+        # Still running (possibly under a previous instance of the daemon), or succeeded.
+        return False
+    max_attempts, backoff_seconds = get_retry_policy(config, pipeline)
+    if len(attempts) >= max_attempts:
+        return False
+    retry_delay_seconds = backoff_seconds * 2 ** (len(attempts) - 1)
+    last_attempt_end = datetime.datetime.fromisoformat(last_attempt['timestamp_analysis_end'])
+
+    return (datetime.datetime.now() - last_attempt_end).total_seconds() >= retry_delay_seconds
+
+
+def prepare_analysis(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object]) -> Optional[dict[str, object]]:
+    """
+    Check whether a pipeline should be run on a sequencing run, and if so, determine all of the paths
+    and the command that will be used to run it.
+
+    Skips any analyses that have already been initiated (whether completed or not), and any analyses whose
+    upstream dependencies (as listed in the pipeline's 'dependencies' config) are not complete. The exception
+    is failed analyses that are due to be retried (see `is_analysis_retry_due`). Retries re-use the work dir
+    of the previous attempt, and are run with `-resume` so that tasks that completed are not run again.
+
+    If the pipeline's `num_shards` is greater than 1, the run's samples are split into that many shards
+    (see `auto_hcv.sharding.plan_shards`), and the analysis includes a plan for each shard as `shards`.
+
+    The executor that will launch the pipeline (see `auto_hcv.executor`) is included as `executor`, and the
+    nextflow profile is taken from the pipeline's `profile` (see `auto_hcv.executor.get_profile`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param run: Run to analyze, as yielded by `scan`.
+    :type run: dict[str, object]
+    :return: Analysis, or None if the analysis should be skipped.
+    :rtype: Optional[dict[str, object]]
+    """
     base_analysis_outdir = config['analysis_output_dir']
     base_analysis_work_dir = config['analysis_work_dir']
     if 'notification_email_addresses' in config:
         notification_email_addresses = config['notification_email_addresses']
     else:
         notification_email_addresses = []
-    for pipeline in config['pipelines']:
-        print('here')
-        stashed_fastq_input = None
-        stashed_fastq_input_long = None
-        pipeline_parameters = pipeline['pipeline_parameters']
-        pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
-        pipeline_minor_version = ''.join(pipeline['pipeline_version'].rsplit('.', 1)[0])
-        analysis_run_id = run['run_id']
-        analysis_run_output_dir = os.path.join(base_analysis_outdir, run['run_id'])
-
-        if pipeline['pipeline_name'] == 'BCCDC-PHL/hcv-nf':
-            # Put any logic/actions you need to perform before running this pipeline here
-            pass
-
-        analysis_output_dir_name = '-'.join([pipeline_short_name, pipeline_minor_version, 'output'])
-        analysis_pipeline_output_dir = os.path.abspath(os.path.join(analysis_run_output_dir, analysis_output_dir_name))
-        pipeline_parameters['outdir'] = analysis_pipeline_output_dir
-
-        analysis_dependencies_complete = check_analysis_dependencies_complete(pipeline, run['analysis_parameters'], analysis_run_output_dir)
-        analysis_not_already_started = not os.path.exists(analysis_pipeline_output_dir)
-        conditions_checked = {
-            'pipeline_dependencies_met': analysis_dependencies_complete,
-            'analysis_not_already_started': analysis_not_already_started,
-        }
-        conditions_met = list(conditions_checked.values())
-
-        if not all(conditions_met):
-            logging.warning(json.dumps({
-                "event_type": "analysis_skipped",
-                "pipeline_name": pipeline['pipeline_name'],
-                "pipeline_version": pipeline['pipeline_version'],
-                "pipeline_dependencies": pipeline['dependencies'],
-                "sequencing_run_id": analysis_run_id,
-                "conditions_checked": conditions_checked,
-            }))
-            if stashed_fastq_input is not None:
-                run['analysis_parameters']['fastq_input'] = stashed_fastq_input
-            continue
 
+    pipeline_parameters = dict(pipeline['pipeline_parameters'])
+    pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
+    analysis_run_id = run['run_id']
+    analysis_run_output_dir = os.path.join(base_analysis_outdir, run['run_id'])
+
+    if pipeline['pipeline_name'] == 'BCCDC-PHL/hcv-nf':
+        # Put any logic/actions you need to perform before running this pipeline here
+        pass
+
+    analysis_output_dir_name = get_analysis_output_dir_name(pipeline)
+    analysis_pipeline_output_dir = os.path.abspath(os.path.join(analysis_run_output_dir, analysis_output_dir_name))
+    pipeline_parameters['outdir'] = analysis_pipeline_output_dir
+
+    analysis_dependencies_complete = check_analysis_dependencies_complete(pipeline, run['analysis_parameters'], analysis_run_output_dir)
+    analysis_not_already_started = not os.path.exists(analysis_pipeline_output_dir)
+    previous_attempts = []
+    analysis_retry_due = False
+    if not analysis_not_already_started:
+        previous_attempts = load_analysis_attempts(analysis_pipeline_output_dir)
+        analysis_retry_due = is_analysis_retry_due(config, pipeline, previous_attempts)
+    conditions_checked = {
+        'pipeline_dependencies_met': analysis_dependencies_complete,
+        'analysis_not_already_started': analysis_not_already_started,
+        'analysis_retry_due': analysis_retry_due,
+    }
+    conditions_met = [analysis_dependencies_complete, analysis_not_already_started or analysis_retry_due]
+
+    if not all(conditions_met):
+        logging.warning(json.dumps({
+            "event_type": "analysis_skipped",
+            "pipeline_name": pipeline['pipeline_name'],
+            "pipeline_version": pipeline['pipeline_version'],
+            "pipeline_dependencies": pipeline.get('dependencies', None),
+            "sequencing_run_id": analysis_run_id,
+            "conditions_checked": conditions_checked,
+        }))
+        return None
+
+    try:
+        pipeline_executor = executor.get_executor(config, pipeline)
+    except ValueError as e:
+        logging.error(json.dumps({"event_type": "analysis_skipped", "pipeline_name": pipeline['pipeline_name'], "pipeline_version": pipeline['pipeline_version'], "sequencing_run_id": analysis_run_id, "error": str(e)}))
+        return None
+
+    resume = False
+    if analysis_retry_due and os.path.isdir(previous_attempts[-1]['analysis_work_dir']):
+        # Work dirs of failed analyses are kept, so that the retry can resume where the last attempt left off.
+        analysis_work_dir = previous_attempts[-1]['analysis_work_dir']
+        resume = True
+    else:
         analysis_timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
         analysis_work_dir = os.path.abspath(os.path.join(base_analysis_work_dir, 'work-' + analysis_run_id + '_' + pipeline_short_name + '_' + analysis_timestamp))
-        analysis_report_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_report.html'))
-        analysis_trace_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_trace.tsv'))
-        analysis_timeline_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_timeline.html'))
-        analysis_log_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_nextflow.log'))
-        pipeline_command = [
-            'nextflow',
-            '-log', analysis_log_path,
-            'run',
-            pipeline['pipeline_name'],
-            '-r', pipeline['pipeline_version'],
-            '-profile', 'conda',
-            '--cache', os.path.join(os.path.expanduser('~'), '.conda/envs'),
-            '-work-dir', analysis_work_dir,
-            '-with-report', analysis_report_path,
-            '-with-trace', analysis_trace_path,
-            '-with-timeline', analysis_timeline_path,
-            '--prefix', analysis_run_id
-        ]
-        print(pipeline_command)
-        if 'send_notification_emails' in config and config['send_notification_emails']:
-            pipeline_command += ['-with-notification', ','.join(notification_email_addresses)]
-        for flag, config_value in pipeline_parameters.items():
-            if config_value is None:
-                value = run['analysis_parameters'][flag]
-                pipeline_command += ['--' + flag, value]
-            else:
-                value = config_value
-                pipeline_command += ['--' + flag, value]
+    analysis_report_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_report.html'))
+    analysis_trace_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_trace.tsv'))
+    analysis_timeline_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_timeline.html'))
+    analysis_log_path = os.path.abspath(os.path.join(analysis_pipeline_output_dir, analysis_run_id + '_' + pipeline_short_name + '_nextflow.log'))
+    pipeline_command = [
+        'nextflow',
+        '-log', analysis_log_path,
+        'run',
+        pipeline['pipeline_name'],
+        '-r', pipeline['pipeline_version'],
+        '-profile', executor.get_profile(config, pipeline),
+        '-ansi-log', 'false',
+        '--cache', os.path.join(os.path.expanduser('~'), '.conda/envs'),
+        '-work-dir', analysis_work_dir,
+        '-with-report', analysis_report_path,
+        '-with-trace', analysis_trace_path,
+        '-with-timeline', analysis_timeline_path,
+        '--prefix', analysis_run_id
+    ]
+    if resume:
+        pipeline_command += ['-resume']
+    if 'send_notification_emails' in config and config['send_notification_emails']:
+        pipeline_command += ['-with-notification', ','.join(notification_email_addresses)]
+    for flag, config_value in pipeline_parameters.items():
+        if config_value is None:
+            value = run['analysis_parameters'][flag]
+            pipeline_command += ['--' + flag, value]
+        else:
+            value = config_value
+            pipeline_command += ['--' + flag, value]
+
+    shards = sharding.plan_shards(pipeline, run, analysis_work_dir, pipeline_command)
 
-        logging.info(json.dumps({"event_type": "analysis_started", "sequencing_run_id": analysis_run_id, "pipeline_command": " ".join(pipeline_command)}))
-        analysis_complete = {"timestamp_analysis_start": datetime.datetime.now().isoformat()}
+    analysis = {
+        "sequencing_run_id": analysis_run_id,
+        "run": run,
+        "pipeline": pipeline,
+        "pipeline_command": pipeline_command,
+        "analysis_work_dir": analysis_work_dir,
+        "analysis_pipeline_output_dir": analysis_pipeline_output_dir,
+        "analysis_trace_path": analysis_trace_path,
+        "analysis_report_paths": [analysis_report_path, analysis_trace_path, analysis_timeline_path],
+        "attempt": len(previous_attempts) + 1,
+        "resume": resume,
+        "shards": shards,
+        "executor": pipeline_executor,
+        "config_version": config.get('config_version', None),
+        "stderr_tail_lines": int(config.get('failed_analysis_stderr_lines', nextflow_output.DEFAULT_STDERR_TAIL_LINES)),
+    }
+
+    return analysis
+
+
+def start_analysis(analysis: dict[str, object]):
+    """
+    Launch the pipeline for an analysis prepared by `prepare_analysis`, without waiting for it to complete.
+
+    The attempt is added to the attempt history (`analysis_attempts.json`) in the analysis output dir, along with
+    the executor and job ID. The pipeline is launched by the analysis's executor (see `auto_hcv.executor`), which
+    for local analyses starts it in its own session so that a Ctrl-C delivered to the daemon does not
+    interrupt analyses that are already in progress. Output from nextflow goes, line by line, to
+    `nextflow_stdout.log` and `nextflow_stderr.log` in the analysis output dir (see `auto_hcv.nextflow_output`),
+    and the capture is stored in the analysis as `output_capture`. The logs of earlier attempts are kept, like the
+    nextflow reports.
+
+    If the analysis is split into shards (see `auto_hcv.sharding`), the pipeline is started once for each shard,
+    and the shards run concurrently.
+
+    :param analysis: Analysis, as returned by `prepare_analysis`.
+    :type analysis: dict[str, object]
+    :return: The running pipeline job (or jobs, for a sharded analysis), with `poll`, `wait` and `cancel` methods.
+    :rtype: auto_hcv.executor.LocalJob | auto_hcv.executor.SlurmJob | auto_hcv.executor.StubJob | auto_hcv.sharding.ShardedProcess
+    :raises OSError: If the pipeline couldn't be launched.
+    """
+    analysis_work_dir = analysis['analysis_work_dir']
+    pipeline_command = analysis['pipeline_command']
+    logging.info(json.dumps({"event_type": "analysis_started", "sequencing_run_id": analysis['sequencing_run_id'], "pipeline_command": " ".join(pipeline_command)}))
+    analysis['timestamp_analysis_start'] = datetime.datetime.now().isoformat()
+    analysis_pipeline_output_dir = analysis['analysis_pipeline_output_dir']
+    attempt = analysis.get('attempt', 1)
+    os.makedirs(analysis_work_dir, exist_ok=analysis.get('resume', False))
+    os.makedirs(analysis_pipeline_output_dir, exist_ok=True)
+    # nextflow won't overwrite the report, trace and timeline of the previous attempt, so they are kept alongside the new ones.
+    nextflow_log_paths = [os.path.join(analysis_pipeline_output_dir, name) for name in os.listdir(analysis_pipeline_output_dir) if name.startswith(nextflow_output.LOG_FILENAME_PREFIXES) and name.endswith('.log')]
+    for report_path in analysis.get('analysis_report_paths', []) + nextflow_log_paths:
+        if attempt > 1 and os.path.exists(report_path):
+            os.replace(report_path, report_path + '.attempt-' + str(attempt - 1))
+    if analysis.get('executor', None) is None:
+        analysis['executor'] = executor.LocalExecutor({})
+    attempts = load_analysis_attempts(analysis_pipeline_output_dir)[:attempt - 1]
+    attempts.append({
+        "attempt": attempt,
+        "analysis_work_dir": analysis_work_dir,
+        "resumed": analysis.get('resume', False),
+        "executor": analysis['executor'].name,
+        "config_version": analysis.get('config_version', None),
+        "timestamp_analysis_start": analysis['timestamp_analysis_start'],
+    })
+    write_analysis_attempts(analysis_pipeline_output_dir, attempts)
+    if analysis.get('shards', None) is not None:
+        for shard in analysis['shards']:
+            for report_path in analysis.get('analysis_report_paths', []):
+                shard_report_path = os.path.join(shard['output_dir'], os.path.basename(report_path))
+                if attempt > 1 and os.path.exists(shard_report_path):
+                    os.replace(shard_report_path, shard_report_path + '.attempt-' + str(attempt - 1))
+        job = sharding.start_shards(analysis)
+    else:
+        job, analysis['output_capture'] = analysis['executor'].launch(
+            pipeline_command,
+            analysis_work_dir,
+            os.path.join(analysis_pipeline_output_dir, 'nextflow_stdout.log'),
+            os.path.join(analysis_pipeline_output_dir, 'nextflow_stderr.log'),
+            trace_path=analysis.get('analysis_trace_path', None),
+            stderr_tail_lines=analysis.get('stderr_tail_lines', nextflow_output.DEFAULT_STDERR_TAIL_LINES),
+        )
+    # The job ID is recorded so that a pipeline can be found (and, for batch jobs, cancelled) if the daemon is restarted.
+    attempts[-1]['job_id'] = job.job_id
+    write_analysis_attempts(analysis_pipeline_output_dir, attempts)
+
+    return job
+
+
+def record_launch_failure(analysis: dict[str, object], error: str):
+    """
+    Record an attempt whose pipeline couldn't be launched (`start_analysis` raised `OSError`) as failed in the
+    attempt history, with `LAUNCH_FAILED_RETURNCODE`, so that it isn't taken for an attempt that is still running,
+    and can be retried (see `is_analysis_retry_due`). If the output dir was never created, there is nothing to record,
+    and the analysis is started again at the next scan.
+
+    :param analysis: Analysis, as returned by `prepare_analysis`.
+    :type analysis: dict[str, object]
+    :param error: Why the pipeline couldn't be launched.
+    :type error: str
+    :return: None
+    :rtype: NoneType
+    """
+    analysis_pipeline_output_dir = analysis['analysis_pipeline_output_dir']
+    if not os.path.isdir(analysis_pipeline_output_dir):
+        return
+    attempt = analysis.get('attempt', 1)
+    attempts = load_analysis_attempts(analysis_pipeline_output_dir)[:attempt]
+    if len(attempts) < attempt:
+        attempts.append({
+            "attempt": attempt,
+            "analysis_work_dir": analysis['analysis_work_dir'],
+            "resumed": analysis.get('resume', False),
+            "config_version": analysis.get('config_version', None),
+            "timestamp_analysis_start": analysis.get('timestamp_analysis_start', None),
+        })
+    attempts[-1]['timestamp_analysis_end'] = datetime.datetime.now().isoformat()
+    attempts[-1]['returncode'] = LAUNCH_FAILED_RETURNCODE
+    attempts[-1]['launch_error'] = error
+    try:
+        write_analysis_attempts(analysis_pipeline_output_dir, attempts)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "write_analysis_attempts_failed", "sequencing_run_id": analysis['sequencing_run_id'], "analysis_pipeline_output_dir": analysis_pipeline_output_dir, "error": str(e)}))
+
+
+def finish_analysis(config: dict[str, object], analysis: dict[str, object], returncode: int) -> bool:
+    """
+    Record the outcome of an analysis whose pipeline process has exited. On success, the
+    `analysis_complete.json` file is written to the analysis output dir. Post-analysis tasks
+    (see `auto_hcv.post_analysis`) should be run afterwards by the caller.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis: Analysis, as returned by `prepare_analysis`.
+    :type analysis: dict[str, object]
+    :param returncode: Exit code of the pipeline process.
+    :type returncode: int
+    :return: Whether or not the analysis completed successfully.
+    :rtype: bool
+    """
+    analysis_run_id = analysis['sequencing_run_id']
+    pipeline_command = analysis['pipeline_command']
+    output_capture = analysis.get('output_capture', None)
+    if output_capture is not None:
+        output_capture.join()
+        output_capture.log_progress(analysis)
+    attempts = load_analysis_attempts(analysis['analysis_pipeline_output_dir'])
+    if len(attempts) > 0:
+        attempts[-1]['timestamp_analysis_end'] = datetime.datetime.now().isoformat()
+        attempts[-1]['returncode'] = returncode
+        if output_capture is not None:
+            attempts[-1]['failed_process'] = output_capture.failed_process
+        write_analysis_attempts(analysis['analysis_pipeline_output_dir'], attempts)
+    if returncode != 0:
+        error = str(subprocess.CalledProcessError(returncode, pipeline_command))
+        analysis_failed = {"event_type": "analysis_failed", "sequencing_run_id": analysis_run_id, "pipeline_command": " ".join(pipeline_command), "error": error}
+        if output_capture is not None:
+            analysis_failed['failed_process'] = output_capture.failed_process
+            analysis_failed['stderr_tail'] = output_capture.get_stderr_tail()
+        analysis_failed['attempt'] = analysis.get('attempt', 1)
+        analysis_failed['will_retry'] = analysis.get('attempt', 1) < get_retry_policy(config, analysis['pipeline'])[0]
+        logging.error(json.dumps(analysis_failed))
+        return False
+
+    if analysis.get('shards', None) is not None:
         try:
-            os.makedirs(analysis_work_dir)
-            # Running the pipeline is disabled by commenting out the line below. Uncomment to enable analysis.
-            #print(pipeline_command)
-            analysis_result = subprocess.run(pipeline_command, capture_output=True, check=True, cwd=analysis_work_dir)
-            analysis_complete['timestamp_analysis_complete'] = datetime.datetime.now().isoformat()
-            with open(os.path.join(analysis_pipeline_output_dir, 'analysis_complete.json'), 'w') as f:
-                json.dump(analysis_complete, f, indent=2)
-            logging.info(json.dumps({"event_type": "analysis_completed", "sequencing_run_id": analysis_run_id, "pipeline_command": " ".join(pipeline_command)}))
+            sharding.merge_shards(analysis)
+        except OSError as e:
+            logging.error(json.dumps({"event_type": "analysis_failed", "sequencing_run_id": analysis_run_id, "pipeline_command": " ".join(pipeline_command), "error": "Failed to merge shard outputs: " + str(e)}))
+            return False
+
+    analysis_complete = {
+        "timestamp_analysis_start": analysis['timestamp_analysis_start'],
+        "timestamp_analysis_complete": datetime.datetime.now().isoformat(),
+        "attempts": analysis.get('attempt', 1),
+        "config_version": analysis.get('config_version', None),
+        "config_sha256": config.get('config_sha256', None),
+    }
+    if analysis.get('reuse_key', None) is not None:
+        analysis_complete['input_fingerprint'] = analysis['input_fingerprint']
+        analysis_complete['reuse_key'] = analysis['reuse_key']
+    if analysis.get('reused_analysis', None) is not None:
+        analysis_complete['reused_from'] = {
+            "sequencing_run_id": analysis['reused_analysis']['run_id'],
+            "analysis_pipeline_output_dir": analysis['reused_analysis']['analysis_pipeline_output_dir'],
+            "mode": analysis['executor'].mode,
+        }
+    if len(analysis['run'].get('excluded_samples', [])) > 0:
+        analysis_complete['excluded_samples'] = analysis['run']['excluded_samples']
+    with open(os.path.join(analysis['analysis_pipeline_output_dir'], 'analysis_complete.json'), 'w') as f:
+        json.dump(analysis_complete, f, indent=2)
+    logging.info(json.dumps({"event_type": "analysis_completed", "sequencing_run_id": analysis_run_id, "pipeline_command": " ".join(pipeline_command)}))
+
+    return True
+
+
+def analyze_run(config: dict[str, object], run: dict[str, object]):
+    """
+    Initiate an analysis on one directory of fastq files, and wait for it to complete. We assume that the
+    directory of fastq files is named using a sequencing run ID.
+
+    Runs the pipeline as defined in the config, with parameters configured for the run to be analyzed. Skips any
+    analyses that have already been initiated (whether completed or not).
 
+    Some pipelines may specify that they depend on the outputs of another through their 'dependencies' config.
+    For those pipelines, we confirm that all of the upstream analyses that we depend on are complete, or the analysis will be skipped.
+
+    To run several analyses at once, use an `auto_hcv.scheduler.AnalysisScheduler` instead.
+
+    :param config:
+    :type config: dict[str, object]
+    :param analysis:
+    :type analysis: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    for pipeline in config['pipelines']:
+        analysis = prepare_analysis(config, pipeline, run)
+        if analysis is None:
+            continue
+        job = start_analysis(analysis)
+        returncode = job.wait()
+        if finish_analysis(config, analysis, returncode):
             # Put any logic/actions you need to perform after running this pipeline here.
-            post_analysis.post_analysis(config, pipeline, run)
-            
-        except subprocess.CalledProcessError as e:
-            logging.error(json.dumps({"event_type": "analysis_failed", "sequencing_run_id": analysis_run_id, "pipeline_command": " ".join(pipeline_command), "error": str(e)}))
+            post_analysis.post_analysis(config, pipeline, run, analysis_work_dir=analysis['analysis_work_dir'])
@@ -0,0 +1,311 @@
+import asyncio
+import datetime
+import json
+import logging
+import signal
+import time
+
+from typing import Optional
+
+import auto_hcv.admission
+import auto_hcv.cleanup
+import auto_hcv.core as core
+import auto_hcv.metrics
+import auto_hcv.state
+import auto_hcv.watch
+
+from auto_hcv.scheduler import AnalysisScheduler
+
+DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
+DEFAULT_POLL_INTERVAL_SECONDS = 10.0
+DEFAULT_POST_ANALYSIS_WORKERS = 1
+# Runs found by discovery, waiting to be submitted to the scheduler. When this is full, the scan waits.
+DISCOVERED_RUNS_QUEUE_SIZE = 100
+# Analyses that completed, waiting for their post-analysis tasks. When this is full, analyses that have
+# finished are left in their slots until there is room, rather than holding up the event loop.
+POST_ANALYSIS_QUEUE_SIZE = 10
+# Put on the discovered runs queue at the end of each scan
+SCAN_COMPLETE = object()
+
+
+def get_interval_seconds(config: dict[str, object], key: str, default: float) -> float:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param key: Config key of the interval.
+    :type key: str
+    :param default: Interval to use if it isn't configured (or isn't a number).
+    :type default: float
+    :return: Interval, in seconds.
+    :rtype: float
+    """
+    if key not in config:
+        return default
+    try:
+        return float(str(config[key]))
+    except ValueError as e:
+        return default
+
+
+class Daemon:
+    """
+    Runs the daemon as a set of cooperative tasks on an asyncio event loop, connected by bounded queues:
+
+    - discovery: scans `fastq_by_run_dir` every `scan_interval_seconds` (and, in watch mode, waits for filesystem
+      events in between), and puts the runs it finds on the discovered runs queue.
+    - scheduling: submits discovered runs to the `AnalysisScheduler`, and every `poll_interval_seconds` reaps
+      finished analyses and launches queued ones (through their executors; see `auto_hcv.executor`).
+    - post-analysis: `post_analysis_workers` workers (default: 1) run the post-analysis tasks (trace ingestion,
+      transfers and reports) of completed analyses.
+
+    Work dirs are deleted by the `auto_hcv.cleanup.WorkDirCleaner`'s own workers. Blocking work (scanning,
+    waiting for filesystem events, post-analysis tasks) runs in threads, so a slow copy or delete on a network
+    filesystem doesn't hold up launching new analyses. The scheduler's `submit_run` and `poll` also run in a
+    thread, one call at a time, since they fingerprint inputs, check free disk space, launch pipelines (including
+    `sbatch`), check on batch jobs (`squeue`) and merge shard outputs, any of which can block on a slow filesystem
+    or batch system. The event loop stays free to accept discovered runs, signals and post-analysis work meanwhile.
+
+    On SIGINT (`Ctrl-C`), discovery stops and no new analyses are started. The daemon returns once the running
+    analyses have finished and their post-analysis tasks are done. On SIGHUP, the config is reloaded.
+    """
+    def __init__(self, config_manager, scheduler: Optional[AnalysisScheduler]=None):
+        self.config_manager = config_manager
+        self.scheduler = scheduler if scheduler is not None else AnalysisScheduler()
+        self.run_state = None
+        self.watcher = None
+        self.metrics_server = None
+        self.quit_when_safe = False
+        self.scanning = False
+        self.num_post_analysis_running = 0
+        self.next_scan_time = time.monotonic()
+        # Created by `run`, on the event loop
+        self.quit_event = None
+        self.discovered_runs = None
+        self.finished_analyses = None
+        self.discovery_task = None
+
+
+    @property
+    def config(self) -> dict[str, object]:
+        return self.config_manager.config
+
+
+    def request_quit(self):
+        """
+        Stop discovering runs and starting analyses, and return from `run` once it is safe to.
+        """
+        logging.info(json.dumps({"event_type": "quit_when_safe_enabled", "num_analyses_running": len(self.scheduler.running)}))
+        self.quit_when_safe = True
+        self.quit_event.set()
+
+
+    def setup(self, config: dict[str, object]):
+        """
+        Create the run state store, admission controller, work dir cleaner, metrics server and watcher,
+        if they are configured and haven't been created yet.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        if self.run_state is None and 'run_state_db' in config:
+            self.run_state = auto_hcv.state.RunStateStore(config['run_state_db'])
+            self.scheduler.run_state = self.run_state
+
+        if self.scheduler.admission_controller is None and 'analysis_work_dir' in config:
+            self.scheduler.admission_controller = auto_hcv.admission.create_admission_controller(config)
+
+        if self.scheduler.cleaner is None and 'analysis_work_dir' in config:
+            self.scheduler.cleaner = auto_hcv.cleanup.create_cleaner(config)
+
+        if self.scheduler.cleaner is not None and self.scheduler.admission_controller is not None:
+            # Work dir sizes are learned as they are deleted, to estimate the disk needed by later analyses.
+            self.scheduler.cleaner.on_deleted = self.scheduler.admission_controller.record_work_dir_usage
+
+        if self.metrics_server is None and config.get('metrics_port', None) is not None:
+            self.metrics_server = auto_hcv.metrics.start_metrics_server(config)
+
+        if self.watcher is None:
+            # The watcher is started before the scan, so that runs that become ready during the scan aren't missed.
+            self.watcher = auto_hcv.watch.create_watcher(config)
+
+
+    def put_finished_analysis(self, loop: asyncio.AbstractEventLoop, analysis: dict[str, object]):
+        """
+        Put a completed analysis on the post-analysis queue from a worker thread. Used as the scheduler's
+        `post_analysis_handler`. The analysis is put on the queue before the scheduler's `poll` returns to the
+        event loop, since the call is scheduled ahead of the thread's result.
+        """
+        loop.call_soon_threadsafe(self.finished_analyses.put_nowait, analysis)
+
+
+    def put_discovered_run(self, loop: asyncio.AbstractEventLoop, run: dict[str, object]):
+        """
+        Put a run on the discovered runs queue from a worker thread, waiting while the queue is full.
+        """
+        asyncio.run_coroutine_threadsafe(self.discovered_runs.put(run), loop).result()
+
+
+    def scan_into_queue(self, loop: asyncio.AbstractEventLoop, config: dict[str, object]):
+        """
+        Scan for runs (see `auto_hcv.core.scan`), and put each run that is found on the discovered runs queue.
+        Runs in a worker thread.
+        """
+        for run in core.scan(config, run_state=self.run_state):
+            if self.quit_when_safe:
+                break
+            if run is not None:
+                self.put_discovered_run(loop, run)
+
+
+    def watch_into_queue(self, loop: asyncio.AbstractEventLoop, config: dict[str, object], timeout: float):
+        """
+        Wait for up to `timeout` seconds for runs to become ready (see `auto_hcv.core.watch`), and put them on
+        the discovered runs queue. Runs in a worker thread.
+        """
+        for run in core.watch(config, self.watcher, timeout, run_state=self.run_state):
+            if run is not None:
+                self.put_discovered_run(loop, run)
+
+
+    async def sleep_unless_quitting(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.quit_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError as e:
+            pass
+
+
+    async def discover(self):
+        """
+        The discovery task. Scans for runs every `scan_interval_seconds`, and in watch mode, checks the runs
+        that filesystem events are reported for in between.
+        """
+        loop = asyncio.get_running_loop()
+        while not self.quit_when_safe:
+            config = self.config
+            if time.monotonic() >= self.next_scan_time:
+                self.setup(config)
+                self.scanning = True
+                scan_start_timestamp = datetime.datetime.now()
+                await asyncio.to_thread(self.scan_into_queue, loop, config)
+                await self.discovered_runs.put(SCAN_COMPLETE)
+                scan_duration_seconds = (datetime.datetime.now() - scan_start_timestamp).total_seconds()
+                logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
+                auto_hcv.metrics.SCAN_DURATION_SECONDS.observe(scan_duration_seconds)
+                self.next_scan_time = time.monotonic() + get_interval_seconds(config, 'scan_interval_seconds', DEFAULT_SCAN_INTERVAL_SECONDS)
+                continue
+
+            poll_interval = get_interval_seconds(config, 'poll_interval_seconds', DEFAULT_POLL_INTERVAL_SECONDS)
+            timeout = max(0.0, min(poll_interval, self.next_scan_time - time.monotonic()))
+            if self.watcher is not None:
+                # In watch mode, we wait for filesystem events instead of sleeping, and the
+                # (less frequent) full scan only acts as a safety net for missed events.
+                await asyncio.to_thread(self.watch_into_queue, loop, config, timeout)
+                if self.watcher.full_scan_needed:
+                    self.watcher.full_scan_needed = False
+                    self.next_scan_time = time.monotonic()
+            else:
+                await self.sleep_unless_quitting(timeout)
+
+
+    def is_safe_to_quit(self) -> bool:
+        """
+        :return: Whether discovery has stopped, no analyses are running, and no post-analysis tasks are left to do.
+        :rtype: bool
+        """
+        discovery_stopped = self.discovery_task is None or self.discovery_task.done()
+        post_analysis_done = self.finished_analyses.qsize() == 0 and self.num_post_analysis_running == 0
+
+        return discovery_stopped and len(self.scheduler.running) == 0 and post_analysis_done
+
+
+    async def schedule(self):
+        """
+        The scheduling task. Submits discovered runs to the scheduler, and polls the scheduler to reap finished
+        analyses and launch queued ones, in a worker thread. Returns once it is safe to quit, after a quit has been requested.
+        """
+        while True:
+            # If a reload fails, we continue on with the last valid config that was loaded.
+            self.config_manager.reload_if_changed()
+            config = self.config
+            poll_interval = get_interval_seconds(config, 'poll_interval_seconds', DEFAULT_POLL_INTERVAL_SECONDS)
+            discovered = []
+            try:
+                discovered.append(await asyncio.wait_for(self.discovered_runs.get(), timeout=poll_interval))
+                while not self.discovered_runs.empty():
+                    discovered.append(self.discovered_runs.get_nowait())
+            except asyncio.TimeoutError as e:
+                pass
+            for run in discovered:
+                if run is SCAN_COMPLETE:
+                    self.scanning = False
+                else:
+                    await asyncio.to_thread(self.scheduler.submit_run, config, run)
+
+            # New analyses are started once the scan is complete, so that every run that
+            # was found can be considered when deciding which analyses to start first.
+            launch_new_analyses = not self.quit_when_safe and not self.scanning
+            # In-flight analyses are polled between scans, so that finished analyses
+            # are recorded (and free slots are filled) without waiting for the next scan.
+            post_analysis_capacity = self.finished_analyses.maxsize - self.finished_analyses.qsize()
+            await asyncio.to_thread(self.scheduler.poll, config, launch_new_analyses=launch_new_analyses, max_finished=post_analysis_capacity)
+
+            if self.quit_when_safe and self.is_safe_to_quit():
+                return
+
+
+    async def post_analysis_worker(self):
+        """
+        A post-analysis task. Runs the post-analysis tasks of completed analyses, one at a time, in a worker thread.
+        If the post-analysis tasks of an analysis fail, the error is logged and the analysis is recorded as failed
+        in the run state store, and the worker moves on to the next analysis.
+        """
+        while True:
+            analysis = await self.finished_analyses.get()
+            self.num_post_analysis_running += 1
+            try:
+                await asyncio.to_thread(self.scheduler.run_post_analysis, analysis)
+            except Exception as e:
+                logging.error(json.dumps({"event_type": "analysis_post_analysis_failed", "sequencing_run_id": analysis['sequencing_run_id'], "pipeline_name": analysis['pipeline']['pipeline_name'], "pipeline_version": analysis['pipeline']['pipeline_version'], "error": repr(e)}))
+                self.scheduler.record_analysis_status(analysis, auto_hcv.state.RUN_STATUS_FAILED)
+            finally:
+                self.num_post_analysis_running -= 1
+                self.finished_analyses.task_done()
+
+
+    async def run(self):
+        """
+        Run the daemon until a quit is requested and it is safe to quit. If any of the tasks fails,
+        the others are cancelled and the exception is raised.
+        """
+        loop = asyncio.get_running_loop()
+        self.quit_event = asyncio.Event()
+        self.discovered_runs = asyncio.Queue(maxsize=DISCOVERED_RUNS_QUEUE_SIZE)
+        self.finished_analyses = asyncio.Queue(maxsize=POST_ANALYSIS_QUEUE_SIZE)
+        self.scheduler.post_analysis_handler = lambda analysis: self.put_finished_analysis(loop, analysis)
+        loop.add_signal_handler(signal.SIGINT, self.request_quit)
+        # The config is reloaded whenever the file changes, or on SIGHUP.
+        loop.add_signal_handler(signal.SIGHUP, self.config_manager.request_reload)
+
+        config = self.config
+        self.setup(config)
+        num_post_analysis_workers = int(config.get('post_analysis_workers', DEFAULT_POST_ANALYSIS_WORKERS))
+        self.discovery_task = asyncio.create_task(self.discover(), name='discovery')
+        schedule_task = asyncio.create_task(self.schedule(), name='scheduling')
+        tasks = [self.discovery_task, schedule_task]
+        tasks += [asyncio.create_task(self.post_analysis_worker(), name='post-analysis-' + str(i)) for i in range(num_post_analysis_workers)]
+        try:
+            while not schedule_task.done():
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+                tasks = list(pending)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if self.scheduler.cleaner is not None and len(self.scheduler.cleaner.queue) > 0:
+            # Work dirs that haven't been deleted yet stay in the saved queue, and are deleted after a restart.
+            logging.info(json.dumps({"event_type": "cleanup_queue_saved", "num_work_dirs_queued": len(self.scheduler.cleaner.queue)}))
@@ -0,0 +1,379 @@
+import json
+import logging
+import os
+import shlex
+import signal
+import stat
+import subprocess
+import time
+
+from typing import Optional
+
+import auto_hcv.nextflow_output as nextflow_output
+
+DEFAULT_EXECUTOR = 'local'
+DEFAULT_PROFILE = 'conda'
+DEFAULT_SLURM_POLL_INTERVAL_SECONDS = 30.0
+# Times in a row that a SLURM job must be missing from the queue, without having written its exit code,
+# before it is treated as lost. Exit code files may take a moment to appear on a shared filesystem.
+SLURM_MISSING_JOB_CHECKS = 2
+SLURM_JOB_SCRIPT_FILENAME = 'auto_hcv_job.sh'
+SLURM_EXIT_CODE_FILENAME = 'auto_hcv_job.exitcode'
+# Return code used when a job ended without reporting one (cancelled, timed out, or lost).
+UNKNOWN_RETURNCODE = 1
+
+
+class LocalJob:
+    """
+    A pipeline process running on this host.
+    """
+    def __init__(self, process: subprocess.Popen):
+        self.process = process
+        self.job_id = str(process.pid)
+
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.returncode
+
+
+    def poll(self) -> Optional[int]:
+        return self.process.poll()
+
+
+    def wait(self) -> int:
+        return self.process.wait()
+
+
+    def cancel(self):
+        # The pipeline runs in its own session, so its whole process group is signalled.
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError as e:
+            pass
+
+
+class LocalExecutor:
+    """
+    Runs pipelines as child processes of the daemon, and reads their output streams directly.
+    """
+    name = 'local'
+
+    def __init__(self, executor_config: dict[str, object]):
+        self.executor_config = executor_config
+
+
+    def launch(self, command: list[str], cwd: str, stdout_path: str, stderr_path: str, trace_path: Optional[str]=None, stderr_tail_lines: int=nextflow_output.DEFAULT_STDERR_TAIL_LINES):
+        """
+        Start a pipeline, without waiting for it to complete.
+
+        :param command: Pipeline command.
+        :type command: list[str]
+        :param cwd: Dir to run the pipeline in.
+        :type cwd: str
+        :param stdout_path: Path to write the pipeline's stdout to.
+        :type stdout_path: str
+        :param stderr_path: Path to write the pipeline's stderr to.
+        :type stderr_path: str
+        :param trace_path: Path to the nextflow trace file, to track progress.
+        :type trace_path: Optional[str]
+        :param stderr_tail_lines: Number of lines of stderr to keep.
+        :type stderr_tail_lines: int
+        :return: The running job, and the capture of its output.
+        :rtype: tuple[LocalJob, auto_hcv.nextflow_output.NextflowOutputCapture]
+        """
+        # Started in its own session so that a Ctrl-C delivered to the daemon does not interrupt the pipeline.
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, cwd=cwd, start_new_session=True)
+        output_capture = nextflow_output.NextflowOutputCapture(process, stdout_path, stderr_path, trace_path=trace_path, stderr_tail_lines=stderr_tail_lines)
+
+        return LocalJob(process), output_capture
+
+
+class SlurmJob:
+    """
+    A pipeline submitted to SLURM as a batch job.
+
+    The job script writes the pipeline's exit code to a file in its dir when it finishes, which is how completion
+    is detected. The queue is also checked (with `squeue`, at most once every `poll_interval_seconds`) so that jobs
+    which end without writing an exit code (because they were cancelled, timed out or lost with their node) are
+    noticed too.
+    """
+    def __init__(self, job_id: str, exit_code_path: str, poll_interval_seconds: float):
+        self.job_id = job_id
+        self.exit_code_path = exit_code_path
+        self.poll_interval_seconds = poll_interval_seconds
+        self.returncode = None
+        self.last_queue_check = time.monotonic()
+        self.times_missing = 0
+
+
+    def read_exit_code(self) -> Optional[int]:
+        try:
+            with open(self.exit_code_path, 'r') as f:
+                return int(f.read().strip())
+        except FileNotFoundError as e:
+            return None
+        except (OSError, ValueError) as e:
+            return UNKNOWN_RETURNCODE
+
+
+    def is_queued(self) -> Optional[bool]:
+        """
+        :return: Whether or not the job is still pending or running, or None if the queue couldn't be checked.
+        :rtype: Optional[bool]
+        """
+        try:
+            result = subprocess.run(['squeue', '--noheader', '--jobs', self.job_id, '--format', '%T'], capture_output=True, text=True, timeout=60)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.warning(json.dumps({"event_type": "slurm_queue_check_failed", "slurm_job_id": self.job_id, "error": str(e)}))
+            return None
+        if result.returncode != 0:
+            # squeue exits non-zero for job IDs that have left the queue.
+            if 'Invalid job id' in result.stderr:
+                return False
+            logging.warning(json.dumps({"event_type": "slurm_queue_check_failed", "slurm_job_id": self.job_id, "error": result.stderr.strip()}))
+            return None
+
+        return result.stdout.strip() != ''
+
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is not None:
+            return self.returncode
+        self.returncode = self.read_exit_code()
+        if self.returncode is not None:
+            return self.returncode
+        if time.monotonic() - self.last_queue_check < self.poll_interval_seconds:
+            return None
+        self.last_queue_check = time.monotonic()
+        if self.is_queued() is False:
+            self.times_missing += 1
+            if self.times_missing >= SLURM_MISSING_JOB_CHECKS:
+                logging.error(json.dumps({"event_type": "slurm_job_lost", "slurm_job_id": self.job_id}))
+                self.returncode = UNKNOWN_RETURNCODE
+        else:
+            self.times_missing = 0
+
+        return self.returncode
+
+
+    def wait(self) -> int:
+        while self.poll() is None:
+            time.sleep(min(self.poll_interval_seconds, 5.0))
+
+        return self.returncode
+
+
+    def cancel(self):
+        try:
+            subprocess.run(['scancel', self.job_id], capture_output=True, timeout=60)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.error(json.dumps({"event_type": "slurm_cancel_failed", "slurm_job_id": self.job_id, "error": str(e)}))
+
+
+class SlurmExecutor:
+    """
+    Submits pipelines to SLURM with `sbatch`, so that the nextflow head job runs on the cluster rather than on
+    the host running the daemon. The job's stdout and stderr are written straight to the log files, which are
+    followed to track progress (see `auto_hcv.nextflow_output.NextflowLogCapture`). Work dirs must be on a
+    filesystem that is shared with the cluster nodes.
+
+    Options (from the executor config): `partition`, `account`, `time`, `cpus`, `memory`, `sbatch_args`
+    (a list of extra arguments for `sbatch`) and `poll_interval_seconds`.
+    """
+    name = 'slurm'
+
+    def __init__(self, executor_config: dict[str, object]):
+        self.executor_config = executor_config
+        self.poll_interval_seconds = float(executor_config.get('poll_interval_seconds', DEFAULT_SLURM_POLL_INTERVAL_SECONDS))
+
+
+    def get_sbatch_command(self, job_script_path: str, cwd: str, stdout_path: str, stderr_path: str) -> list[str]:
+        sbatch_command = [
+            'sbatch',
+            '--parsable',
+            '--job-name', 'auto-hcv-' + os.path.basename(os.path.normpath(cwd)),
+            '--chdir', cwd,
+            '--output', stdout_path,
+            '--error', stderr_path,
+        ]
+        sbatch_options = [('partition', '--partition'), ('account', '--account'), ('time', '--time'), ('cpus', '--cpus-per-task'), ('memory', '--mem')]
+        for key, flag in sbatch_options:
+            if self.executor_config.get(key, None) is not None:
+                sbatch_command += [flag, str(self.executor_config[key])]
+        sbatch_command += [str(arg) for arg in self.executor_config.get('sbatch_args', [])]
+        sbatch_command.append(job_script_path)
+
+        return sbatch_command
+
+
+    def launch(self, command: list[str], cwd: str, stdout_path: str, stderr_path: str, trace_path: Optional[str]=None, stderr_tail_lines: int=nextflow_output.DEFAULT_STDERR_TAIL_LINES):
+        """
+        Submit a pipeline as a batch job. See `LocalExecutor.launch`.
+
+        :raises OSError: If the job couldn't be submitted.
+        :rtype: tuple[SlurmJob, auto_hcv.nextflow_output.NextflowLogCapture]
+        """
+        job_script_path = os.path.join(cwd, SLURM_JOB_SCRIPT_FILENAME)
+        exit_code_path = os.path.join(cwd, SLURM_EXIT_CODE_FILENAME)
+        # A retry reuses the work dir, so the exit code of the previous attempt is removed.
+        if os.path.exists(exit_code_path):
+            os.remove(exit_code_path)
+        with open(job_script_path, 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write(shlex.join(command) + '\n')
+            f.write('echo $? > ' + shlex.quote(exit_code_path + '.tmp') + ' && mv ' + shlex.quote(exit_code_path + '.tmp') + ' ' + shlex.quote(exit_code_path) + '\n')
+        os.chmod(job_script_path, os.stat(job_script_path).st_mode | stat.S_IXUSR)
+        sbatch_command = self.get_sbatch_command(job_script_path, cwd, stdout_path, stderr_path)
+        try:
+            result = subprocess.run(sbatch_command, capture_output=True, text=True, timeout=120)
+        except subprocess.TimeoutExpired as e:
+            raise OSError('sbatch timed out: ' + shlex.join(sbatch_command))
+        if result.returncode != 0:
+            raise OSError('sbatch failed (' + str(result.returncode) + '): ' + result.stderr.strip())
+        # With --parsable, sbatch prints "<job_id>" or "<job_id>;<cluster>"
+        job_id = result.stdout.strip().split(';')[0]
+        logging.info(json.dumps({"event_type": "slurm_job_submitted", "slurm_job_id": job_id, "job_script": job_script_path}))
+        job = SlurmJob(job_id, exit_code_path, self.poll_interval_seconds)
+        output_capture = nextflow_output.NextflowLogCapture(job, stdout_path, stderr_path, trace_path=trace_path, stderr_tail_lines=stderr_tail_lines)
+
+        return job, output_capture
+
+
+class StubJob:
+    """
+    A pretend pipeline run, which finishes after a fixed time with a fixed return code.
+    """
+    def __init__(self, job_id: str, duration_seconds: float, returncode: int, on_complete):
+        self.job_id = job_id
+        self.end_time = time.monotonic() + duration_seconds
+        self.stub_returncode = returncode
+        self.on_complete = on_complete
+        self.returncode = None
+
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None and time.monotonic() >= self.end_time:
+            self.on_complete(self.stub_returncode)
+            self.returncode = self.stub_returncode
+
+        return self.returncode
+
+
+    def wait(self) -> int:
+        while self.poll() is None:
+            time.sleep(max(0.0, min(1.0, self.end_time - time.monotonic())))
+
+        return self.returncode
+
+
+    def cancel(self):
+        if self.returncode is None:
+            self.on_complete(-signal.SIGTERM)
+            self.returncode = -signal.SIGTERM
+
+
+class StubExecutor:
+    """
+    Doesn't run pipelines at all. Each job creates the pipeline's `--outdir` and a one-task trace file, and
+    finishes after `duration_seconds` (default: 0) with `returncode` (default: 0). For testing the daemon
+    without nextflow or a cluster.
+    """
+    name = 'stub'
+    num_jobs = 0
+
+    def __init__(self, executor_config: dict[str, object]):
+        self.executor_config = executor_config
+
+
+    def launch(self, command: list[str], cwd: str, stdout_path: str, stderr_path: str, trace_path: Optional[str]=None, stderr_tail_lines: int=nextflow_output.DEFAULT_STDERR_TAIL_LINES):
+        """
+        Start a pretend pipeline run. See `LocalExecutor.launch`.
+
+        :rtype: tuple[StubJob, auto_hcv.nextflow_output.NextflowLogCapture]
+        """
+        StubExecutor.num_jobs += 1
+        job_id = 'stub-' + str(StubExecutor.num_jobs)
+        outdir = command[command.index('--outdir') + 1] if '--outdir' in command else None
+
+        def on_complete(returncode: int):
+            if outdir is not None:
+                os.makedirs(outdir, exist_ok=True)
+            status = 'COMPLETED' if returncode == 0 else 'FAILED'
+            if trace_path is not None:
+                with open(trace_path, 'w') as f:
+                    f.write('task_id\thash\tname\tstatus\texit\n1\tab/cdef12\tSTUB (1)\t' + status + '\t' + str(returncode) + '\n')
+            with open(stdout_path, 'a') as f:
+                f.write('[ab/cdef12] Submitted process > STUB (1)\n')
+            if returncode != 0:
+                with open(stderr_path, 'a') as f:
+                    f.write("ERROR ~ Error executing process > 'STUB (1)'\n")
+
+        for log_path in [stdout_path, stderr_path]:
+            open(log_path, 'w').close()
+        job = StubJob(job_id, float(self.executor_config.get('duration_seconds', 0.0)), int(self.executor_config.get('returncode', 0)), on_complete)
+        output_capture = nextflow_output.NextflowLogCapture(job, stdout_path, stderr_path, trace_path=trace_path, stderr_tail_lines=stderr_tail_lines)
+
+        return job, output_capture
+
+
+EXECUTORS = {
+    'local': LocalExecutor,
+    'slurm': SlurmExecutor,
+    'stub': StubExecutor,
+}
+
+
+def get_executor_config(config: dict[str, object], pipeline: dict[str, object]) -> dict[str, object]:
+    """
+    The executor config of a pipeline (its `executor`), on top of the default for all pipelines (the top-level `executor`).
+    Either may be given as just the name of the executor.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: Executor config, with at least `type`.
+    :rtype: dict[str, object]
+    """
+    executor_config = {'type': DEFAULT_EXECUTOR}
+    for value in [config.get('executor', None), pipeline.get('executor', None)]:
+        if isinstance(value, str):
+            executor_config['type'] = value
+        elif isinstance(value, dict):
+            executor_config.update(value)
+
+    return executor_config
+
+
+def get_executor(config: dict[str, object], pipeline: dict[str, object]):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: The executor to launch the pipeline with.
+    :rtype: LocalExecutor | SlurmExecutor | StubExecutor
+    :raises ValueError: If the executor type isn't known.
+    """
+    executor_config = get_executor_config(config, pipeline)
+    executor_type = executor_config['type']
+    if executor_type not in EXECUTORS:
+        raise ValueError('Unknown executor for pipeline ' + pipeline['pipeline_name'] + ': ' + str(executor_type) + ' (expected one of ' + ', '.join(EXECUTORS) + ')')
+
+    return EXECUTORS[executor_type](executor_config)
+
+
+def get_profile(config: dict[str, object], pipeline: dict[str, object]) -> str:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: The nextflow `-profile` to run the pipeline with: the pipeline's `profile`, then the executor's `profile`, then `conda`.
+    :rtype: str
+    """
+    if pipeline.get('profile', None):
+        return pipeline['profile']
+
+    return get_executor_config(config, pipeline).get('profile', None) or DEFAULT_PROFILE
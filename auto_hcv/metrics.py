@@ -0,0 +1,215 @@
+import http.server
+import json
+import logging
+import math
+import threading
+
+from typing import Optional
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets, in seconds
+SHORT_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+LONG_DURATION_BUCKETS = (60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 14400.0, 28800.0, 86400.0)
+
+
+def format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: Optional[tuple[str, str]]=None) -> str:
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in pairs]
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A metric, with a value for each combination of label values. Metrics are updated from the main loop and from
+    worker threads (transfers and work dir cleanup), so updates are made with a lock held.
+    """
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+        if len(self.label_names) == 0 and self.metric_type in ['counter', 'gauge']:
+            self.values[()] = 0.0
+
+
+    def get_label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError('Metric ' + self.name + ' has labels ' + str(list(self.label_names)) + ', got ' + str(sorted(labels)))
+
+        return tuple(str(labels[name]) for name in self.label_names)
+
+
+    def render_samples(self) -> list[str]:
+        with self.lock:
+            return [self.name + format_labels(self.label_names, label_values) + ' ' + format_value(value) for label_values, value in sorted(self.values.items())]
+
+
+    def render(self) -> str:
+        lines = [
+            '# HELP ' + self.name + ' ' + self.help_text,
+            '# TYPE ' + self.name + ' ' + self.metric_type,
+        ]
+        lines += self.render_samples()
+
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount: float=1.0, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value: float, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = float(value)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]=(), buckets: tuple[float, ...]=SHORT_DURATION_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+
+    def observe(self, value: float, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = {'bucket_counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            histogram = self.values[label_values]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    histogram['bucket_counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+
+    def render_samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for label_values, histogram in sorted(self.values.items()):
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(self.buckets, histogram['bucket_counts']):
+                    cumulative_count += bucket_count
+                    lines.append(self.name + '_bucket' + format_labels(self.label_names, label_values, ('le', format_value(upper_bound))) + ' ' + str(cumulative_count))
+                lines.append(self.name + '_sum' + format_labels(self.label_names, label_values) + ' ' + format_value(histogram['sum']))
+                lines.append(self.name + '_count' + format_labels(self.label_names, label_values) + ' ' + str(histogram['count']))
+
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+
+        return metric
+
+
+    def render(self) -> str:
+        """
+        :return: All metrics, in the Prometheus text exposition format.
+        :rtype: str
+        """
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = MetricsRegistry()
+
+SCAN_DURATION_SECONDS = REGISTRY.register(Histogram('auto_hcv_scan_duration_seconds', 'Time taken to scan fastq_by_run_dir for runs.'))
+DIRECTORIES_SEEN = REGISTRY.register(Counter('auto_hcv_directories_seen_total', 'Directories checked while scanning fastq_by_run_dir.'))
+DIRECTORIES_SKIPPED = REGISTRY.register(Counter('auto_hcv_directories_skipped_total', 'Directories skipped while scanning fastq_by_run_dir.', ('reason',)))
+PREFLIGHT_RUNS_HELD = REGISTRY.register(Counter('auto_hcv_preflight_runs_held_total', 'Times that a run was held because its fastq files failed the preflight checks.'))
+PREFLIGHT_SAMPLES_EXCLUDED = REGISTRY.register(Counter('auto_hcv_preflight_samples_excluded_total', 'Samples excluded from runs because their fastq files failed the preflight checks.'))
+ANALYSES_WAITING = REGISTRY.register(Gauge('auto_hcv_analyses_waiting', 'Analyses waiting for their upstream analyses to finish.'))
+ANALYSES_QUEUED = REGISTRY.register(Gauge('auto_hcv_analyses_queued', 'Analyses queued to be started.'))
+ANALYSES_RUNNING = REGISTRY.register(Gauge('auto_hcv_analyses_running', 'Analyses running.', ('pipeline_name', 'pipeline_version')))
+ANALYSES_HELD = REGISTRY.register(Counter('auto_hcv_analyses_held_total', 'Times that a queued analysis was held because resources were short.', ('resource',)))
+ANALYSES_STARTED = REGISTRY.register(Counter('auto_hcv_analyses_started_total', 'Analyses started.', ('pipeline_name', 'pipeline_version')))
+ANALYSES_COMPLETED = REGISTRY.register(Counter('auto_hcv_analyses_completed_total', 'Analyses that completed successfully.', ('pipeline_name', 'pipeline_version')))
+ANALYSES_FAILED = REGISTRY.register(Counter('auto_hcv_analyses_failed_total', 'Analyses that failed.', ('pipeline_name', 'pipeline_version')))
+ANALYSES_REUSED = REGISTRY.register(Counter('auto_hcv_analyses_reused_total', 'Analyses completed by reusing the outputs of an earlier analysis of the same input.', ('pipeline_name', 'pipeline_version')))
+ANALYSIS_DURATION_SECONDS = REGISTRY.register(Histogram('auto_hcv_analysis_duration_seconds', 'Wall time of analyses, from start to exit.', ('pipeline_name', 'pipeline_version'), buckets=LONG_DURATION_BUCKETS))
+REPORT_BUILD_DURATION_SECONDS = REGISTRY.register(Histogram('auto_hcv_report_build_duration_seconds', 'Time taken to build the reports for an analysis.', ('pipeline_name',)))
+TRANSFER_BYTES = REGISTRY.register(Counter('auto_hcv_transfer_bytes_total', 'Bytes copied when transferring results.', ('pipeline_name',)))
+TRANSFER_DURATION_SECONDS = REGISTRY.register(Histogram('auto_hcv_transfer_duration_seconds', 'Time taken to transfer the results of an analysis.', ('pipeline_name',)))
+TRANSFER_THROUGHPUT_BYTES_PER_SECOND = REGISTRY.register(Gauge('auto_hcv_transfer_throughput_bytes_per_second', 'Throughput of the most recent transfer of results.', ('pipeline_name',)))
+CLEANUP_DURATION_SECONDS = REGISTRY.register(Histogram('auto_hcv_cleanup_duration_seconds', 'Time taken to delete an analysis work dir.'))
+CLEANUP_BYTES_RECLAIMED = REGISTRY.register(Counter('auto_hcv_cleanup_bytes_reclaimed_total', 'Bytes reclaimed by deleting analysis work dirs.'))
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/metrics', '/']:
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the log.
+        pass
+
+
+def start_metrics_server(config: dict[str, object]) -> Optional[http.server.ThreadingHTTPServer]:
+    """
+    Serve metrics over HTTP (at `/metrics`) from a background thread, if `metrics_port` is set in the config.
+    The server listens on `metrics_host` (default: `127.0.0.1`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Running server, or None if metrics aren't enabled or the server couldn't be started.
+    :rtype: Optional[http.server.ThreadingHTTPServer]
+    """
+    if config.get('metrics_port', None) is None:
+        return None
+    host = config.get('metrics_host', None) or DEFAULT_METRICS_HOST
+    port = int(config['metrics_port'])
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "start_metrics_server_failed", "metrics_host": host, "metrics_port": port, "error": str(e)}))
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logging.info(json.dumps({"event_type": "metrics_server_started", "metrics_host": host, "metrics_port": server.server_address[1]}))
+
+    return server
@@ -0,0 +1,269 @@
+import collections
+import json
+import logging
+import os
+import re
+import threading
+
+from typing import Optional
+
+DEFAULT_STDERR_TAIL_LINES = 50
+READER_JOIN_TIMEOUT_SECONDS = 10.0
+# The stdout and stderr logs of an analysis (`nextflow_stdout.log`, or `nextflow_stdout.shard-0.log` for a shard)
+# are written to its output dir.
+LOG_FILENAME_PREFIXES = ('nextflow_stdout', 'nextflow_stderr')
+
+# Lines printed by `nextflow run -ansi-log false`, for example:
+#   [5e/0b5e8a] Submitted process > HCV_NF:fastp (sample-01)
+#   [ab/12cd34] Cached process > HCV_NF:fastp (sample-01)
+#   [5e/0b5e8a] NOTE: Process `HCV_NF:fastp (sample-01)` terminated with an error exit status (1) -- Execution is retried (1)
+#   ERROR ~ Error executing process > 'HCV_NF:fastp (sample-01)'
+NEXTFLOW_SUBMITTED_REGEX = re.compile(r'Submitted process > (?P<process>.+)$')
+NEXTFLOW_CACHED_REGEX = re.compile(r'Cached process > (?P<process>.+)$')
+NEXTFLOW_RETRIED_REGEX = re.compile(r'NOTE: Process `(?P<process>.+)` terminated .* Execution is retried')
+NEXTFLOW_IGNORED_REGEX = re.compile(r'NOTE: Process `(?P<process>.+)` terminated .* Error is ignored')
+NEXTFLOW_ERROR_REGEX = re.compile(r"Error executing process > '(?P<process>.+)'")
+
+# Task statuses in the nextflow trace file, counted as progress
+TRACE_STATUS_COUNTS = {
+    'COMPLETED': 'processes_completed',
+    'FAILED': 'processes_failed',
+    'ABORTED': 'processes_failed',
+}
+
+
+class NextflowOutputCapture:
+    """
+    Streams the stdout and stderr of a running nextflow process to log files, one line at a time,
+    so that memory use doesn't grow with the length of the run and the logs can be followed while it runs.
+
+    Progress is tracked from nextflow's console output (processes submitted, cached, retried and failed)
+    and from the trace file, which gets a line for each task as it finishes. The last lines of stderr
+    are kept, so that they can be reported if the analysis fails.
+    """
+    def __init__(self, process, stdout_path: str, stderr_path: str, trace_path: Optional[str]=None, stderr_tail_lines: int=DEFAULT_STDERR_TAIL_LINES):
+        self.process = process
+        self.trace_path = trace_path
+        self.trace_offset = 0
+        self.trace_status_column = None
+        self.lock = threading.Lock()
+        self.stderr_tail = collections.deque(maxlen=stderr_tail_lines)
+        self.counts = {
+            'processes_submitted': 0,
+            'processes_cached': 0,
+            'processes_completed': 0,
+            'processes_failed': 0,
+            'processes_retried': 0,
+        }
+        self.last_logged_counts = dict(self.counts)
+        self.failed_process = None
+        self.start_readers(stdout_path, stderr_path)
+
+
+    def start_readers(self, stdout_path: str, stderr_path: str):
+        """
+        Start a thread to read each of the process's output streams.
+
+        :param stdout_path: Path to write stdout to.
+        :type stdout_path: str
+        :param stderr_path: Path to write stderr to.
+        :type stderr_path: str
+        :return: None
+        :rtype: NoneType
+        """
+        self.threads = [
+            threading.Thread(target=self.read_stream, args=(self.process.stdout, stdout_path, False), daemon=True),
+            threading.Thread(target=self.read_stream, args=(self.process.stderr, stderr_path, True), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+
+    def read_stream(self, stream, log_path: str, is_stderr: bool):
+        """
+        Copy lines from one of the process's output streams to a log file until the stream is closed.
+
+        :param stream: Binary stream (stdout or stderr of the process).
+        :param log_path: Path to the log file.
+        :type log_path: str
+        :param is_stderr: Whether or not the stream is stderr (whose last lines are kept).
+        :type is_stderr: bool
+        :return: None
+        :rtype: NoneType
+        """
+        with open(log_path, 'w') as log:
+            for raw_line in stream:
+                line = raw_line.decode('utf-8', errors='replace').rstrip('\n')
+                log.write(line + '\n')
+                log.flush()
+                with self.lock:
+                    if is_stderr:
+                        self.stderr_tail.append(line)
+                    self.parse_console_line(line)
+        stream.close()
+
+
+    def parse_console_line(self, line: str):
+        """
+        Update progress counts from a line of nextflow console output. Must be called with `self.lock` held.
+
+        :param line: Line of output.
+        :type line: str
+        :return: None
+        :rtype: NoneType
+        """
+        if NEXTFLOW_SUBMITTED_REGEX.search(line):
+            self.counts['processes_submitted'] += 1
+        elif NEXTFLOW_CACHED_REGEX.search(line):
+            self.counts['processes_cached'] += 1
+        elif NEXTFLOW_RETRIED_REGEX.search(line):
+            self.counts['processes_retried'] += 1
+        elif NEXTFLOW_IGNORED_REGEX.search(line):
+            self.counts['processes_failed'] += 1
+        else:
+            # Failed tasks are counted from the trace file. The console output names the task that stopped the run.
+            match = NEXTFLOW_ERROR_REGEX.search(line)
+            if match:
+                self.failed_process = match.group('process')
+
+
+    def read_trace(self):
+        """
+        Read the lines that have been added to the trace file since it was last read, and count the tasks that finished.
+
+        :return: None
+        :rtype: NoneType
+        """
+        if self.trace_path is None or not os.path.exists(self.trace_path):
+            return
+        try:
+            with open(self.trace_path, 'rb') as f:
+                f.seek(self.trace_offset)
+                data = f.read()
+        except OSError as e:
+            return
+        # Only complete lines are counted. A partly-written line is read again next time.
+        last_newline = data.rfind(b'\n')
+        if last_newline < 0:
+            return
+        self.trace_offset += last_newline + 1
+        with self.lock:
+            for line in data[:last_newline].decode('utf-8', errors='replace').split('\n'):
+                fields = line.split('\t')
+                if self.trace_status_column is None:
+                    if 'status' in fields:
+                        self.trace_status_column = fields.index('status')
+                    continue
+                if len(fields) <= self.trace_status_column:
+                    continue
+                count_key = TRACE_STATUS_COUNTS.get(fields[self.trace_status_column], None)
+                if count_key is not None:
+                    self.counts[count_key] += 1
+
+
+    def get_progress(self) -> dict[str, int]:
+        """
+        :return: Progress counts (`processes_submitted`, `processes_cached`, `processes_completed`, `processes_failed`, `processes_retried`)
+        :rtype: dict[str, int]
+        """
+        self.read_trace()
+        with self.lock:
+            return dict(self.counts)
+
+
+    def log_progress(self, analysis: dict[str, object], force: bool=False):
+        """
+        Log an `analysis_progress` event, if progress has been made since the last one was logged.
+
+        :param analysis: Analysis, as returned by `auto_hcv.core.prepare_analysis`.
+        :type analysis: dict[str, object]
+        :param force: Log the event even if there has been no progress.
+        :type force: bool
+        :return: None
+        :rtype: NoneType
+        """
+        progress = self.get_progress()
+        if progress == self.last_logged_counts and not force:
+            return
+        self.last_logged_counts = progress
+        logging.info(json.dumps(dict({
+            "event_type": "analysis_progress",
+            "sequencing_run_id": analysis['sequencing_run_id'],
+            "pipeline_name": analysis['pipeline']['pipeline_name'],
+            "pipeline_version": analysis['pipeline']['pipeline_version'],
+        }, **progress)))
+
+
+    def get_stderr_tail(self) -> list[str]:
+        """
+        :return: The last lines written to stderr.
+        :rtype: list[str]
+        """
+        with self.lock:
+            return list(self.stderr_tail)
+
+
+    def join(self, timeout: float=READER_JOIN_TIMEOUT_SECONDS):
+        """
+        Wait for the output streams to be read to the end, after the process has exited. Processes started by
+        nextflow may keep the streams open after nextflow itself has exited, so this only waits for up to `timeout` seconds.
+
+        :param timeout: Maximum time to wait for each stream, in seconds.
+        :type timeout: float
+        :return: None
+        :rtype: NoneType
+        """
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class NextflowLogCapture(NextflowOutputCapture):
+    """
+    Tracks the progress of a pipeline that runs somewhere else (for example, as a batch job), by following
+    the stdout and stderr log files that it writes, instead of reading its output streams. New lines are
+    read whenever progress is checked, so no threads are needed.
+    """
+    def start_readers(self, stdout_path: str, stderr_path: str):
+        self.threads = []
+        self.log_offsets = {stdout_path: 0, stderr_path: 0}
+        self.log_paths = [(stdout_path, False), (stderr_path, True)]
+
+
+    def read_log(self, log_path: str, is_stderr: bool):
+        """
+        Read the lines that have been added to a log file since it was last read.
+
+        :param log_path: Path to the log file.
+        :type log_path: str
+        :param is_stderr: Whether or not the log is stderr (whose last lines are kept).
+        :type is_stderr: bool
+        :return: None
+        :rtype: NoneType
+        """
+        try:
+            with open(log_path, 'rb') as f:
+                f.seek(self.log_offsets[log_path])
+                data = f.read()
+        except OSError as e:
+            return
+        last_newline = data.rfind(b'\n')
+        if last_newline < 0:
+            return
+        self.log_offsets[log_path] += last_newline + 1
+        with self.lock:
+            for line in data[:last_newline].decode('utf-8', errors='replace').split('\n'):
+                if is_stderr:
+                    self.stderr_tail.append(line)
+                self.parse_console_line(line)
+
+
+    def get_progress(self) -> dict[str, int]:
+        for log_path, is_stderr in self.log_paths:
+            self.read_log(log_path, is_stderr)
+
+        return super().get_progress()
+
+
+    def join(self, timeout: float=READER_JOIN_TIMEOUT_SECONDS):
+        for log_path, is_stderr in self.log_paths:
+            self.read_log(log_path, is_stderr)
@@ -1,12 +1,20 @@
+import collections
+import concurrent.futures
 import csv
 import datetime
 import glob
+import hashlib
 import json
 import logging
 import os
 from os.path import join as pathjoin
 import shutil
-from .report_html import build_report_html
+import time
+from . import metrics
+from .aggregate import build_run_summary
+from .cleanup import delete_work_dir
+from .report_html import build_report_html, get_file_sha256
+from .trace import ingest_trace
 
 
 
@@ -19,17 +27,188 @@ DEFAULT_SAMPLE_FILES = [
 	("consensus_seqs","{}_consensus_seqs.fa"),
 ]
 
+# Default number of files copied at once when transferring results
+DEFAULT_TRANSFER_WORKERS = 4
+
+# How transferred files are checked against their source: by size, or by SHA-256 of their contents
+TRANSFER_VERIFY_MODES = ['size', 'checksum']
+
+TRANSFER_COMPLETE_FILENAME = 'transfer_complete.json'
+TRANSFER_TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
+TRANSFER_TMP_SUFFIX = '.part'
+TRANSFER_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_file_sha256(src_path, dest_path):
+	"""
+	Copy a file (and its metadata) in chunks, hashing the source as it is read.
+
+	:param src_path: Path to the source file.
+	:type src_path: str
+	:param dest_path: Path to copy the file to.
+	:type dest_path: str
+	:return: SHA-256 of the source file's contents.
+	:rtype: str
+	"""
+	sha256 = hashlib.sha256()
+	with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+		for chunk in iter(lambda: src.read(TRANSFER_COPY_CHUNK_SIZE), b''):
+			sha256.update(chunk)
+			dest.write(chunk)
+	shutil.copystat(src_path, dest_path)
+
+	return sha256.hexdigest()
+
+
+def transferred_file_matches(src_path, dest_path, verify='size', src_sha256=None):
+	"""
+	Check a transferred file against its source.
+
+	:param src_path: Path to the source file.
+	:type src_path: str
+	:param dest_path: Path to the transferred file.
+	:type dest_path: str
+	:param verify: `size` or `checksum`
+	:type verify: str
+	:param src_sha256: SHA-256 of the source file, if it is already known.
+	:type src_sha256: Optional[str]
+	:return: Whether or not the transferred file matches its source.
+	:rtype: bool
+	"""
+	if os.path.getsize(src_path) != os.path.getsize(dest_path):
+		return False
+	if verify == 'checksum':
+		if src_sha256 is None:
+			src_sha256 = get_file_sha256(src_path)
+		return get_file_sha256(dest_path) == src_sha256
+
+	return True
+
+
 # Function to transfer a file from source to destination
-def transfer_file(src_path, dest_path):
-	try: 
-		#logging.info(f'Copying {src_path} to {dest_path}')
-		shutil.copy2(src_path, dest_path)
-	except FileNotFoundError as e :
+def transfer_file(src_path, dest_path, verify='size'):
+	"""
+	Transfer a single file. The file is copied to a temporary name next to its destination, checked against
+	the source, then renamed into place, so a file at `dest_path` is never partially written.
+	Files that were already transferred (by an earlier, interrupted transfer) are skipped.
+
+	:param src_path: Path to the source file.
+	:type src_path: str
+	:param dest_path: Path to transfer the file to.
+	:type dest_path: str
+	:param verify: `size` or `checksum`
+	:type verify: str
+	:return: Dict with keys `src_path`, `dest_path`, `status` (`copied`, `skipped`, `missing` or `failed`) and `bytes`.
+	:rtype: dict
+	"""
+	result = {'src_path': src_path, 'dest_path': dest_path, 'status': None, 'bytes': 0}
+	try:
+		if os.path.exists(dest_path) and transferred_file_matches(src_path, dest_path, verify):
+			result['status'] = 'skipped'
+			result['bytes'] = os.path.getsize(dest_path)
+			return result
+		tmp_path = dest_path + TRANSFER_TMP_SUFFIX
+		if verify == 'checksum':
+			src_sha256 = copy_file_sha256(src_path, tmp_path)
+		else:
+			src_sha256 = None
+			shutil.copy2(src_path, tmp_path)
+		if not transferred_file_matches(src_path, tmp_path, verify, src_sha256=src_sha256):
+			os.remove(tmp_path)
+			logging.error(json.dumps({"event_type": "transfer_file_verification_failed", "file": src_path, "verify": verify}))
+			result['status'] = 'failed'
+			return result
+		os.replace(tmp_path, dest_path)
+		result['status'] = 'copied'
+		result['bytes'] = os.path.getsize(dest_path)
+	except FileNotFoundError as e:
 		# Log a warning if the file does not exist
 		logging.warning(json.dumps({"event_type": "transfer_file_does_not_exist", "file": src_path}))
+		result['status'] = 'missing'
+	except OSError as e:
+		logging.error(json.dumps({"event_type": "transfer_file_failed", "file": src_path, "error": str(e)}))
+		result['status'] = 'failed'
+
+	return result
+
+
+def get_transfer_files(src_path, dest_path, run_id, fstring_list=DEFAULT_SAMPLE_FILES):
+	"""
+	List the files to transfer for a run: the run summary report, and the files named in `fstring_list` for each sample.
+
+	:param src_path: Pipeline output dir for the run.
+	:type src_path: str
+	:param dest_path: Dir to transfer the files to.
+	:type dest_path: str
+	:param run_id: Sequencing run ID.
+	:type run_id: str
+	:param fstring_list: (name, format string) for each sample file. Format strings are filled in with the sample name.
+	:type fstring_list: list[tuple[str, str]]
+	:return: (source path, destination path) for each file.
+	:rtype: list[tuple[str, str]]
+	"""
+	transfer_files = [(pathjoin(src_path, run_id + "_run_summary_report.csv"), pathjoin(dest_path, run_id + "_run_summary_report.csv"))]
+	sample_dirs = sorted(x.name for x in os.scandir(src_path) if x.is_dir())
+	for sample_name in sample_dirs:
+		for str_name, fstring in fstring_list:
+			if str_name == 'depth_plot':
+				name = sample_name.replace('-','o')
+			else:
+				name = sample_name
+			filename = fstring.format(name)
+			transfer_files.append((pathjoin(src_path, sample_name, filename), pathjoin(dest_path, sample_name, filename)))
+
+	return transfer_files
+
+
+def find_incomplete_transfer_dir(run_transfer_dir):
+	"""
+	Find a transfer of a run that was started but not completed, so that it can be resumed.
+	Only the most recent transfer is considered.
+
+	:param run_transfer_dir: Dir containing the timestamped transfer dirs for a run.
+	:type run_transfer_dir: str
+	:return: Path to the incomplete transfer dir, or None if the most recent transfer completed (or there isn't one).
+	:rtype: Optional[str]
+	"""
+	if not os.path.isdir(run_transfer_dir):
+		return None
+	transfer_dirs = sorted(x.path for x in os.scandir(run_transfer_dir) if x.is_dir())
+	if len(transfer_dirs) == 0:
+		return None
+	latest_transfer_dir = transfer_dirs[-1]
+	if os.path.isfile(pathjoin(latest_transfer_dir, TRANSFER_COMPLETE_FILENAME)):
+		return None
+
+	return latest_transfer_dir
+
 
 # Function to transfer HCV results
 def transfer_hcv_results(config, pipeline, run, fstring_list=DEFAULT_SAMPLE_FILES):
+	"""
+	Transfer the results of an analysis to a new timestamped dir under the `analysis_report_dir`.
+	Files are copied in parallel by the pipeline's `transfer.workers` threads, and checked by size (or, with
+	`"transfer": {"verify": "checksum"}`, by SHA-256). If the previous transfer of the run was interrupted,
+	it is resumed: files that were already transferred are skipped.
+
+	:param config: The config dictionary
+	:type config: dict
+	:param pipeline: The pipeline dictionary
+	:type pipeline: dict
+	:param run: The run dictionary
+	:type run: dict
+	:param fstring_list: (name, format string) for each sample file to transfer.
+	:type fstring_list: list[tuple[str, str]]
+	:return: Transfer summary (as written to `transfer_complete.json`), or None if the transfer failed.
+	:rtype: Optional[dict]
+	"""
+	transfer_config = pipeline.get('transfer', None) or {}
+	workers = max(1, int(transfer_config.get('workers', DEFAULT_TRANSFER_WORKERS)))
+	verify = transfer_config.get('verify', 'size')
+	if verify not in TRANSFER_VERIFY_MODES:
+		logging.warning(json.dumps({"event_type": "transfer_verify_mode_invalid", "verify": verify, "valid_verify_modes": TRANSFER_VERIFY_MODES}))
+		verify = 'size'
+
 	# Get the pipeline details from the configuration
 	pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
 	pipeline_minor_version = ''.join(pipeline['pipeline_version'].rsplit('.', 1)[0])
@@ -37,60 +216,65 @@ def transfer_hcv_results(config, pipeline, run, fstring_list=DEFAULT_SAMPLE_FILE
 
 	# Set the source and destination paths for file transfer
 	src_path = pathjoin(config['analysis_output_dir'], run['run_id'], pipeline_path_name)
-	dest_path = pathjoin(config['analysis_report_dir'], pipeline_path_name, run['run_id'], datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-
-	# Check if the run already exists in the summary folder
-	if os.path.isfile(pathjoin(dest_path, "transfer_complete.json")):
-		logging.warning(json.dumps({"event_type": "transfer_hcv_folder_exists_complete","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name']}))
-		return
-	elif os.path.isdir(dest_path):
-		logging.error(json.dumps({"event_type": "transfer_hcv_folder_exists_incomplete","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name']}))
-		return
+	run_transfer_dir = pathjoin(config['analysis_report_dir'], pipeline_path_name, run['run_id'])
+	dest_path = find_incomplete_transfer_dir(run_transfer_dir)
+	resumed = dest_path is not None
+	if not resumed:
+		dest_path = pathjoin(run_transfer_dir, datetime.datetime.now().strftime(TRANSFER_TIMESTAMP_FORMAT))
 
 	# Record the start time of file transfer
+	transfer_start = time.monotonic()
 	transfer_complete = {'timestamp_transfer_start': datetime.datetime.now().isoformat()}
-	logging.info(json.dumps({"event_type": "transfer_hcv_results_start","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name']}))
-	
-	try: 
-		# Create the destination directory
-		os.makedirs(dest_path)
-
-		# Transfer the summary report for the run
-		logging.debug(json.dumps({"event_type": "transfer_hcv_summary_report","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name']}))
-
-		transfer_file(pathjoin(src_path, run['run_id'] + "_run_summary_report.csv"), pathjoin(dest_path, run['run_id'] + "_run_summary_report.csv"))
-		
-		# Transfer sample folders for the run
-		logging.debug(json.dumps({"event_type": "transfer_hcv_sample_folders","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name']}))
-		sample_dirs = [x for x in os.listdir(src_path) if os.path.isdir(pathjoin(src_path, x))]
-
-		# Iterate through each sample folder 
-		for sample_name in sample_dirs:
-			os.makedirs(pathjoin(dest_path, sample_name))
-
-			# Copy each individual file
-			for str_name, fstring in fstring_list:
-				if str_name == 'depth_plot':
-					name = sample_name.replace('-','o')
-				else:
-					name = sample_name
-			
-				filename = fstring.format(name)
-
-				transfer_file(pathjoin(src_path, sample_name, filename), pathjoin(dest_path, sample_name, filename))
-
-		# Record the completion time of file transfer
-		transfer_complete['timestamp_transfer_complete'] = datetime.datetime.now().isoformat()
-
-		# Write the transfer completion details to a JSON file
-		with open(pathjoin(dest_path, 'transfer_complete.json'), 'w') as f:
-			json.dump(transfer_complete, f, indent=2)
-
-		logging.info(json.dumps({"event_type": "transfer_hcv_results_complete","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name']}))
-	
-	except FileExistsError as e:
-		logging.error(json.dumps({"event_type": "transfer_hcv_directory_exists_error","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name'], 'error': e}))
-		
+	logging.info(json.dumps({"event_type": "transfer_hcv_results_start","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name'], "transfer_dir": dest_path, "resumed": resumed, "workers": workers, "verify": verify}))
+
+	try:
+		transfer_files = get_transfer_files(src_path, dest_path, run['run_id'], fstring_list)
+		for dest_dir in sorted(set(os.path.dirname(dest_file) for _, dest_file in transfer_files)):
+			os.makedirs(dest_dir, exist_ok=True)
+	except OSError as e:
+		logging.error(json.dumps({"event_type": "transfer_hcv_results_failed","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name'], "error": str(e)}))
+		return None
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		results = list(executor.map(lambda f: transfer_file(f[0], f[1], verify), transfer_files))
+
+	duration_seconds = time.monotonic() - transfer_start
+	num_files = collections.Counter(result['status'] for result in results)
+	bytes_copied = sum(result['bytes'] for result in results if result['status'] == 'copied')
+	transfer_complete.update({
+		'resumed': resumed,
+		'verify': verify,
+		'workers': workers,
+		'num_files_copied': num_files['copied'],
+		'num_files_skipped': num_files['skipped'],
+		'num_files_missing': num_files['missing'],
+		'num_files_failed': num_files['failed'],
+		'bytes_copied': bytes_copied,
+		'bytes_total': sum(result['bytes'] for result in results),
+		'duration_seconds': round(duration_seconds, 3),
+		'throughput_bytes_per_second': round(bytes_copied / duration_seconds) if duration_seconds > 0 else None,
+	})
+	metrics.TRANSFER_BYTES.inc(bytes_copied, pipeline_name=pipeline['pipeline_name'])
+	metrics.TRANSFER_DURATION_SECONDS.observe(duration_seconds, pipeline_name=pipeline['pipeline_name'])
+	if transfer_complete['throughput_bytes_per_second'] is not None:
+		metrics.TRANSFER_THROUGHPUT_BYTES_PER_SECOND.set(transfer_complete['throughput_bytes_per_second'], pipeline_name=pipeline['pipeline_name'])
+
+	if num_files['failed'] > 0:
+		# Leave the transfer dir without a transfer_complete.json, so that the transfer is resumed next time.
+		logging.error(json.dumps({"event_type": "transfer_hcv_results_failed","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name'], "transfer_dir": dest_path, "num_files_failed": num_files['failed']}))
+		return None
+
+	# Record the completion time of file transfer
+	transfer_complete['timestamp_transfer_complete'] = datetime.datetime.now().isoformat()
+
+	# Write the transfer completion details to a JSON file
+	with open(pathjoin(dest_path, TRANSFER_COMPLETE_FILENAME), 'w') as f:
+		json.dump(transfer_complete, f, indent=2)
+
+	logging.info(json.dumps(dict({"event_type": "transfer_hcv_results_complete","sequencing_run_id": run['run_id'],"pipeline_name": pipeline['pipeline_name'], "transfer_dir": dest_path}, **transfer_complete)))
+
+	return transfer_complete
+
 
 def post_analysis_hcv_nf(config, pipeline, run):
 	logging.debug(json.dumps({
@@ -99,27 +283,92 @@ def post_analysis_hcv_nf(config, pipeline, run):
 				"pipeline_name": pipeline['pipeline_name']
 			}))
 
-	#transfer_hcv_results(config, pipeline, run)
-	build_report_html(config,pipeline,run)
+	transfer_config = pipeline.get('transfer', None) or {}
+	if transfer_config.get('enabled', False):
+		transfer_hcv_results(config, pipeline, run)
+	build_hcv_nf_reports(config, pipeline, run)
+
+
+def build_hcv_nf_reports(config, pipeline, run, force=False):
+	build_start = time.monotonic()
+	summary = build_report_html(config, pipeline, run, force=force)
+	build_run_summary(config, pipeline, run)
+	metrics.REPORT_BUILD_DURATION_SECONDS.observe(time.monotonic() - build_start, pipeline_name=pipeline['pipeline_name'])
+
+	return summary
+
+
+# A dictionary mapping pipeline names to the functions that build their reports
+report_fn_map = {
+	'BCCDC-PHL/hcv-nf': build_hcv_nf_reports
+}
+
+
+def build_reports(config, pipeline, run, force=False):
+	"""
+	(Re-)build the reports for an analysis that has already completed. Only reports whose
+	inputs have changed since they were last built are rebuilt, unless `force` is set.
+
+	:param config: The config dictionary
+	:type config: dict
+	:param pipeline: The pipeline dictionary
+	:type pipeline: dict
+	:param run: The run dictionary
+	:type run: dict
+	:param force: Rebuild all reports, even if their inputs haven't changed.
+	:type force: bool
+	:return: Report build summary, or None if the pipeline doesn't have reports or the analysis isn't complete.
+	:rtype: Optional[dict]
+	"""
+	pipeline_name = pipeline['pipeline_name']
+	pipeline_short_name = pipeline_name.split('/')[1]
+	pipeline_minor_version = ''.join(pipeline['pipeline_version'].rsplit('.', 1)[0])
+	pipeline_path_name = '-'.join([pipeline_short_name, pipeline_minor_version, 'output'])
+	analysis_complete_path = pathjoin(config['analysis_output_dir'], run['run_id'], pipeline_path_name, 'analysis_complete.json')
+
+	if pipeline_name not in report_fn_map:
+		return None
+	if not os.path.exists(analysis_complete_path):
+		logging.warning(json.dumps({
+			"event_type": "build_reports_skipped_analysis_not_complete",
+			"sequencing_run_id": run['run_id'],
+			"pipeline_name": pipeline_name,
+			"analysis_complete_path": analysis_complete_path
+		}))
+		return None
+
+	return report_fn_map[pipeline_name](config, pipeline, run, force=force)
 
 
 def find_latest_glob(path):
-	list_dirs = glob.glob(path)
+	# Work dir names end in a timestamp, so the latest one sorts last
+	list_dirs = sorted(glob.glob(path))
 	if len(list_dirs) > 0:
 		return list_dirs[-1]
 	else:
 		return None
-	
-def post_analysis(config, pipeline, run):
+
+
+def post_analysis(config, pipeline, run, analysis_work_dir=None, cleaner=None, input_bytes=None, reused=False):
 	"""
 	Perform post-analysis tasks for a pipeline.
 
+	The nextflow trace is added to the trace store (see `auto_hcv.trace`), if one is configured, unless the analysis's outputs were reused from an earlier analysis (see `auto_hcv.reuse`), whose processes are already in the store. The analysis work dir is deleted in the background if a `cleaner` is provided, or right away otherwise.
+
 	:param config: The config dictionary
 	:type config: dict
 	:param pipeline: The pipeline dictionary
 	:type pipeline: dict
 	:param run: The run dictionary
 	:type run: dict
+	:param analysis_work_dir: The work dir used by the analysis. If not provided, the most recent work dir for the run is used.
+	:type analysis_work_dir: Optional[str]
+	:param cleaner: Background cleaner to queue the work dir with.
+	:type cleaner: Optional[auto_hcv.cleanup.WorkDirCleaner]
+	:param input_bytes: Size of the analysis's input, passed to the cleaner so that work dir usage can be learned (see `auto_hcv.admission`).
+	:type input_bytes: Optional[int]
+	:param reused: Whether the analysis's outputs were reused from an earlier analysis, rather than the pipeline being run.
+	:type reused: bool
 	:return: None
 	"""
 
@@ -129,30 +378,46 @@ def post_analysis(config, pipeline, run):
 	sequencing_run_id = run['run_id']
 	base_analysis_work_dir = config['analysis_work_dir']
 
-	# The work_dir includes a timestamp, so we need to glob to find the most recent one
-	work_dir_glob = os.path.join(base_analysis_work_dir, 'work-' + sequencing_run_id + '_' + pipeline_short_name + '_' + '*')
-	work_dir = find_latest_glob(work_dir_glob)
+	# Record the resource usage of each process from the nextflow trace. A reused trace describes the
+	# processes of the earlier analysis, which were recorded when it completed.
+	if not reused:
+		ingest_trace(config, pipeline, run)
+
+	work_dir = analysis_work_dir
+	if work_dir is None:
+		# The work_dir includes a timestamp, so we need to glob to find the most recent one
+		work_dir_glob = os.path.join(base_analysis_work_dir, 'work-' + sequencing_run_id + '_' + pipeline_short_name + '_' + '*')
+		work_dir = find_latest_glob(work_dir_glob)
 
 	# Remove the working directory tree
-	if work_dir:
-		try:
-			shutil.rmtree(work_dir, ignore_errors=True)
-			logging.info(json.dumps({
-				"event_type": "analysis_work_dir_deleted",
-				"sequencing_run_id": sequencing_run_id,
-				"analysis_work_dir_path": work_dir
-			}))
-		except OSError as e:
-			logging.error(json.dumps({
-				"event_type": "delete_analysis_work_dir_failed",
-				"sequencing_run_id": sequencing_run_id,
-				"analysis_work_dir_path": work_dir
-			}))
+	if work_dir and os.path.exists(work_dir):
+		if cleaner is not None:
+			cleaner.enqueue(sequencing_run_id, work_dir, input_bytes=input_bytes)
+		else:
+			result = delete_work_dir(work_dir)
+			metrics.CLEANUP_DURATION_SECONDS.observe(result['duration_seconds'])
+			metrics.CLEANUP_BYTES_RECLAIMED.inc(result['bytes_reclaimed'])
+			if len(result['errors']) == 0:
+				logging.info(json.dumps({
+					"event_type": "analysis_work_dir_deleted",
+					"sequencing_run_id": sequencing_run_id,
+					"analysis_work_dir_path": work_dir,
+					"bytes_reclaimed": result['bytes_reclaimed'],
+					"num_files_deleted": result['num_files_deleted'],
+					"duration_seconds": result['duration_seconds'],
+				}))
+			else:
+				logging.error(json.dumps({
+					"event_type": "delete_analysis_work_dir_failed",
+					"sequencing_run_id": sequencing_run_id,
+					"analysis_work_dir_path": work_dir,
+					"errors": result['errors'][:10],
+				}))
 	else:
 		logging.warning(json.dumps({
 			"event_type": "analysis_work_dir_not_found",
 			"sequencing_run_id": sequencing_run_id,
-			"analysis_work_dir_glob": work_dir_glob
+			"analysis_work_dir_path": work_dir,
 		}))
 
 	# a dictionary mapping pipeline names to their functions
@@ -0,0 +1,364 @@
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+import zlib
+
+from typing import Optional
+
+import auto_hcv.metrics as metrics
+import auto_hcv.sharding as sharding
+
+DEFAULT_PREFLIGHT_WORKERS = 4
+GZIP_CHECK_MODES = ['trailer', 'full']
+ON_BAD_SAMPLE_ACTIONS = ['exclude', 'hold']
+INPUT_MANIFEST_FILENAME = 'input_manifest.json'
+PREFLIGHT_FASTQ_INPUT_DIR_NAME = 'preflight_fastq_input'
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_FLAG_FEXTRA = 0x04
+# The empty block that ends every BGZF file (from the SAM/BAM specification)
+BGZF_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Plain gzip files can only be checked for truncation by decompressing them, so small ones always are.
+FULL_CHECK_MAX_BYTES = 16 * 1024 * 1024
+# Decompressed bytes read from the start of a file to estimate its read count
+READ_ESTIMATE_SAMPLE_BYTES = 1024 * 1024
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+def is_bgzf(header: bytes) -> bool:
+    """
+    :param header: First bytes of a gzip file (at least 16).
+    :type header: bytes
+    :return: Whether or not the file is BGZF (blocked gzip), which has a `BC` extra subfield in each block header.
+    :rtype: bool
+    """
+    return len(header) >= 16 and header[:2] == GZIP_MAGIC and header[3] & GZIP_FLAG_FEXTRA != 0 and header[12:14] == b'BC'
+
+
+def count_lines_gzip(path: str) -> int:
+    """
+    Decompress a whole gzip file, which checks the CRC and length in each member's trailer.
+
+    :param path: Path to the gzip file.
+    :type path: str
+    :return: Number of lines.
+    :rtype: int
+    :raises OSError: If the file is corrupt.
+    :raises EOFError: If the file is truncated.
+    :raises zlib.error: If the compressed data is invalid.
+    """
+    num_lines = 0
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            num_lines += chunk.count(b'\n')
+
+    return num_lines
+
+
+def sample_fastq(path: str, compressed: bool) -> tuple[bytes, int, bool]:
+    """
+    Read (and decompress) data from the start of a fastq file.
+
+    :param path: Path to the fastq file.
+    :type path: str
+    :param compressed: Whether or not the file is gzip-compressed.
+    :type compressed: bool
+    :return: Up to `READ_ESTIMATE_SAMPLE_BYTES` of data, the number of bytes of the file that it came from, and whether the whole file was read.
+    :rtype: tuple[bytes, int, bool]
+    """
+    data = []
+    num_data_bytes = 0
+    num_file_bytes = 0
+    with open(path, 'rb') as f:
+        if not compressed:
+            chunk = f.read(READ_ESTIMATE_SAMPLE_BYTES)
+            return chunk, len(chunk), len(f.read(1)) == 0
+        decompressor = zlib.decompressobj(wbits=31)
+        while num_data_bytes < READ_ESTIMATE_SAMPLE_BYTES:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                return b''.join(data), num_file_bytes, True
+            num_file_bytes += len(chunk)
+            while chunk:
+                decompressed = decompressor.decompress(chunk)
+                data.append(decompressed)
+                num_data_bytes += len(decompressed)
+                chunk = decompressor.unused_data
+                if decompressor.eof:
+                    # Files may have several gzip members (BGZF files have one for each block).
+                    decompressor = zlib.decompressobj(wbits=31)
+                    if not chunk:
+                        break
+
+    return b''.join(data), num_file_bytes, False
+
+
+def check_fastq_file(path: str, gzip_check: str='trailer', estimate_reads: bool=True) -> dict[str, object]:
+    """
+    Check that a fastq file can be read: its symlink (if it is one) resolves, it isn't empty, it starts like a fastq
+    file, and (if gzip-compressed) it isn't truncated. With `gzip_check` set to `trailer`, BGZF files are checked for
+    their end-of-file block, and plain gzip files are decompressed if they are small (up to `FULL_CHECK_MAX_BYTES`).
+    With `full`, every gzip file is decompressed, and its read count is counted rather than estimated.
+
+    :param path: Path to the fastq file.
+    :type path: str
+    :param gzip_check: `trailer` or `full`.
+    :type gzip_check: str
+    :param estimate_reads: Whether or not to estimate the number of reads, from the size of the file and the reads at its start.
+    :type estimate_reads: bool
+    :return: The file's `name`, `path`, `bytes`, `estimated_reads` (or None) and `errors`.
+    :rtype: dict[str, object]
+    """
+    result = {
+        "name": os.path.basename(path),
+        "path": path,
+        "bytes": 0,
+        "estimated_reads": None,
+        "errors": [],
+    }
+    if os.path.islink(path) and not os.path.exists(path):
+        result['errors'].append("Broken symlink to " + os.readlink(path))
+        return result
+    try:
+        result['bytes'] = os.stat(path).st_size
+        if result['bytes'] == 0:
+            result['errors'].append("Empty file")
+            return result
+        with open(path, 'rb') as f:
+            header = f.read(16)
+            if result['bytes'] >= len(BGZF_EOF_BLOCK):
+                f.seek(-len(BGZF_EOF_BLOCK), os.SEEK_END)
+            trailer = f.read()
+        compressed = path.endswith('.gz')
+        if compressed and header[:2] != GZIP_MAGIC:
+            result['errors'].append("Not gzip-compressed")
+            return result
+        if compressed and is_bgzf(header) and trailer != BGZF_EOF_BLOCK:
+            result['errors'].append("Missing BGZF end-of-file block (truncated)")
+            return result
+        if compressed and (gzip_check == 'full' or (not is_bgzf(header) and result['bytes'] <= FULL_CHECK_MAX_BYTES)):
+            num_lines = count_lines_gzip(path)
+            if estimate_reads:
+                result['estimated_reads'] = num_lines // 4
+        data, num_file_bytes, read_whole_file = sample_fastq(path, compressed)
+        if not data.startswith(b'@'):
+            result['errors'].append("Not a fastq file (doesn't start with '@')")
+            return result
+        if estimate_reads and result['estimated_reads'] is None:
+            num_reads = data.count(b'\n') // 4
+            if read_whole_file or num_file_bytes == 0:
+                result['estimated_reads'] = num_reads
+            else:
+                result['estimated_reads'] = int(num_reads * result['bytes'] / num_file_bytes)
+    except (OSError, EOFError, zlib.error) as e:
+        result['errors'].append(type(e).__name__ + ": " + str(e))
+
+    return result
+
+
+def check_pairing(file_names: list[str]) -> dict[str, list[str]]:
+    """
+    Check that each R1 fastq file has an R2 file with the same name (apart from the read number), and vice versa.
+
+    :param file_names: Names of the fastq files in a run's fastq directory.
+    :type file_names: list[str]
+    :return: Map from the name of each file whose mate is missing to the error.
+    :rtype: dict[str, list[str]]
+    """
+    names = set(file_names)
+    errors = {}
+    for name in file_names:
+        match = sharding.FASTQ_FILENAME_REGEX.match(name)
+        if match is None:
+            continue
+        mate_read = 'R2' if match.group('read') == 'R1' else 'R1'
+        mate_name = name[:match.start('read')] + mate_read + name[match.end('read'):]
+        if mate_name not in names:
+            errors[name] = [match.group('read') + " file has no " + mate_read + " file (expected " + mate_name + ")"]
+
+    return errors
+
+
+def get_preflight_settings(config: dict[str, object]) -> dict[str, object]:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: The preflight settings that the input manifest depends on.
+    :rtype: dict[str, object]
+    """
+    preflight_config = config.get('preflight', None) or {}
+
+    return {
+        "gzip_check": preflight_config.get('gzip_check', 'trailer'),
+        "estimate_reads": bool(preflight_config.get('estimate_reads', True)),
+        "on_bad_sample": preflight_config.get('on_bad_sample', 'exclude'),
+    }
+
+
+def build_input_manifest(config: dict[str, object], run: dict[str, object]) -> dict[str, object]:
+    """
+    Check all of the fastq files of a run, in parallel (with `preflight.workers` threads), and summarize them by sample.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run, as returned by `auto_hcv.core.check_fastq_dir`.
+    :type run: dict[str, object]
+    :return: Input manifest, with the `bytes`, `estimated_reads`, `status` (`ok` or `bad`) and files of each sample.
+    :rtype: dict[str, object]
+    """
+    preflight_config = config.get('preflight', None) or {}
+    settings = get_preflight_settings(config)
+    workers = int(preflight_config.get('workers', DEFAULT_PREFLIGHT_WORKERS))
+    fastq_directory = run['fastq_directory']
+    samples = sharding.find_fastq_samples(fastq_directory)
+    fastq_paths = [path for sample_name in sorted(samples) for path in samples[sample_name]]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        file_results = dict(zip(fastq_paths, executor.map(lambda path: check_fastq_file(path, settings['gzip_check'], settings['estimate_reads']), fastq_paths)))
+    pairing_errors = check_pairing([os.path.basename(path) for path in fastq_paths])
+
+    manifest_samples = {}
+    for sample_name in sorted(samples):
+        files = [file_results[path] for path in samples[sample_name]]
+        for file_result in files:
+            file_result['errors'] += pairing_errors.get(file_result['name'], [])
+        estimated_reads = None
+        if settings['estimate_reads'] and all(f['estimated_reads'] is not None for f in files):
+            estimated_reads = sum(f['estimated_reads'] for f in files)
+        manifest_samples[sample_name] = {
+            "status": "bad" if any(len(f['errors']) > 0 for f in files) else "ok",
+            "bytes": sum(f['bytes'] for f in files),
+            "estimated_reads": estimated_reads,
+            "files": files,
+        }
+
+    return {
+        "sequencing_run_id": run['run_id'],
+        "fastq_directory": fastq_directory,
+        "fastq_directory_mtime": os.stat(fastq_directory).st_mtime,
+        "timestamp_checked": datetime.datetime.now().isoformat(),
+        "settings": settings,
+        "num_samples": len(manifest_samples),
+        "bad_samples": [sample_name for sample_name, sample in manifest_samples.items() if sample['status'] == 'bad'],
+        "samples": manifest_samples,
+    }
+
+
+def load_input_manifest(manifest_path: str) -> Optional[dict[str, object]]:
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        return None
+
+
+def write_input_manifest(manifest_path: str, manifest: dict[str, object]):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def create_preflight_input_dir(input_dir: str, manifest: dict[str, object]):
+    """
+    Create a fastq input dir with symlinks to the files of the samples that passed the preflight checks.
+    Symlinks to other files (left from an earlier check) are removed.
+
+    :param input_dir: Path to the input dir.
+    :type input_dir: str
+    :param manifest: Input manifest, as built by `build_input_manifest`.
+    :type manifest: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    fastq_paths = {}
+    for sample in manifest['samples'].values():
+        if sample['status'] != 'ok':
+            continue
+        for file_result in sample['files']:
+            fastq_paths[file_result['name']] = file_result['path']
+    for entry in os.scandir(input_dir):
+        if entry.name not in fastq_paths:
+            os.remove(entry.path)
+    for name, fastq_path in fastq_paths.items():
+        link_path = os.path.join(input_dir, name)
+        if not os.path.lexists(link_path):
+            os.symlink(fastq_path, link_path)
+
+
+def preflight_run(config: dict[str, object], run: dict[str, object]) -> Optional[dict[str, object]]:
+    """
+    Check a run's fastq files before it is analyzed (if `preflight.enabled` is set), and write an input manifest
+    (`input_manifest.json`) to the run's analysis output dir. The manifest is re-used, rather than the files being
+    checked again, if the run's fastq dir hasn't changed and the run wasn't held.
+
+    If any samples are bad, then depending on `preflight.on_bad_sample`, the run is held (`hold`), or the bad samples
+    are excluded (`exclude`, the default): the run's `fastq_input` is replaced with a dir of symlinks to the good
+    samples' files, and the bad samples are listed in the run as `excluded_samples`. A run with no good samples is held.
+    Held runs are checked again when they are next found by a scan.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run, as returned by `auto_hcv.core.check_fastq_dir`.
+    :type run: dict[str, object]
+    :return: The run to analyze, or None if it is held.
+    :rtype: Optional[dict[str, object]]
+    """
+    preflight_config = config.get('preflight', None) or {}
+    if not preflight_config.get('enabled', False):
+        return run
+    run_output_dir = os.path.join(config['analysis_output_dir'], run['run_id'])
+    manifest_path = os.path.join(run_output_dir, INPUT_MANIFEST_FILENAME)
+
+    manifest = load_input_manifest(manifest_path)
+    manifest_is_current = (
+        manifest is not None and
+        manifest.get('action', None) != 'held' and
+        manifest.get('settings', None) == get_preflight_settings(config) and
+        manifest.get('fastq_directory_mtime', None) == os.stat(run['fastq_directory']).st_mtime
+    )
+    bad_samples = []
+    try:
+        if not manifest_is_current:
+            manifest = build_input_manifest(config, run)
+            bad_samples = manifest['bad_samples']
+            on_bad_sample = manifest['settings']['on_bad_sample']
+            if len(bad_samples) == 0:
+                manifest['action'] = None
+            elif on_bad_sample == 'hold' or len(bad_samples) == manifest['num_samples']:
+                manifest['action'] = 'held'
+            else:
+                manifest['action'] = 'excluded'
+            write_input_manifest(manifest_path, manifest)
+            logging.info(json.dumps({"event_type": "preflight_complete", "sequencing_run_id": run['run_id'], "num_samples": manifest['num_samples'], "num_bad_samples": len(bad_samples), "input_manifest_path": manifest_path}))
+        bad_samples = manifest['bad_samples']
+        input_dir = os.path.join(run_output_dir, PREFLIGHT_FASTQ_INPUT_DIR_NAME)
+        if manifest['action'] == 'excluded':
+            create_preflight_input_dir(input_dir, manifest)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "preflight_failed", "sequencing_run_id": run['run_id'], "fastq_directory": run['fastq_directory'], "error": str(e)}))
+        metrics.PREFLIGHT_RUNS_HELD.inc()
+        return None
+
+    run['input_bytes'] = sum(sample['bytes'] for sample in manifest['samples'].values() if sample['status'] == 'ok')
+    if manifest['action'] is None:
+        return run
+    sample_errors = {sample_name: [f['name'] + ": " + error for f in manifest['samples'][sample_name]['files'] for error in f['errors']] for sample_name in bad_samples}
+    if manifest['action'] == 'held':
+        logging.warning(json.dumps({"event_type": "run_held_preflight_failed", "sequencing_run_id": run['run_id'], "bad_samples": sample_errors, "input_manifest_path": manifest_path}))
+        metrics.PREFLIGHT_RUNS_HELD.inc()
+        return None
+
+    if not manifest_is_current:
+        logging.warning(json.dumps({"event_type": "samples_excluded_preflight_failed", "sequencing_run_id": run['run_id'], "excluded_samples": sample_errors, "fastq_input": input_dir}))
+        metrics.PREFLIGHT_SAMPLES_EXCLUDED.inc(len(bad_samples))
+    run['analysis_parameters']['fastq_input'] = input_dir
+    run['excluded_samples'] = bad_samples
+
+    return run
@@ -0,0 +1,169 @@
+import datetime
+import json
+import logging
+import os
+import re
+
+from typing import Optional
+
+import auto_hcv.core as core
+
+INSTRUMENT_TYPE_MISEQ = 'miseq'
+INSTRUMENT_TYPE_NEXTSEQ = 'nextseq'
+
+SYMLINKS_COMPLETE_FILENAME = 'symlinks_complete.json'
+
+
+def get_instrument_type(run_id: str) -> Optional[str]:
+    """
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: `miseq` or `nextseq`, or None if the run ID doesn't match either format.
+    :rtype: Optional[str]
+    """
+    if re.match(core.MISEQ_RUN_ID_REGEX, run_id):
+        return INSTRUMENT_TYPE_MISEQ
+    if re.match(core.NEXTSEQ_RUN_ID_REGEX, run_id):
+        return INSTRUMENT_TYPE_NEXTSEQ
+
+    return None
+
+
+def get_run_date(run_id: str) -> Optional[datetime.date]:
+    """
+    :param run_id: Sequencing run ID, which starts with the date of the run (`YYMMDD`).
+    :type run_id: str
+    :return: Date of the run, or None if it can't be parsed.
+    :rtype: Optional[datetime.date]
+    """
+    try:
+        return datetime.datetime.strptime(run_id[:6], '%y%m%d').date()
+    except ValueError as e:
+        return None
+
+
+def get_marker_priority(run: dict[str, object]) -> float:
+    """
+    :param run: Run, as yielded by `auto_hcv.core.scan`.
+    :type run: dict[str, object]
+    :return: The `priority` field from the run's `symlinks_complete.json`, or 0 if there isn't one.
+    :rtype: float
+    """
+    fastq_directory = run.get('fastq_directory', None)
+    if fastq_directory is None:
+        return 0.0
+    try:
+        with open(os.path.join(fastq_directory, SYMLINKS_COMPLETE_FILENAME), 'r') as f:
+            symlinks_complete = json.load(f)
+        return float(symlinks_complete.get('priority', 0) or 0)
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        # The marker file is often empty, or isn't a JSON object.
+        return 0.0
+
+
+def rule_matches(rule: dict[str, object], run_id: str) -> bool:
+    """
+    :param rule: Priority rule, with (optional) `run_id_regex` and `instrument` criteria.
+    :type rule: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Whether or not the run meets all of the rule's criteria.
+    :rtype: bool
+    """
+    if 'run_id_regex' in rule and re.search(rule['run_id_regex'], run_id) is None:
+        return False
+    if 'instrument' in rule and rule['instrument'] != get_instrument_type(run_id):
+        return False
+
+    return True
+
+
+def get_base_priority(config: dict[str, object], run: dict[str, object]) -> float:
+    """
+    Get the part of a run's priority that doesn't change while it waits: the sum of the `priority` of every
+    rule in `run_priority.rules` that the run matches, plus the `priority` from its `symlinks_complete.json`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run, as yielded by `auto_hcv.core.scan`.
+    :type run: dict[str, object]
+    :return: Base priority. Higher priorities are analyzed first.
+    :rtype: float
+    """
+    run_priority_config = config.get('run_priority', None) or {}
+    priority = 0.0
+    for rule in run_priority_config.get('rules', []):
+        if rule_matches(rule, run['run_id']):
+            priority += float(rule.get('priority', 0))
+    priority += get_marker_priority(run)
+
+    return priority
+
+
+def get_age_priority(config: dict[str, object], run_id: str, today: Optional[datetime.date]=None) -> float:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param today: Today's date.
+    :type today: Optional[datetime.date]
+    :return: Priority gained by the run for its age: `run_priority.priority_per_day` for each day since the run's date.
+    :rtype: float
+    """
+    run_priority_config = config.get('run_priority', None) or {}
+    priority_per_day = float(run_priority_config.get('priority_per_day', 0))
+    run_date = get_run_date(run_id)
+    if priority_per_day == 0 or run_date is None:
+        return 0.0
+    if today is None:
+        today = datetime.date.today()
+
+    return max(0, (today - run_date).days) * priority_per_day
+
+
+class PriorityOverrides:
+    """
+    Priority adjustments that can be made while the daemon is running, by editing a JSON control file
+    (`run_priority.control_file`) that maps run IDs to an amount to add to the run's priority, for example:
+
+        {"230101_M00123_0001_000000000-ABCDE": 1000}
+
+    The file is re-read whenever it changes.
+    """
+    def __init__(self, control_file_path: Optional[str]):
+        self.control_file_path = control_file_path
+        self.mtime = None
+        self.overrides = {}
+
+
+    def refresh(self):
+        """
+        Re-read the control file if it has changed. If it can't be read, the last overrides that were read are kept.
+
+        :return: None
+        :rtype: NoneType
+        """
+        if self.control_file_path is None:
+            return
+        try:
+            mtime = os.stat(self.control_file_path).st_mtime
+        except FileNotFoundError as e:
+            self.mtime = None
+            self.overrides = {}
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.control_file_path, 'r') as f:
+                overrides = {str(run_id): float(bump) for run_id, bump in json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logging.error(json.dumps({"event_type": "load_priority_control_file_failed", "control_file": os.path.abspath(self.control_file_path), "error": str(e)}))
+            return
+        self.mtime = mtime
+        self.overrides = overrides
+        logging.info(json.dumps({"event_type": "priority_control_file_loaded", "control_file": os.path.abspath(self.control_file_path), "overrides": overrides}))
+
+
+    def get(self, run_id: str) -> float:
+        return self.overrides.get(run_id, 0.0)
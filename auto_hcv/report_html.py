@@ -1,15 +1,1032 @@
 import pandas as pd
 from pathlib import Path
 import base64
+import concurrent.futures
+import hashlib
+import html
+import io
 import os
+import shutil
 import json
+import time
+import re
 import yaml
 from datetime import datetime
 import logging
+import multiprocessing
 from os.path import join as pathjoin
-import glob
 
-def build_report_html(config,pipeline,run):
+# The C (libyaml) loader is much faster than the pure-Python one, but is only available if PyYAML was built with libyaml.
+try:
+    from yaml import CSafeLoader as YAMLSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLSafeLoader
+
+DEFAULT_REPORT_WORKERS = 1
+# Report worker processes are started from a fork server, not forked from the (multi-threaded) daemon.
+REPORT_WORKER_START_METHOD = 'forkserver'
+
+# 'inline': images are embedded in each report as base64 data URIs, so each report is a single self-contained file (for emailing).
+# 'linked': images are copied once into a content-addressed `assets` directory for the run, and referenced by relative URL.
+REPORT_IMAGE_MODES = ['inline', 'linked']
+DEFAULT_REPORT_IMAGE_MODE = 'inline'
+ASSETS_DIR_NAME = 'assets'
+ASSET_HASH_CACHE_FILENAME = 'asset_hash_cache.json'
+
+# Images are base64-encoded in chunks of this many bytes (a multiple of 3, so that
+# the encoded chunks can be concatenated), so that whole images are never held in memory.
+IMG_READ_CHUNK_SIZE = 3 * 64 * 1024
+
+# Columns that are read from each type of table, but not shown in reports.
+TABLE_HIDDEN_COLUMNS = {
+    'genotype': ['subject_strand', 'e_value'],
+}
+TOP_HITS_PER_AMPLICON = 10
+QUERY_SEQ_ID_AMPLICON_REGEX = r'^[^|]*\|([^|]*)'
+# Floats are shown with this many digits, as by `DataFrame.to_html`
+TABLE_FLOAT_DIGITS = 6
+# Rows are formatted and written this many at a time
+TABLE_ROWS_PER_WRITE = 1000
+# Provenance files are named `<sample>_<timestamp>_provenance.yml`
+PROVENANCE_FILENAME_SUFFIX_REGEX = r'_[0-9].*_provenance\.yml$'
+
+REPORT_HEAD = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8" />
+<title>R3510056725 HCV Typing and Analysis Results</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+
+<style>
+    html, body {
+    font-family: 'Segoe UI', Arial, sans-serif;
+    background: #f7fafc;
+    color: #222;
+    margin: 0;
+    padding: 0;
+    min-height: 100vh;
+    }
+    body {
+    margin: 0;
+    padding: 0 0 50px 0;
+    }
+    .container {
+    max-width: 1100px;
+    margin: 30px auto 60px auto;
+    padding: 30px 30px 20px 30px;
+    background: #fff;
+    border-radius: 16px;
+    box-shadow: 0 2px 20px rgba(30,40,80,0.13), 0 1.5px 6px rgba(0,0,0,0.04);
+    }
+    h1 {
+    font-size: 2.2em;
+    margin-bottom: 15px;
+    }
+    h2 {
+    font-size: 1.35em;
+    color: #29598c;
+    border-bottom: 1px solid #e1e7ef;
+    padding-bottom: 3px;
+    margin-top: 40px;
+    }
+    section {
+    margin-bottom: 36px;
+    padding-bottom: 14px;
+    border-bottom: 1px solid #eaeaea;
+    }
+    .data-table {
+    width: 100%;
+    border-collapse: separate;
+    border-spacing: 0;
+    background: #fafbfc;
+    margin: 10px 0 20px 0;
+    font-size: 0.98em;
+    overflow-x: auto;
+    display: block;
+    max-width: 100%;
+    box-shadow: 0 0.5px 1.2px rgba(80,130,170,0.05);
+    }
+    .data-table th, .data-table td {
+    border: 1px solid #dde4ea;
+    padding: 7px 8px;
+    text-align: left;
+    font-size: 0.97em;
+    }
+    .data-table th {
+    background: #e4ecf6;
+    font-weight: 500;
+    color: #263e5a;
+    }
+    .data-table tbody tr:nth-child(even) {
+    background: #f5faff;
+    }
+    img {
+    width: auto;
+    max-width: 97%;
+    margin: 0 0 18px 0;
+    border-radius: 8px;
+    border: 1.2px solid #d1dbe6;
+    box-shadow: 0 1px 8px rgba(80,120,140,0.10);
+    display: block;
+    }
+    .miniimg {
+    max-height: 120px;
+    margin-right: 18px;
+    display: inline-block;
+    border-radius: 4px;
+    box-shadow: none;
+    border: 1px solid #eee;
+    }
+    iframe {
+    border-radius: 10px;
+    border: 1.2px solid #d5dbe7;
+    margin-top: 10px;
+    background: #f7fafc;
+    }
+    ul {
+    padding-left: 18px;
+    margin: 8px 0;
+    }
+    li {
+    margin-bottom: 4px;
+    font-size: 1em;
+    }
+    .provenance-sample-specific {
+    background: #fff8e6;
+    border-radius: 8px;
+    padding: 2px 12px;
+    border: 1px solid #f0d9a0;
+    }
+    .provenance-list {
+    background: #f4f8fb;
+    border-radius: 8px;
+    padding: 10px 18px 10px 18px;
+    font-size: 0.98em;
+    color: #2d2c2e;
+    border: 1px solid #e2e6ec;
+    margin-top: 7px;
+    }
+    a {
+    color: #2077c7;
+    text-decoration: none;
+    border-bottom: 1px dashed #2077c7;
+    }
+    a:hover {
+    color: #0a3157;
+    border-bottom: 1px solid #0a3157;
+    }
+    @media (max-width: 700px) {
+    .container { padding: 8px; border-radius: 0; box-shadow: none; }
+    h1 { font-size: 1.4em; }
+    section { margin-bottom: 20px; }
+    .data-table th, .data-table td { padding: 5px 5px; font-size: 0.91em; }
+    }
+</style>
+</head>
+<body>
+<div class="container">
+"""
+
+REPORT_TAIL = """</div>
+</body>
+</html>
+"""
+
+
+def get_report_template_version():
+    """
+    Reports depend on the code that builds them as well as on their inputs, so the version of the report
+    template is taken to be the SHA-256 of this module. Any change to it causes all reports to be rebuilt.
+
+    :return: Report template version.
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(__file__, 'rb') as f:
+        sha256.update(f.read())
+
+    return sha256.hexdigest()
+
+
+REPORT_TEMPLATE_VERSION = get_report_template_version()
+
+
+def list_file_names(dir_path):
+    """
+    :param dir_path: Path to a dir.
+    :type dir_path: str | Path
+    :return: Names of the files in the dir (following symlinks). Empty if the dir can't be listed.
+    :rtype: set[str]
+    """
+    try:
+        return {entry.name for entry in os.scandir(dir_path) if entry.is_file()}
+    except OSError as e:
+        return set()
+
+
+def input_exists(inputs, input_name, existing_inputs=None):
+    """
+    :param inputs: Paths to the sample's pipeline outputs, as returned by `get_sample_input_paths`.
+    :type inputs: dict[str, Path]
+    :param input_name: Input name.
+    :type input_name: str
+    :param existing_inputs: Names of the inputs that exist, as returned by `get_sample_input_paths`. If None, the input's path is checked.
+    :type existing_inputs: Optional[set[str]]
+    :return: Whether or not the input exists.
+    :rtype: bool
+    """
+    if existing_inputs is None:
+        return inputs[input_name].exists()
+
+    return input_name in existing_inputs
+
+
+def get_sample_input_paths(analysis_run_output_dir, sample_name):
+    """
+    Get the paths to all of the pipeline outputs for a sample that are included in its report, and which of them exist.
+    The sample dir (and its `demix` dir) is listed once, rather than checking each input separately.
+
+    :param analysis_run_output_dir: Pipeline output dir for the run.
+    :type analysis_run_output_dir: str
+    :param sample_name: Sample name.
+    :type sample_name: str
+    :return: Map from input name to path, and the names of the inputs that exist.
+    :rtype: tuple[dict[str, Path], set[str]]
+    """
+    sample_dir = os.path.join(analysis_run_output_dir, sample_name)
+    sample_dir_files = list_file_names(sample_dir)
+    provenance_regex = re.compile(re.escape(sample_name) + PROVENANCE_FILENAME_SUFFIX_REGEX)
+    provenance_files = sorted(name for name in sample_dir_files if provenance_regex.match(name))
+    if provenance_files:
+        provenance_yml_name = provenance_files[0]
+    else:
+        provenance_yml_name = sample_name + "_provenance.yml"
+    depth_plot_name = sample_name.replace('-','o')
+
+    input_names = {
+        "consensus_tsv": sample_name + "_consensus_seqs_report.tsv",
+        "provenance_yml": provenance_yml_name,
+        "core_plot_png": sample_name + "_core_db_depth_plots.png",
+        "ns5b_plot_png": sample_name + "_ns5b_db_depth_plots.png",
+        "depth_plots": depth_plot_name + "_depth_plots.png",
+        "core_tree": sample_name + "_core_tree.png",
+        "ns5b_tree": sample_name + "_ns5b_tree.png",
+        "core_subtype_tree": sample_name + "_core_subtype_tree.png",
+        "ns5b_subtype_tree": sample_name + "_ns5b_subtype_tree.png",
+        "blastn_result": sample_name + "_blast_results_prefilter.csv",
+        "genotype_csv": sample_name + "_genotype_calls_nt.csv",
+        "genome_result_csv": sample_name + "_parsed_genome_results.csv",
+    }
+    inputs = {
+        "demix_tsv": Path(os.path.join(sample_dir, "demix", sample_name+"_demixing_results.tsv")),
+    }
+    existing_inputs = set()
+    if inputs['demix_tsv'].name in list_file_names(inputs['demix_tsv'].parent):
+        existing_inputs.add('demix_tsv')
+    for input_name, file_name in input_names.items():
+        inputs[input_name] = Path(os.path.join(sample_dir, file_name))
+        if file_name in sample_dir_files:
+            existing_inputs.add(input_name)
+
+    return inputs, existing_inputs
+
+
+class AssetCache:
+    """
+    Content-addressed store of report images for a run. Each image is stored once, as `assets/<sha256>.png`
+    in the pipeline output dir, no matter how many reports refer to it.
+
+    The SHA-256 of each image is cached (keyed on path, size and modification time) in
+    `assets/asset_hash_cache.json`, so images that haven't changed are never re-read.
+    """
+    def __init__(self, analysis_run_output_dir, hashes=None):
+        self.assets_dir = os.path.join(analysis_run_output_dir, ASSETS_DIR_NAME)
+        self.hashes = hashes if hashes is not None else {}
+        self.updated_hashes = {}
+
+
+    @classmethod
+    def load(cls, analysis_run_output_dir):
+        """
+        :param analysis_run_output_dir: Pipeline output dir for the run.
+        :type analysis_run_output_dir: str
+        :return: Asset cache, with any hashes cached by previous report builds.
+        :rtype: AssetCache
+        """
+        asset_cache = cls(analysis_run_output_dir)
+        os.makedirs(asset_cache.assets_dir, exist_ok=True)
+        hash_cache_path = os.path.join(asset_cache.assets_dir, ASSET_HASH_CACHE_FILENAME)
+        try:
+            with open(hash_cache_path, 'r') as f:
+                asset_cache.hashes = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+            asset_cache.hashes = {}
+
+        return asset_cache
+
+
+    def save(self, updated_hashes):
+        """
+        Add hashes computed by report builds (possibly in other processes) to the cache, and write it to disk.
+
+        :param updated_hashes: Map from image path to cache entry.
+        :type updated_hashes: dict[str, dict[str, object]]
+        :return: None
+        :rtype: NoneType
+        """
+        self.hashes.update(updated_hashes)
+        hash_cache_path = os.path.join(self.assets_dir, ASSET_HASH_CACHE_FILENAME)
+        with open(hash_cache_path + '.tmp', 'w') as f:
+            json.dump(self.hashes, f, indent=2)
+        os.replace(hash_cache_path + '.tmp', hash_cache_path)
+
+
+    def get_sha256(self, img_path):
+        """
+        :param img_path: Path to an image.
+        :type img_path: Path
+        :return: SHA-256 of the image (from the cache, if the image hasn't changed).
+        :rtype: str
+        """
+        key = str(img_path.absolute())
+        img_stat = img_path.stat()
+        cached = self.hashes.get(key, None)
+        if cached is not None and cached['size'] == img_stat.st_size and cached['mtime_ns'] == img_stat.st_mtime_ns:
+            return cached['sha256']
+        sha256 = hashlib.sha256()
+        with open(img_path, 'rb') as img:
+            for chunk in iter(lambda: img.read(IMG_READ_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        entry = {
+            "size": img_stat.st_size,
+            "mtime_ns": img_stat.st_mtime_ns,
+            "sha256": sha256.hexdigest(),
+        }
+        self.hashes[key] = entry
+        self.updated_hashes[key] = entry
+
+        return entry['sha256']
+
+
+    def add(self, img_path):
+        """
+        Copy an image into the assets dir (unless an identical image is already there).
+
+        :param img_path: Path to an image.
+        :type img_path: Path
+        :return: Path to the asset, relative to a sample's report.
+        :rtype: str
+        """
+        asset_name = self.get_sha256(img_path) + img_path.suffix
+        asset_path = os.path.join(self.assets_dir, asset_name)
+        if not os.path.exists(asset_path):
+            # Reports are built by several processes at once, which may add the same image.
+            tmp_asset_path = asset_path + '.' + str(os.getpid()) + '.tmp'
+            shutil.copyfile(img_path, tmp_asset_path)
+            os.replace(tmp_asset_path, asset_path)
+
+        return '../' + ASSETS_DIR_NAME + '/' + asset_name
+
+
+def write_img_tag_if_exists(f, img_path, height=None, alt="image", asset_cache=None, exists=None):
+    """
+    Write an image tag, or a placeholder if the image doesn't exist (`exists`, if known, or else checked). If an asset
+    cache is provided, the image is linked from the run's assets dir. Otherwise, the image is inlined as a base64
+    data URI, and is read and encoded in chunks.
+    """
+    if exists is None:
+        exists = img_path.exists()
+    if exists:
+        height_attr = f' height="{height}px"' if height else ""
+        if asset_cache is not None:
+            f.write(f'<img src="{asset_cache.add(img_path)}"{height_attr} alt="{alt}">')
+            return
+        f.write('<img src="data:image/png;base64,')
+        with open(img_path, 'rb') as img:
+            for chunk in iter(lambda: img.read(IMG_READ_CHUNK_SIZE), b''):
+                f.write(base64.b64encode(chunk).decode('utf-8'))
+        f.write(f'"{height_attr} alt="{alt}">')
+    else:
+        f.write(f'<span style="color:#888;">Missing: {img_path.name}</span>')
+
+
+def read_report_table(table_path, table_type=None, index_col=None, **kwargs):
+    """
+    Read a table for a report. Only the columns that are shown in the report are read: the index column
+    (which is never shown) and the hidden columns for the table type (see `TABLE_HIDDEN_COLUMNS`) are skipped.
+
+    :param table_path: Path to the table.
+    :type table_path: Path
+    :param table_type: Type of table (`genotype` or `blastn`), if it needs special handling.
+    :type table_type: Optional[str]
+    :param index_col: Position of the index column, if there is one.
+    :type index_col: Optional[int]
+    :return: Table
+    :rtype: pd.DataFrame
+    """
+    header = pd.read_csv(table_path, nrows=0, **kwargs).columns
+    hidden_columns = set(TABLE_HIDDEN_COLUMNS.get(table_type, []))
+    usecols = [i for i, column in enumerate(header) if i != index_col and column not in hidden_columns]
+
+    return pd.read_csv(table_path, usecols=usecols, **kwargs)
+
+
+def select_top_hits_per_amplicon(df, n=TOP_HITS_PER_AMPLICON):
+    """
+    Select the `n` hits with the highest bitscores for each amplicon. Only the top hits of each amplicon are
+    partially sorted, rather than sorting the whole table.
+
+    :param df: BLAST results, with `amplicon` and `bitscore` columns.
+    :type df: pd.DataFrame
+    :param n: Number of hits to select for each amplicon.
+    :type n: int
+    :return: Top hits, ordered by amplicon, then by descending bitscore.
+    :rtype: pd.DataFrame
+    """
+    top_hit_index = df.groupby('amplicon')['bitscore'].nlargest(n).index.get_level_values(-1)
+
+    return df.loc[top_hit_index].reset_index(drop=True)
+
+
+def format_float_column(values):
+    """
+    Format a column of floats the way `DataFrame.to_html` does: with the same number of decimal places for every
+    value (trailing zeros trimmed), or in scientific notation if any value is very small, or is very large and
+    too long to show that way.
+
+    :param values: Column values.
+    :type values: np.ndarray
+    :return: Formatted values.
+    :rtype: list[str]
+    """
+    is_nan = pd.isna(values)
+    finite_values = values[~is_nan]
+    abs_values = abs(finite_values)
+    formatted = [f'{value:.{TABLE_FLOAT_DIGITS}f}' for value in finite_values]
+    # At least one decimal place is kept. Infinite values (`inf`) aren't trimmed.
+    num_zeros_trimmed = min((len(value) - len(value.rstrip('0')) for value in formatted if value[-1].isdigit()), default=0)
+    num_zeros_trimmed = min(num_zeros_trimmed, TABLE_FLOAT_DIGITS - 1)
+    if num_zeros_trimmed > 0:
+        formatted = [value[:-num_zeros_trimmed] if value[-1].isdigit() else value for value in formatted]
+    has_small_values = ((abs_values < 10 ** -TABLE_FLOAT_DIGITS) & (abs_values > 0)).any()
+    too_long = max((len(value) for value in formatted), default=0) > TABLE_FLOAT_DIGITS + 6
+    if has_small_values or (too_long and (abs_values > 1e6).any()):
+        formatted = [f'{value:.{TABLE_FLOAT_DIGITS}e}' for value in finite_values]
+    if not is_nan.any():
+        return formatted
+    formatted_values = iter(formatted)
+
+    return ['NaN' if nan else next(formatted_values) for nan in is_nan]
+
+
+def format_table_column(column):
+    """
+    :param column: Table column.
+    :type column: pd.Series
+    :return: HTML-escaped values, formatted as by `DataFrame.to_html`.
+    :rtype: list[str]
+    """
+    if pd.api.types.is_float_dtype(column.dtype):
+        return format_float_column(column.to_numpy(dtype=float))
+    if pd.api.types.is_integer_dtype(column.dtype) or pd.api.types.is_bool_dtype(column.dtype):
+        return [str(value) for value in column.tolist()]
+
+    return [html.escape(str(value), quote=False) if not pd.isna(value) else 'NaN' for value in column.tolist()]
+
+
+def write_html_table(f, df):
+    """
+    Write a table as HTML, a chunk of rows at a time, without building the whole table in memory.
+    The markup matches `DataFrame.to_html(index=False, classes='data-table', border=0)`.
+
+    :param f: File to write the table to.
+    :type f: io.TextIOBase
+    :param df: Table
+    :type df: pd.DataFrame
+    :return: None
+    :rtype: NoneType
+    """
+    # Every value is formatted before anything is written, so that a table that can't be formatted isn't partly written.
+    cells = [['      <td>' + value + '</td>\n' for value in format_table_column(df.iloc[:, i])] for i in range(df.shape[1])]
+    f.write('<table border="0" class="dataframe data-table">\n  <thead>\n    <tr style="text-align: right;">\n')
+    f.write(''.join('      <th>' + html.escape(str(column), quote=False) + '</th>\n' for column in df.columns))
+    f.write('    </tr>\n  </thead>\n  <tbody>\n')
+    for chunk_start in range(0, len(df), TABLE_ROWS_PER_WRITE):
+        rows = zip(*(column_cells[chunk_start:chunk_start + TABLE_ROWS_PER_WRITE] for column_cells in cells))
+        f.write(''.join('    <tr>\n' + ''.join(row) + '    </tr>\n' for row in rows))
+    f.write('  </tbody>\n</table>')
+
+
+def write_table_if_exists(f, table_path, table_type=None, exists=None, **kwargs):
+    """
+    Write a table from a CSV/TSV file as HTML, or a message if it is missing or can't be read.
+
+    For `genotype` tables, the amplicon is taken from the `query_seq_id` (`<sample>|<amplicon>|...`). For `genotype`
+    and `blastn` tables, only the top hits for each amplicon are shown (see `select_top_hits_per_amplicon`).
+
+    :param f: File to write the table to.
+    :type f: io.TextIOBase
+    :param table_path: Path to the table.
+    :type table_path: Path
+    :param table_type: Type of table (`genotype` or `blastn`), if it needs special handling.
+    :type table_type: Optional[str]
+    :param exists: Whether or not the table exists, if already known. Checked if not provided.
+    :type exists: Optional[bool]
+    :return: None
+    :rtype: NoneType
+    """
+    if exists is None:
+        exists = table_path.exists()
+    if not exists:
+        f.write(f"<div style='color:#888'>Table file missing: {table_path.name}</div>")
+        return
+    try:
+        df = read_report_table(table_path, table_type, **kwargs)
+        if table_type == 'genotype':
+            # The second field of the query ID, as by `.split('|')[1]`
+            df['amplicon'] = df['query_seq_id'].str.extract(QUERY_SEQ_ID_AMPLICON_REGEX, expand=False)
+        if table_type in ['genotype', 'blastn']:
+            df = select_top_hits_per_amplicon(df)
+        write_html_table(f, df)
+    except Exception as e:
+        f.write(f"<div style='color:red'>Error reading {table_path.name}: {e}</div>")
+
+
+# Helper to safely create html tables
+def table_if_exists(table_path, table_type=None, **kwargs):
+    f = io.StringIO()
+    write_table_if_exists(f, table_path, table_type, **kwargs)
+
+    return f.getvalue()
+
+
+def parse_provenance(provenance_text):
+    """
+    Parse a provenance file into its entries. Provenance files are YAML lists, with one entry for each process
+    (or input) of the pipeline. Files with several YAML documents have the entries of all of them.
+
+    :param provenance_text: Contents of the provenance file.
+    :type provenance_text: str
+    :return: Entries. A document that isn't a list is a single entry.
+    :rtype: list
+    :raises yaml.YAMLError: If the file isn't valid YAML.
+    """
+    entries = []
+    for document in yaml.load_all(provenance_text, Loader=YAMLSafeLoader):
+        if document is None:
+            continue
+        entries += document if isinstance(document, list) else [document]
+
+    return entries
+
+
+def get_provenance_entry_key(entry):
+    """
+    :param entry: Provenance entry, as parsed by `parse_provenance`.
+    :type entry: object
+    :return: Canonical JSON of the entry, so that entries with the same content compare equal.
+    :rtype: str
+    """
+    return json.dumps(entry, sort_keys=True, default=str)
+
+
+def load_run_provenance(inputs_by_sample, existing_inputs_by_sample=None):
+    """
+    Load the provenance of every sample in a run. Most samples' provenance files are largely the same (pipeline
+    version, database paths and so on), so files with the same contents are parsed only once, and the entries that
+    every sample shares are separated from the ones that differ.
+
+    :param inputs_by_sample: Map from sample name to the paths of its inputs, as returned by `get_sample_input_paths`.
+    :type inputs_by_sample: dict[str, dict[str, Path]]
+    :param existing_inputs_by_sample: Map from sample name to the names of its inputs that exist, as returned by `get_sample_input_paths`. Provenance files that don't exist aren't opened.
+    :type existing_inputs_by_sample: Optional[dict[str, set[str]]]
+    :return: Map from sample name to its provenance (None if it has no provenance file), with keys `common` (the
+             entries shared by all samples with provenance), `sample_specific` (the sample's other entries) and
+             `error` (if the file isn't valid YAML).
+    :rtype: dict[str, Optional[dict[str, list]]]
+    """
+    provenance_by_sample = {sample_name: None for sample_name in inputs_by_sample}
+    entries_by_sample = {}
+    parsed_files = {}
+    for sample_name, inputs in inputs_by_sample.items():
+        if existing_inputs_by_sample is not None and not input_exists(inputs, 'provenance_yml', existing_inputs_by_sample[sample_name]):
+            continue
+        try:
+            with open(inputs['provenance_yml'], 'r') as f:
+                provenance_text = f.read()
+            if provenance_text not in parsed_files:
+                parsed_files[provenance_text] = parse_provenance(provenance_text)
+        except OSError as e:
+            continue
+        except yaml.YAMLError as e:
+            provenance_by_sample[sample_name] = {"common": [], "sample_specific": [], "error": str(e)}
+            continue
+        entries_by_sample[sample_name] = parsed_files[provenance_text]
+
+    common_entry_keys = set()
+    if len(entries_by_sample) > 1:
+        common_entry_keys = set.intersection(*[{get_provenance_entry_key(entry) for entry in entries} for entries in entries_by_sample.values()])
+
+    for sample_name, entries in entries_by_sample.items():
+        provenance = {"common": [], "sample_specific": []}
+        for entry in entries:
+            key = "common" if get_provenance_entry_key(entry) in common_entry_keys else "sample_specific"
+            provenance[key].append(entry)
+        provenance_by_sample[sample_name] = provenance
+
+    return provenance_by_sample
+
+
+def provenance_entries_html(entries):
+    html_content = "<ul>\n"
+    for item in entries:
+        if isinstance(item, dict):
+            for key, value in item.items():
+                html_content += f"  <li>{key}: {value}</li>\n"
+        elif item is not None:
+            html_content += f"  <li>{item}</li>\n"
+    html_content += "</ul>\n"
+
+    return html_content
+
+
+def provenance_html(provenance):
+    """
+    :param provenance: Sample provenance, as returned by `load_run_provenance`, or None if the sample has none.
+    :type provenance: Optional[dict[str, list]]
+    :return: The entries that are specific to the sample, followed by those common to the run.
+    :rtype: str
+    """
+    if provenance is None:
+        return "<div style='color:#888'>Provenance file missing.</div>"
+    if 'error' in provenance:
+        return "<div style='color:#888'>Provenance file could not be read: " + html.escape(provenance['error']) + "</div>"
+    if len(provenance['common']) == 0:
+        return provenance_entries_html(provenance['sample_specific'])
+
+    html_content = "<h3>Specific to this sample</h3>\n"
+    if len(provenance['sample_specific']) > 0:
+        html_content += "<div class='provenance-sample-specific'>\n" + provenance_entries_html(provenance['sample_specific']) + "</div>\n"
+    else:
+        html_content += "<div style='color:#888'>None: this sample's provenance is the same as the rest of the run.</div>\n"
+    html_content += "<h3>Common to all samples in the run</h3>\n"
+    html_content += provenance_entries_html(provenance['common'])
+
+    return html_content
+
+
+def write_sample_report(f, sample_name, inputs, current_datetime, asset_cache=None, provenance=None, existing_inputs=None):
+    """
+    Write the HTML report for a sample, one section at a time.
+
+    :param f: File to write the report to.
+    :type f: io.TextIOBase
+    :param sample_name: Sample name.
+    :type sample_name: str
+    :param inputs: Paths to the sample's pipeline outputs, as returned by `get_sample_input_paths`.
+    :type inputs: dict[str, Path]
+    :param current_datetime: Report generation time.
+    :type current_datetime: datetime
+    :param asset_cache: Asset cache to link images from. If None, images are inlined.
+    :type asset_cache: Optional[AssetCache]
+    :param provenance: Sample provenance, as returned by `load_run_provenance`.
+    :type provenance: Optional[dict[str, list]]
+    :param existing_inputs: Names of the inputs that exist, as returned by `get_sample_input_paths`. Checked if not provided.
+    :type existing_inputs: Optional[set[str]]
+    :return: None
+    :rtype: NoneType
+    """
+    f.write(REPORT_HEAD)
+    f.write(f"""    <h1>{sample_name} HCV Typing &amp; Analysis Results</h1>
+    <p>Report generated on: {current_datetime} </p>
+    <section>
+    <h2>Consensus Sequences Report</h2>
+    <p>Note the segment coverage was calculated based on the full length hcv genome that has a length of an approximate 9600 nucleotides.
+    But we are only sequencing core and ns5b amplicons, 3.53 (core) and 3.35 (ns5b) are full coverage. 
+    </p>
+""")
+    write_table_if_exists(f, inputs['consensus_tsv'], exists=input_exists(inputs, 'consensus_tsv', existing_inputs), sep='\t')
+    f.write("""
+    </section>
+    <section>
+    <h2>Alignment Statistics</h2>
+""")
+    write_table_if_exists(f, inputs['genome_result_csv'], exists=input_exists(inputs, 'genome_result_csv', existing_inputs), index_col=0)
+    f.write("""
+    </section>
+    <section>
+    <h2>Freyja Mixture Analysis</h2>
+""")
+    write_table_if_exists(f, inputs['demix_tsv'], exists=input_exists(inputs, 'demix_tsv', existing_inputs), sep='\t')
+    f.write("""
+    </section>
+
+    <section>
+    <h2>Blast Results (HCV Reference Database)</h2>
+    <div>
+        <span style="font-size:1em;">References downloaded from: 
+        <a href="https://ictv.global/sg_wiki/flaviviridae/hepacivirus/hcv_files" target="_blank">
+            ictv.global HCV files
+        </a>
+        </span>
+    </div>
+""")
+    write_table_if_exists(f, inputs['blastn_result'], table_type='blastn', exists=input_exists(inputs, 'blastn_result', existing_inputs), index_col=0)
+    f.write("""
+    </section>
+
+    <section>
+    <h2>Blast Results (Core_nt databases, top 10 per amplicon)</h2>
+""")
+    write_table_if_exists(f, inputs['genotype_csv'], table_type='genotype', exists=input_exists(inputs, 'genotype_csv', existing_inputs), index_col=0)
+    f.write("""
+    </section>
+
+    <section>
+    <h2>Depth Plots</h2>
+    <div style="margin-bottom:12px;">
+    """)
+    write_img_tag_if_exists(f, inputs['depth_plots'], alt="Core/NS5B depth", asset_cache=asset_cache, exists=input_exists(inputs, 'depth_plots', existing_inputs))
+    f.write("""
+    </div>
+
+    </section>
+
+    <section>
+    <h2>Phylogenetic Analysis</h2>
+    <div style="display: flex; flex-wrap: wrap; gap: 24px 16px; margin-bottom: 13px;">
+""")
+    trees = [
+        ("Core genotype clustering", 'core_tree', "Core genotype tree"),
+        ("Core subtype clustering", 'core_subtype_tree', "Core subtype tree"),
+        ("NS5B genotype clustering", 'ns5b_tree', "NS5B genotype tree"),
+        ("NS5B subtype clustering", 'ns5b_subtype_tree', "NS5B subtype tree"),
+    ]
+    for title, input_name, alt in trees:
+        f.write(f"""        <div>
+        <div style="font-weight:600;color:#364e73;font-size:1.04em;margin-bottom:4px;">{title}</div>
+        """)
+        write_img_tag_if_exists(f, inputs[input_name], alt=alt, asset_cache=asset_cache, exists=input_exists(inputs, input_name, existing_inputs))
+        f.write("""
+        </div>
+""")
+    f.write("""    </div>
+    </section>
+
+    <section>
+    <h2>Reads Mapped to the Reference DB</h2>
+    <p>Here we take the raw reads and map directly onto the 237 HCV references. The coverage of the reference with 
+    the most reads mapped is plotted. Note the coverage plots here do not represent the real coverage as the current database
+    used do not capture all the variability of the actual HCV samples. This is why the assembly mode is better.
+    The results here give confirmation to the reported results above and in case of missing assembly, suggest what the genotype/subtypes
+    might be. We expect these to have comparable coverage as the HCV database grows. 
+        
+    </p>
+    <div style="display: flex; flex-wrap: wrap; gap: 28px 16px; align-items: center;">
+        """)
+    write_img_tag_if_exists(f, inputs['core_plot_png'], alt="Reads mapped to core db", asset_cache=asset_cache, exists=input_exists(inputs, 'core_plot_png', existing_inputs))
+    f.write("""
+        """)
+    write_img_tag_if_exists(f, inputs['ns5b_plot_png'], alt="Reads mapped to ns5b db", asset_cache=asset_cache, exists=input_exists(inputs, 'ns5b_plot_png', existing_inputs))
+    f.write("""
+    </div>
+    </section>
+
+    <section>
+    <h2>Provenance</h2>
+    <div class="provenance-list">
+        """)
+    f.write(provenance_html(provenance))
+    f.write("""
+    </div>
+    </section>
+""")
+    f.write(REPORT_TAIL)
+
+
+def get_file_sha256(path):
+    """
+    :param path: Path to a file.
+    :type path: Path
+    :return: SHA-256 of the file.
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(IMG_READ_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def get_input_fingerprint(path, sha256=None, exists=None):
+    """
+    :param path: Path to a report input.
+    :type path: Path
+    :param sha256: SHA-256 of the file, if it is already known.
+    :type sha256: Optional[str]
+    :param exists: Whether or not the file exists, if already known. Checked if not provided.
+    :type exists: Optional[bool]
+    :return: Dict with keys `path`, `exists`, and (if the file exists) `size`, `mtime_ns` and `sha256`.
+    :rtype: dict[str, object]
+    """
+    fingerprint = {
+        "path": str(path.absolute()),
+        "exists": exists if exists is not None else path.exists(),
+    }
+    if fingerprint['exists']:
+        path_stat = path.stat()
+        fingerprint['size'] = path_stat.st_size
+        fingerprint['mtime_ns'] = path_stat.st_mtime_ns
+        fingerprint['sha256'] = sha256 if sha256 is not None else get_file_sha256(path)
+
+    return fingerprint
+
+
+def get_provenance_sha256(provenance):
+    """
+    :param provenance: Sample provenance, as returned by `load_run_provenance`.
+    :type provenance: Optional[dict[str, list]]
+    :return: SHA-256 of the provenance, which changes if the provenance of other samples in the run changes what is common.
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps(provenance, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def build_report_manifest(inputs, report_image_mode, provenance=None, existing_inputs=None):
+    """
+    Record the inputs that a report was built from.
+
+    :param inputs: Paths to the sample's pipeline outputs, as returned by `get_sample_input_paths`.
+    :type inputs: dict[str, Path]
+    :param report_image_mode: Report image mode (`inline` or `linked`).
+    :type report_image_mode: str
+    :param provenance: Sample provenance shown in the report, as returned by `load_run_provenance`.
+    :type provenance: Optional[dict[str, list]]
+    :param existing_inputs: Names of the inputs that exist, as returned by `get_sample_input_paths`. Checked if not provided.
+    :type existing_inputs: Optional[set[str]]
+    :return: Report manifest.
+    :rtype: dict[str, object]
+    """
+    manifest = {
+        "report_template_version": REPORT_TEMPLATE_VERSION,
+        "report_image_mode": report_image_mode,
+        "provenance_sha256": get_provenance_sha256(provenance),
+        "timestamp_report_built": datetime.now().isoformat(),
+        "inputs": {input_name: get_input_fingerprint(path, exists=input_exists(inputs, input_name, existing_inputs)) for input_name, path in inputs.items()},
+    }
+
+    return manifest
+
+
+def report_manifest_matches(manifest, inputs, report_image_mode, asset_cache=None, provenance=None, existing_inputs=None):
+    """
+    Check whether a report's manifest still matches its inputs. Inputs whose size and modification time
+    haven't changed are assumed to be unchanged. Inputs whose modification time has changed (but not their size)
+    are hashed and compared.
+
+    :param manifest: Report manifest, as returned by `build_report_manifest`.
+    :type manifest: dict[str, object]
+    :param inputs: Paths to the sample's pipeline outputs, as returned by `get_sample_input_paths`.
+    :type inputs: dict[str, Path]
+    :param report_image_mode: Report image mode (`inline` or `linked`).
+    :type report_image_mode: str
+    :param asset_cache: Asset cache that the report links images from, if any.
+    :type asset_cache: Optional[AssetCache]
+    :param provenance: Sample provenance, as returned by `load_run_provenance`.
+    :type provenance: Optional[dict[str, list]]
+    :param existing_inputs: Names of the inputs that exist, as returned by `get_sample_input_paths`. Checked if not provided.
+    :type existing_inputs: Optional[set[str]]
+    :return: Whether or not the report is up to date.
+    :rtype: bool
+    """
+    if manifest.get('report_template_version', None) != REPORT_TEMPLATE_VERSION:
+        return False
+    if manifest.get('provenance_sha256', None) != get_provenance_sha256(provenance):
+        return False
+    if manifest.get('report_image_mode', None) != report_image_mode:
+        return False
+    manifest_inputs = manifest.get('inputs', {})
+    if set(manifest_inputs.keys()) != set(inputs.keys()):
+        return False
+    for input_name, path in inputs.items():
+        recorded = manifest_inputs[input_name]
+        if recorded['path'] != str(path.absolute()) or recorded['exists'] != input_exists(inputs, input_name, existing_inputs):
+            return False
+        if not recorded['exists']:
+            continue
+        path_stat = path.stat()
+        if recorded['size'] != path_stat.st_size:
+            return False
+        if recorded['mtime_ns'] != path_stat.st_mtime_ns and recorded['sha256'] != get_file_sha256(path):
+            return False
+        if asset_cache is not None and path.suffix == '.png':
+            # The linked image must still be in the assets dir.
+            if not os.path.exists(os.path.join(asset_cache.assets_dir, recorded['sha256'] + path.suffix)):
+                return False
+
+    return True
+
+
+def build_sample_report(analysis_run_output_dir, sample_name, current_datetime, asset_cache=None, force=False, inputs=None, provenance=None, existing_inputs=None):
+    """
+    Build the HTML report for one sample. The report is written to a temporary file, which replaces
+    `<sample>_report.html` once it is complete, so a failure never leaves a partial report behind.
+
+    A manifest of the report's inputs is written to `<sample>_report_manifest.json`. If the report
+    already exists and its manifest still matches its inputs, the report is not rebuilt (unless `force` is set).
+
+    This is run in a worker process, so any error is caught and returned rather than raised,
+    and doesn't affect the reports for other samples.
+
+    :param analysis_run_output_dir: Pipeline output dir for the run.
+    :type analysis_run_output_dir: str
+    :param sample_name: Sample name.
+    :type sample_name: str
+    :param current_datetime: Report generation time.
+    :type current_datetime: datetime
+    :param asset_cache: Asset cache to link images from. If None, images are inlined.
+    :type asset_cache: Optional[AssetCache]
+    :param force: Rebuild the report even if its inputs haven't changed.
+    :type force: bool
+    :param inputs: Paths to the sample's pipeline outputs, as returned by `get_sample_input_paths`. Found if not provided.
+    :type inputs: Optional[dict[str, Path]]
+    :param provenance: Sample provenance, as returned by `load_run_provenance`. Loaded (for this sample alone) if not provided.
+    :type provenance: Optional[dict[str, list]]
+    :param existing_inputs: Names of the inputs that exist, as returned by `get_sample_input_paths` along with `inputs`.
+    :type existing_inputs: Optional[set[str]]
+    :return: Dict with keys `sample_name`, `status` (`built`, `unchanged`, `skipped` or `failed`), `duration_seconds`, `error` (if failed) and `asset_hashes` (image hashes computed while building the report).
+    :rtype: dict[str, object]
+    """
+    start_time = time.perf_counter()
+    result = {
+        "sample_name": sample_name,
+        "status": "built",
+    }
+    report_file = os.path.join(analysis_run_output_dir, sample_name, sample_name + '_report.html')
+    manifest_file = os.path.join(analysis_run_output_dir, sample_name, sample_name + '_report_manifest.json')
+    tmp_report_file = report_file + '.tmp'
+    report_image_mode = 'linked' if asset_cache is not None else 'inline'
+    try:
+        if inputs is None:
+            inputs, existing_inputs = get_sample_input_paths(analysis_run_output_dir, sample_name)
+        if provenance is None:
+            provenance = load_run_provenance({sample_name: inputs}, None if existing_inputs is None else {sample_name: existing_inputs})[sample_name]
+        required_inputs = ['consensus_tsv', 'core_plot_png', 'blastn_result', 'depth_plots', 'genotype_csv', 'demix_tsv']
+        manifest = None
+        if not force and os.path.exists(report_file) and os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+        if not any(input_exists(inputs, input_name, existing_inputs) for input_name in required_inputs):
+            result['status'] = "skipped"
+        elif manifest is not None and report_manifest_matches(manifest, inputs, report_image_mode, asset_cache, provenance, existing_inputs):
+            result['status'] = "unchanged"
+        else:
+            with open(tmp_report_file, 'w') as f:
+                write_sample_report(f, sample_name, inputs, current_datetime, asset_cache, provenance, existing_inputs)
+            os.replace(tmp_report_file, report_file)
+            with open(manifest_file + '.tmp', 'w') as f:
+                json.dump(build_report_manifest(inputs, report_image_mode, provenance, existing_inputs), f, indent=2)
+            os.replace(manifest_file + '.tmp', manifest_file)
+            print(f"HTML report generated: {report_file}")
+    except Exception as e:
+        result['status'] = "failed"
+        result['error'] = str(e)
+        if os.path.exists(tmp_report_file):
+            os.remove(tmp_report_file)
+    result['duration_seconds'] = round(time.perf_counter() - start_time, 3)
+    if asset_cache is not None:
+        result['asset_hashes'] = asset_cache.updated_hashes
+
+    return result
+
+
+def build_report_html(config,pipeline,run,force=False):
+    """
+    Build an HTML report for each sample in the run's pipeline output dir.
+
+    Reports are built in parallel by a pool of `report_workers` processes (from the config, default 1).
+    Images are inlined into each report, unless `report_image_mode` is set to `linked` in the config,
+    in which case they are stored once in the run's `assets` dir (see `AssetCache`).
+
+    Each sample dir is listed once to find its inputs and which of them exist. Provenance is loaded once for the whole run (see
+    `load_run_provenance`), and each report shows the entries specific to its sample apart from those common to the run.
+
+    Reports whose inputs haven't changed since they were last built are not rebuilt, unless `force` is set.
+    A report that fails to build doesn't affect the others. A summary of the outcome and build time for each
+    sample is logged, and written to `report_build_summary.json` in the pipeline output dir.
+
+    :param config: The config dictionary
+    :type config: dict
+    :param pipeline: The pipeline dictionary
+    :type pipeline: dict
+    :param run: The run dictionary
+    :type run: dict
+    :param force: Rebuild all reports, even if their inputs haven't changed.
+    :type force: bool
+    :return: Report build summary
+    :rtype: dict
+    """
     # Get the current local date and time
     current_datetime = datetime.now()
     pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
@@ -19,352 +1036,87 @@ def build_report_html(config,pipeline,run):
     sequencing_run_id = os.path.join(run['run_id'],pipeline_path_name)
     analysis_run_output_dir = os.path.join(config['analysis_output_dir'], sequencing_run_id)
 
-    sample_dirs = [x for x in os.listdir(analysis_run_output_dir) if os.path.isdir(pathjoin(analysis_run_output_dir, x))]
+    sample_dirs = [x for x in os.listdir(analysis_run_output_dir) if os.path.isdir(pathjoin(analysis_run_output_dir, x)) and x != ASSETS_DIR_NAME]
+
+    try:
+        report_workers = int(config.get('report_workers', DEFAULT_REPORT_WORKERS))
+    except ValueError as e:
+        report_workers = DEFAULT_REPORT_WORKERS
 
-    # Iterate through each sample folder 
+    report_image_mode = config.get('report_image_mode', DEFAULT_REPORT_IMAGE_MODE)
+    if report_image_mode not in REPORT_IMAGE_MODES:
+        logging.warning(json.dumps({"event_type": "unknown_report_image_mode", "report_image_mode": report_image_mode, "default_report_image_mode": DEFAULT_REPORT_IMAGE_MODE}))
+        report_image_mode = DEFAULT_REPORT_IMAGE_MODE
+
+    asset_cache = None
+    if report_image_mode == 'linked':
+        asset_cache = AssetCache.load(analysis_run_output_dir)
+
+    inputs_by_sample = {}
+    existing_inputs_by_sample = {}
     for sample_name in sample_dirs:
-        #print("Current date and time:", current_datetime)
-        # Define paths to your files
-        demix_tsv = Path(os.path.join(analysis_run_output_dir,sample_name,"demix", sample_name+"_demixing_results.tsv"))
-        consensus_tsv = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_consensus_seqs_report.tsv"))
-        print(sample_name)
-        pattern = os.path.join(analysis_run_output_dir,sample_name,sample_name + "_[0-9]*_provenance.yml")
-        
-        files = glob.glob(pattern)
+        inputs_by_sample[sample_name], existing_inputs_by_sample[sample_name] = get_sample_input_paths(analysis_run_output_dir, sample_name)
+    provenance_by_sample = load_run_provenance(inputs_by_sample, existing_inputs_by_sample)
 
-        if not files:
-            print("no yml files")
-            provenance_yml = os.path.join(analysis_run_output_dir,sample_name,sample_name + "_[0-9]*_provenance.yml")
-        else:
-            provenance_yml = files[0]
-
-        core_plot_png = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_core_db_depth_plots.png" ))
-        ns5b_plot_png = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_ns5b_db_depth_plots.png" ))
-        depth_plot_name = sample_name.replace('-','o')
-        print(os.path.join(analysis_run_output_dir,sample_name,depth_plot_name + "_depth_plots.png" ))
-        depth_plots = Path(os.path.join(analysis_run_output_dir,sample_name,depth_plot_name + "_depth_plots.png" ))
-        core_tree = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_core_tree.png" ))
-        ns5b_tree = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_ns5b_tree.png" ))
-        core_subtype_tree = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_core_subtype_tree.png" ))
-        ns5b_subtype_tree = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_ns5b_subtype_tree.png" ))
-        blastn_result = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_blast_results_prefilter.csv" ))
-        genotype_csv = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_genotype_calls_nt.csv" ))
-        genome_result_csv = Path(os.path.join(analysis_run_output_dir,sample_name,sample_name + "_parsed_genome_results.csv"))
-        #igv_report_path = os.path.join(analysis_run_output_dir,sample_name, sample_name + "_igv_report.html")
-        #print(igv_report_path)
-        # Helper to safely create image tags
-        if not ( consensus_tsv.exists() or core_plot_png.exists() or blastn_result.exists() or depth_plots.exists() or genotype_csv.exists() or demix_tsv.exists() ):
-            continue
-         
-        def img_tag_if_exists(img_path, height=None, alt="image"):
-            if img_path.exists():
-                data_uri = base64.b64encode(img_path.read_bytes()).decode('utf-8')
-                height_attr = f' height="{height}px"' if height else ""
-                return f'<img src="data:image/png;base64,{data_uri}"{height_attr} alt="{alt}">'
-            return f'<span style="color:#888;">Missing: {img_path.name}</span>'
-
-        # Helper to safely create html tables
-        def table_if_exists(table_path, **kwargs):
-            if table_path.exists():
+    logging.info(json.dumps({"event_type": "build_reports_start", "sequencing_run_id": run['run_id'], "pipeline_name": pipeline['pipeline_name'], "num_samples": len(sample_dirs), "report_workers": report_workers, "report_image_mode": report_image_mode}))
+    start_time = time.perf_counter()
+    sample_results = []
+    if report_workers <= 1:
+        for sample_name in sample_dirs:
+            sample_results.append(build_sample_report(analysis_run_output_dir, sample_name, current_datetime, asset_cache, force, inputs_by_sample[sample_name], provenance_by_sample[sample_name], existing_inputs_by_sample[sample_name]))
+    else:
+        # Reports are built from a worker thread of the daemon, while other threads (cleanup workers, nextflow output
+        # readers, the metrics server) are running. A forked worker could inherit a lock held by one of them, and deadlock.
+        mp_context = multiprocessing.get_context(REPORT_WORKER_START_METHOD)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=report_workers, mp_context=mp_context) as executor:
+            futures = {executor.submit(build_sample_report, analysis_run_output_dir, sample_name, current_datetime, asset_cache, force, inputs_by_sample[sample_name], provenance_by_sample[sample_name], existing_inputs_by_sample[sample_name]): sample_name for sample_name in sample_dirs}
+            for future in concurrent.futures.as_completed(futures):
                 try:
-                    df = pd.read_csv(table_path, **kwargs)
-                    if table_path == genotype_csv:  
-                        #df = pd.read_csv(genotype_csv, index_col=0)
-                        df = df.drop(['subject_strand','e_value'],axis=1)
-                        df['amplicon'] = df.apply(lambda row: row['query_seq_id'].split('|')[1], axis=1)
-                        df = df.sort_values(['amplicon', 'bitscore'], ascending=[True, False])
-                        df = df.groupby('amplicon').head(10).reset_index(drop=True)
-                    
-                    if table_path == blastn_result:
-                        #df = pd.read_csv(blastn_result, index_col=0)
-                        df = df.sort_values(['amplicon', 'bitscore'], ascending=[True, False])
-                        df = df.groupby('amplicon').head(10).reset_index(drop=True)
-
-                    return df.to_html(index=False, classes='data-table', border=0)
+                    sample_results.append(future.result())
                 except Exception as e:
-                    return f"<div style='color:red'>Error reading {table_path.name}: {e}</div>"
-            return f"<div style='color:#888'>Table file missing: {table_path.name}</div>"
+                    # The worker process itself failed (for example, it was killed because it ran out of memory).
+                    sample_results.append({"sample_name": futures[future], "status": "failed", "error": str(e)})
 
-        # Helper to safely read YAML
-        if os.path.exists(provenance_yml):
-            with open(provenance_yml, 'r') as f:
-                provenance_data = yaml.safe_load(f)
+    if asset_cache is not None:
+        updated_hashes = {}
+        for result in sample_results:
+            updated_hashes.update(result.pop('asset_hashes', {}))
+        asset_cache.save(updated_hashes)
 
-            html_content = "<ul>\n"
+    for result in sample_results:
+        if result['status'] == 'failed':
+            logging.error(json.dumps({"event_type": "build_sample_report_failed", "sequencing_run_id": run['run_id'], "sample_name": result['sample_name'], "error": result['error']}))
 
-            for item in provenance_data:
-                for key, value in item.items():
-                    html_content += f"  <li>{key}: {value}</li>\n"
-
-            html_content += "</ul>\n"
-        else:
-            html_content = "<div style='color:#888'>Provenance file missing.</div>"
-
-        # Usage in template
-        consensus_html = table_if_exists(consensus_tsv, sep='\t')
-        demix_html = table_if_exists(demix_tsv, sep='\t')
-        blastn_html = table_if_exists(blastn_result, index_col=0)
-        genotype_html = table_if_exists(genotype_csv, index_col=0)
-        genome_results_html = table_if_exists(genome_result_csv, index_col = 0)
-        img_tag_mapref_core = img_tag_if_exists(core_plot_png, alt="Reads mapped to core db")
-        img_tag_mapref_ns5b = img_tag_if_exists(ns5b_plot_png, alt="Reads mapped to ns5b db")
-        img_tag_depth = img_tag_if_exists(depth_plots, alt="Core/NS5B depth")
-        img_tag_tree_core = img_tag_if_exists(core_tree, alt="Core genotype tree")
-        img_tag_tree_ns5b = img_tag_if_exists(ns5b_tree, alt="NS5B genotype tree")
-        img_tag_tree_core_subtype = img_tag_if_exists(core_subtype_tree, alt="Core subtype tree")
-        img_tag_tree_ns5b_subtype = img_tag_if_exists(ns5b_subtype_tree, alt="NS5B subtype tree")
-
-        #with open(provenance_yml,'r') as file:
-        #    provenance_data = yaml.safe_load(file)
-
-        #print(provenance_data)
-        # Read tabular data into dataframes
-        #demix_df = pd.read_csv(demix_tsv, sep='\t', nrows=20)         # reading first 20 rows as preview
-        #consensus_df = pd.read_csv(consensus_tsv, sep='\t', nrows=20)
-
-        #genotype_df = pd.read_csv(genotype_csv, index_col = 0)
-        #genotype_df = genotype_df.drop(['subject_strand','e_value'],axis=1)
-        #genotype_df['amplicon'] = genotype_df.apply(lambda row: row['query_seq_id'].split('|')[1], axis=1)
-        #genotype_sorted = genotype_df.sort_values(['amplicon', 'bitscore'], ascending=[True, False])
-        #genotype_sorted_top10 = genotype_sorted.groupby('amplicon').head(10).reset_index(drop=True)
-
-        #blastn_df = pd.read_csv(blastn_result,index_col=0)
-        #blastn_df = blastn_df.sort_values(['amplicon', 'bitscore'], ascending=[True, False])
-        #blastn_df_top10 = blastn_df.groupby('amplicon').head(10).reset_index(drop=True)
-
-
-        #html_content = "<ul>\n"
-        #for item in provenance_data:
-        #    for key,value in item.items():
-        #        html_content += f"  <li>{key}: {value}<//li>\n"
-
-        #html_content += "</ul>\n"
-
-        # Start the HTML report string
-        html = f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-        <meta charset="UTF-8" />
-        <title>R3510056725 HCV Typing and Analysis Results</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-
-        <style>
-            html, body {{
-            font-family: 'Segoe UI', Arial, sans-serif;
-            background: #f7fafc;
-            color: #222;
-            margin: 0;
-            padding: 0;
-            min-height: 100vh;
-            }}
-            body {{
-            margin: 0;
-            padding: 0 0 50px 0;
-            }}
-            .container {{
-            max-width: 1100px;
-            margin: 30px auto 60px auto;
-            padding: 30px 30px 20px 30px;
-            background: #fff;
-            border-radius: 16px;
-            box-shadow: 0 2px 20px rgba(30,40,80,0.13), 0 1.5px 6px rgba(0,0,0,0.04);
-            }}
-            h1 {{
-            font-size: 2.2em;
-            margin-bottom: 15px;
-            }}
-            h2 {{
-            font-size: 1.35em;
-            color: #29598c;
-            border-bottom: 1px solid #e1e7ef;
-            padding-bottom: 3px;
-            margin-top: 40px;
-            }}
-            section {{
-            margin-bottom: 36px;
-            padding-bottom: 14px;
-            border-bottom: 1px solid #eaeaea;
-            }}
-            .data-table {{
-            width: 100%;
-            border-collapse: separate;
-            border-spacing: 0;
-            background: #fafbfc;
-            margin: 10px 0 20px 0;
-            font-size: 0.98em;
-            overflow-x: auto;
-            display: block;
-            max-width: 100%;
-            box-shadow: 0 0.5px 1.2px rgba(80,130,170,0.05);
-            }}
-            .data-table th, .data-table td {{
-            border: 1px solid #dde4ea;
-            padding: 7px 8px;
-            text-align: left;
-            font-size: 0.97em;
-            }}
-            .data-table th {{
-            background: #e4ecf6;
-            font-weight: 500;
-            color: #263e5a;
-            }}
-            .data-table tbody tr:nth-child(even) {{
-            background: #f5faff;
-            }}
-            img {{
-            width: auto;
-            max-width: 97%;
-            margin: 0 0 18px 0;
-            border-radius: 8px;
-            border: 1.2px solid #d1dbe6;
-            box-shadow: 0 1px 8px rgba(80,120,140,0.10);
-            display: block;
-            }}
-            .miniimg {{
-            max-height: 120px;
-            margin-right: 18px;
-            display: inline-block;
-            border-radius: 4px;
-            box-shadow: none;
-            border: 1px solid #eee;
-            }}
-            iframe {{
-            border-radius: 10px;
-            border: 1.2px solid #d5dbe7;
-            margin-top: 10px;
-            background: #f7fafc;
-            }}
-            ul {{
-            padding-left: 18px;
-            margin: 8px 0;
-            }}
-            li {{
-            margin-bottom: 4px;
-            font-size: 1em;
-            }}
-            .provenance-list {{
-            background: #f4f8fb;
-            border-radius: 8px;
-            padding: 10px 18px 10px 18px;
-            font-size: 0.98em;
-            color: #2d2c2e;
-            border: 1px solid #e2e6ec;
-            margin-top: 7px;
-            }}
-            a {{
-            color: #2077c7;
-            text-decoration: none;
-            border-bottom: 1px dashed #2077c7;
-            }}
-            a:hover {{
-            color: #0a3157;
-            border-bottom: 1px solid #0a3157;
-            }}
-            @media (max-width: 700px) {{
-            .container {{ padding: 8px; border-radius: 0; box-shadow: none; }}
-            h1 {{ font-size: 1.4em; }}
-            section {{ margin-bottom: 20px; }}
-            .data-table th, .data-table td {{ padding: 5px 5px; font-size: 0.91em; }}
-            }}
-        </style>
-        </head>
-        <body>
-        <div class="container">
-            <h1>{sample_name} HCV Typing &amp; Analysis Results</h1>
-            <p>Report generated on: {current_datetime} </p>
-            <section>
-            <h2>Consensus Sequences Report</h2>
-            <p>Note the segment coverage was calculated based on the full length hcv genome that has a length of an approximate 9600 nucleotides.
-            But we are only sequencing core and ns5b amplicons, 3.53 (core) and 3.35 (ns5b) are full coverage. 
-            </p>
-            {consensus_html}
-            </section>
-            <section>
-            <h2>Alignment Statistics</h2>
-            {genome_results_html}
-            </section>
-            <section>
-            <h2>Freyja Mixture Analysis</h2>
-            {demix_html}
-            </section>
-            
-            <section>
-            <h2>Blast Results (HCV Reference Database)</h2>
-            <div>
-                <span style="font-size:1em;">References downloaded from: 
-                <a href="https://ictv.global/sg_wiki/flaviviridae/hepacivirus/hcv_files" target="_blank">
-                    ictv.global HCV files
-                </a>
-                </span>
-            </div>
-            {blastn_html}
-            </section>
-            
-            <section>
-            <h2>Blast Results (Core_nt databases, top 10 per amplicon)</h2>
-            {genotype_html}
-            </section>
-            
-            <section>
-            <h2>Depth Plots</h2>
-            <div style="margin-bottom:12px;">
-            {img_tag_depth}
-            </div>
-
-            </section>
-            
-            <section>
-            <h2>Phylogenetic Analysis</h2>
-            <div style="display: flex; flex-wrap: wrap; gap: 24px 16px; margin-bottom: 13px;">
-                <div>
-                <div style="font-weight:600;color:#364e73;font-size:1.04em;margin-bottom:4px;">Core genotype clustering</div>
-                {img_tag_tree_core}
-                </div>
-                <div>
-                <div style="font-weight:600;color:#364e73;font-size:1.04em;margin-bottom:4px;">Core subtype clustering</div>
-                {img_tag_tree_core_subtype}
-                </div>
-                <div>
-                <div style="font-weight:600;color:#364e73;font-size:1.04em;margin-bottom:4px;">NS5B genotype clustering</div>
-                {img_tag_tree_ns5b}
-                </div>
-                <div>
-                <div style="font-weight:600;color:#364e73;font-size:1.04em;margin-bottom:4px;">NS5B subtype clustering</div>
-                {img_tag_tree_ns5b_subtype}
-                </div>
-            </div>
-            </section>
-            
-            <section>
-            <h2>Reads Mapped to the Reference DB</h2>
-            <p>Here we take the raw reads and map directly onto the 237 HCV references. The coverage of the reference with 
-            the most reads mapped is plotted. Note the coverage plots here do not represent the real coverage as the current database
-            used do not capture all the variability of the actual HCV samples. This is why the assembly mode is better.
-            The results here give confirmation to the reported results above and in case of missing assembly, suggest what the genotype/subtypes
-            might be. We expect these to have comparable coverage as the HCV database grows. 
-                
-            </p>
-            <div style="display: flex; flex-wrap: wrap; gap: 28px 16px; align-items: center;">
-                {img_tag_mapref_core}
-                {img_tag_mapref_ns5b}
-            </div>
-            </section>
-            
-            <section>
-            <h2>Provenance</h2>
-            <div class="provenance-list">
-                {html_content}
-            </div>
-            </section>
-        </div>
-        </body>
-        </html>
-        """
+    summary = {
+        "sequencing_run_id": run['run_id'],
+        "pipeline_name": pipeline['pipeline_name'],
+        "pipeline_version": pipeline['pipeline_version'],
+        "report_workers": report_workers,
+        "report_image_mode": report_image_mode,
+        "timestamp_report_build_start": current_datetime.isoformat(),
+        "total_duration_seconds": round(time.perf_counter() - start_time, 3),
+        "num_samples": len(sample_results),
+        "num_reports_built": len([r for r in sample_results if r['status'] == 'built']),
+        "num_reports_unchanged": len([r for r in sample_results if r['status'] == 'unchanged']),
+        "num_reports_skipped": len([r for r in sample_results if r['status'] == 'skipped']),
+        "num_reports_failed": len([r for r in sample_results if r['status'] == 'failed']),
+        "samples": sorted(sample_results, key=lambda r: r['sample_name']),
+    }
+    # Replaced rather than written in place, since the file may be a hard link to an earlier analysis's (see `auto_hcv.reuse`).
+    summary_path = os.path.join(analysis_run_output_dir, 'report_build_summary.json')
+    with open(summary_path + '.tmp', 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(summary_path + '.tmp', summary_path)
 
-        # Write the HTML report to disk
-        report_file =  os.path.join(analysis_run_output_dir,sample_name,sample_name + '_report.html')
-        with open(report_file, 'w') as f:
-            f.write(html)
+    logging.info(json.dumps({
+        "event_type": "build_reports_complete",
+        "sequencing_run_id": run['run_id'],
+        "pipeline_name": pipeline['pipeline_name'],
+        "total_duration_seconds": summary['total_duration_seconds'],
+        "num_reports_built": summary['num_reports_built'],
+        "num_reports_unchanged": summary['num_reports_unchanged'],
+        "num_reports_skipped": summary['num_reports_skipped'],
+        "num_reports_failed": summary['num_reports_failed'],
+    }))
 
-        print(f"HTML report generated: {report_file}")
\ No newline at end of file
+    return summary
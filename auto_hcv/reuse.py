@@ -0,0 +1,264 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import signal
+import threading
+
+from typing import Optional
+
+import auto_hcv.nextflow_output as nextflow_output
+import auto_hcv.sharding as sharding
+
+REUSE_MODES = ['link', 'copy']
+DEFAULT_REUSE_MODE = 'link'
+# Bytes hashed from the start, middle and end of each fastq file. Hashing whole files would mean reading
+# every run in full; files that differ almost always differ in size, or in these chunks.
+SAMPLED_CHUNK_BYTES = 64 * 1024
+# Files in the previous analysis output dir that belong to that analysis, and aren't reused. Its nextflow stdout and
+# stderr logs (see `auto_hcv.nextflow_output.LOG_FILENAME_PREFIXES`) aren't reused either.
+NOT_REUSED_FILENAMES = ['analysis_complete.json', 'analysis_attempts.json']
+# Files that post-analysis tasks (reports, run summaries) write again for the new analysis. In `link` mode these are
+# copied, so that the earlier analysis's files are never changed through a shared hard link.
+REWRITTEN_FILENAMES = ['report_build_summary.json', 'asset_hash_cache.json']
+REWRITTEN_FILENAME_SUFFIXES = ('_report.html', '_report_manifest.json', '_run_summary.html')
+
+
+def hash_file_sample(path: str, size: int) -> str:
+    """
+    :param path: Path to the file.
+    :type path: str
+    :param size: Size of the file, in bytes.
+    :type size: int
+    :return: SHA-256 of up to `SAMPLED_CHUNK_BYTES` from each of the start, middle and end of the file (or of the whole file, if it's small).
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size <= 3 * SAMPLED_CHUNK_BYTES:
+            sha256.update(f.read())
+        else:
+            for offset in [0, (size - SAMPLED_CHUNK_BYTES) // 2, size - SAMPLED_CHUNK_BYTES]:
+                f.seek(offset)
+                sha256.update(f.read(SAMPLED_CHUNK_BYTES))
+
+    return sha256.hexdigest()
+
+
+def fingerprint_fastq_input(fastq_input_dir: str) -> str:
+    """
+    Fingerprint the input of an analysis from the sample names, file names, file sizes and a sampled content hash
+    (see `hash_file_sample`) of each of the fastq files in the fastq input dir. Runs whose fastq files have been
+    re-symlinked or re-delivered under a new run directory get the same fingerprint.
+
+    :param fastq_input_dir: Fastq input dir of the run (its fastq dir, or the dir made by the preflight checks).
+    :type fastq_input_dir: str
+    :return: Input fingerprint (SHA-256, as hex).
+    :rtype: str
+    :raises OSError: If any of the files can't be read.
+    """
+    samples = sharding.find_fastq_samples(fastq_input_dir)
+    fingerprint_samples = []
+    for sample_name in sorted(samples):
+        files = []
+        for path in sorted(samples[sample_name]):
+            size = os.stat(path).st_size
+            files.append([os.path.basename(path), size, hash_file_sample(path, size)])
+        fingerprint_samples.append([sample_name, files])
+
+    return hashlib.sha256(json.dumps(fingerprint_samples).encode('utf-8')).hexdigest()
+
+
+def get_input_fingerprint(run_state, run: dict[str, object]) -> Optional[str]:
+    """
+    Get the fingerprint of a run's fastq input, from the run state store if it was computed for the input dir as it
+    is now (same modification time), or by fingerprinting the input (see `fingerprint_fastq_input`) and caching it.
+    The fingerprint is also kept in the run as `input_fingerprint`, for the run's other analyses.
+
+    :param run_state: Run state store.
+    :type run_state: auto_hcv.state.RunStateStore
+    :param run: Run, as yielded by `auto_hcv.core.scan`.
+    :type run: dict[str, object]
+    :return: Input fingerprint, or None if the fastq files can't be read.
+    :rtype: Optional[str]
+    """
+    if 'input_fingerprint' in run:
+        return run['input_fingerprint']
+    fastq_input = run['analysis_parameters']['fastq_input']
+    try:
+        dir_mtime = os.stat(fastq_input).st_mtime
+        input_fingerprint = run_state.get_input_fingerprint(run['run_id'], fastq_input, dir_mtime)
+        if input_fingerprint is None:
+            input_fingerprint = fingerprint_fastq_input(fastq_input)
+            run_state.set_input_fingerprint(run['run_id'], fastq_input, dir_mtime, input_fingerprint)
+    except OSError as e:
+        logging.warning(json.dumps({"event_type": "input_fingerprint_failed", "sequencing_run_id": run['run_id'], "error": str(e)}))
+        return None
+    run['input_fingerprint'] = input_fingerprint
+
+    return input_fingerprint
+
+
+def get_reuse_key(pipeline: dict[str, object], input_fingerprint: str) -> str:
+    """
+    Combine an input fingerprint with the pipeline's name, version and parameters. Parameters that are set per run
+    (those configured as null, such as `fastq_input` and `outdir`) are left out, since they name paths that differ
+    between runs even when the input is the same.
+
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param input_fingerprint: Input fingerprint, as returned by `fingerprint_fastq_input`.
+    :type input_fingerprint: str
+    :return: Key (SHA-256, as hex) shared by all analyses of the same input by the same pipeline.
+    :rtype: str
+    """
+    pipeline_parameters = {flag: value for flag, value in pipeline['pipeline_parameters'].items() if value is not None}
+    key = {
+        "pipeline_name": pipeline['pipeline_name'],
+        "pipeline_version": pipeline['pipeline_version'],
+        "pipeline_parameters": pipeline_parameters,
+        "input_fingerprint": input_fingerprint,
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_reused_analysis(analysis_pipeline_output_dir: str) -> bool:
+    """
+    :param analysis_pipeline_output_dir: Analysis output dir.
+    :type analysis_pipeline_output_dir: str
+    :return: Whether or not the analysis's `analysis_complete.json` records that its outputs were reused (`reused_from`).
+    :rtype: bool
+    """
+    try:
+        with open(os.path.join(analysis_pipeline_output_dir, 'analysis_complete.json'), 'r') as f:
+            analysis_complete = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        return False
+
+    return isinstance(analysis_complete, dict) and analysis_complete.get('reused_from', None) is not None
+
+
+def get_reuse_mode(config: dict[str, object]) -> str:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: How previous outputs are reused: `link` (hard links, falling back to copies across filesystems) or `copy`.
+    :rtype: str
+    """
+    reuse_config = config.get('input_reuse', None) or {}
+
+    return reuse_config.get('mode', DEFAULT_REUSE_MODE)
+
+
+class ReuseCancelled(Exception):
+    pass
+
+
+class ReuseJob:
+    """
+    Links or copies the outputs of a previous analysis of the same input into the analysis output dir,
+    in a thread, instead of running the pipeline. Files named with the previous run ID (the trace, nextflow
+    report and timeline, and run summaries) are renamed with the new run ID, so that trace ingestion and
+    transfers find them under the names they would have had if the pipeline had run.
+    """
+    def __init__(self, previous_output_dir: str, outdir: str, mode: str, stderr_path: str, previous_run_id: str, run_id: str):
+        self.job_id = 'reuse'
+        self.previous_output_dir = previous_output_dir
+        self.previous_run_id = previous_run_id
+        self.run_id = run_id
+        self.outdir = outdir
+        self.mode = mode
+        self.stderr_path = stderr_path
+        self.returncode = None
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.reuse_outputs, daemon=True)
+        self.thread.start()
+
+
+    def copy_file(self, src: str, dst: str):
+        if self.cancelled:
+            raise ReuseCancelled()
+        name = os.path.basename(dst)
+        if name.startswith(self.previous_run_id):
+            name = self.run_id + name[len(self.previous_run_id):]
+            dst = os.path.join(os.path.dirname(dst), name)
+        is_rewritten = name in REWRITTEN_FILENAMES or name.endswith(REWRITTEN_FILENAME_SUFFIXES)
+        if self.mode == 'link' and not is_rewritten:
+            try:
+                os.link(src, dst)
+                return
+            except OSError as e:
+                # Hard links can't cross filesystems.
+                pass
+        shutil.copy2(src, dst)
+
+
+    def get_not_reused_filenames(self, d: str, names: list[str]) -> list[str]:
+        if d != self.previous_output_dir:
+            return []
+
+        return [name for name in names if name in NOT_REUSED_FILENAMES or name.startswith(nextflow_output.LOG_FILENAME_PREFIXES)]
+
+
+    def reuse_outputs(self):
+        try:
+            shutil.copytree(
+                self.previous_output_dir,
+                self.outdir,
+                copy_function=self.copy_file,
+                ignore=self.get_not_reused_filenames,
+                dirs_exist_ok=True,
+            )
+            self.returncode = 0
+        except ReuseCancelled as e:
+            self.returncode = -signal.SIGTERM
+        except (OSError, shutil.Error) as e:
+            with open(self.stderr_path, 'a') as f:
+                f.write('ERROR ~ Failed to reuse outputs of ' + self.previous_output_dir + ': ' + str(e) + '\n')
+            self.returncode = 1
+
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+
+    def wait(self) -> int:
+        self.thread.join()
+
+        return self.returncode
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ReuseExecutor:
+    """
+    Used in place of the pipeline's executor when an earlier analysis of the same input, by the same
+    pipeline, is found in the run state store (see `auto_hcv.scheduler.AnalysisScheduler.enqueue`).
+    """
+    name = 'reuse'
+
+    def __init__(self, previous_analysis: dict[str, object], mode: str=DEFAULT_REUSE_MODE):
+        self.previous_analysis = previous_analysis
+        self.mode = mode
+
+
+    def launch(self, command: list[str], cwd: str, stdout_path: str, stderr_path: str, trace_path: Optional[str]=None, stderr_tail_lines: int=nextflow_output.DEFAULT_STDERR_TAIL_LINES):
+        """
+        Start reusing the previous analysis's outputs. See `auto_hcv.executor.LocalExecutor.launch`.
+        The outputs go to the command's `--outdir`, renamed for the run in the command's `--prefix`.
+
+        :rtype: tuple[ReuseJob, auto_hcv.nextflow_output.NextflowLogCapture]
+        """
+        outdir = command[command.index('--outdir') + 1]
+        for log_path in [stdout_path, stderr_path]:
+            open(log_path, 'w').close()
+        run_id = command[command.index('--prefix') + 1]
+        job = ReuseJob(self.previous_analysis['analysis_pipeline_output_dir'], outdir, self.mode, stderr_path, self.previous_analysis['run_id'], run_id)
+        # The reused trace is renamed to `trace_path`, so its tasks are counted as progress.
+        output_capture = nextflow_output.NextflowLogCapture(job, stdout_path, stderr_path, trace_path=trace_path, stderr_tail_lines=stderr_tail_lines)
+
+        return job, output_capture
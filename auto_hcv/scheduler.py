@@ -0,0 +1,515 @@
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import time
+
+from typing import Optional
+
+import auto_hcv.config
+import auto_hcv.core as core
+import auto_hcv.metrics as metrics
+import auto_hcv.post_analysis as post_analysis
+import auto_hcv.priority as priority
+import auto_hcv.reuse as reuse
+import auto_hcv.state as state
+
+DEFAULT_MAX_CONCURRENT_ANALYSES = 1
+
+
+def get_analysis_key(run: dict[str, object], pipeline: dict[str, object]) -> tuple[str, str, str]:
+    """
+    Get a key that uniquely identifies the analysis of a sequencing run by a pipeline.
+
+    :param run: Run, as yielded by `core.scan`.
+    :type run: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: (run_id, pipeline_name, pipeline_version)
+    :rtype: tuple[str, str, str]
+    """
+    return (run['run_id'], pipeline['pipeline_name'], pipeline['pipeline_version'])
+
+
+class AnalysisScheduler:
+    """
+    Runs several analyses at once, without blocking the daemon while they run.
+
+    Runs are submitted to the scheduler as they are found by `core.scan`. Each call to `poll` collects the
+    results of any pipelines that have exited and starts queued analyses, while keeping the number of
+    running analyses within the `max_concurrent_analyses` limit from the application config, and within
+    the (optional) `max_concurrent_analyses` limit from each pipeline's config.
+
+    Pipelines that depend on other pipelines (through their `dependencies` config) wait until all of their
+    upstream analyses of the same run have finished, and are then queued right away, so that a run moves
+    through the whole dependency graph within a single scan. Analyses that don't depend on one another
+    run in parallel.
+
+    Queued analyses are started in order of priority (see `get_priority`), and in the order that they
+    were queued when their priorities are equal.
+
+    If a run state store is provided, the status of each analysis is recorded in it as the analysis progresses.
+    If a work dir cleaner is provided, the work dirs of completed analyses are deleted in the background.
+    If an admission controller is provided, queued analyses are only started when there is enough free disk,
+    memory and CPU for them (see `auto_hcv.admission`). With a run state store, an analysis of an input that has
+    already been analyzed by the same pipeline reuses the earlier outputs (see `find_reusable_analysis`).
+
+    Post-analysis tasks are run by `reap` itself, unless a `post_analysis_handler` is set, in which case each analysis
+    that completed successfully is passed to it, and the handler is responsible for calling `run_post_analysis`
+    (for example, from a worker, so that slow transfers don't hold up starting new analyses; see `auto_hcv.daemon`).
+    """
+    def __init__(self, run_state=None, cleaner=None, admission_controller=None):
+        self.waiting = []
+        self.queued = collections.deque()
+        self.running = {}
+        self.run_state = run_state
+        self.cleaner = cleaner
+        self.admission_controller = admission_controller
+        self.post_analysis_handler = None
+        self.sequence = itertools.count()
+        self.priority_overrides = priority.PriorityOverrides(None)
+
+
+    def record_analysis_status(self, analysis: dict[str, object], status: str):
+        """
+        Record the status of an analysis in the run state store (if there is one).
+
+        :param analysis: Analysis, as returned by `core.prepare_analysis`.
+        :type analysis: dict[str, object]
+        :param status: Analysis status.
+        :type status: str
+        :return: None
+        :rtype: NoneType
+        """
+        if self.run_state is None:
+            return
+        self.run_state.set_analysis_status(analysis['config'], analysis['sequencing_run_id'], analysis['pipeline'], status, analysis['analysis_pipeline_output_dir'])
+
+
+    def is_idle(self) -> bool:
+        """
+        :return: Whether or not there are no analyses running or waiting to be started.
+        :rtype: bool
+        """
+        return len(self.running) == 0 and len(self.queued) == 0 and len(self.waiting) == 0
+
+
+    def is_scheduled(self, key: tuple[str, str, str]) -> bool:
+        """
+        :param key: Analysis key, as returned by `get_analysis_key`.
+        :type key: tuple[str, str, str]
+        :return: Whether or not the analysis is already waiting, queued or running.
+        :rtype: bool
+        """
+        if key in self.running:
+            return True
+        if any(analysis['key'] == key for analysis in self.queued):
+            return True
+        if any(analysis['key'] == key for analysis in self.waiting):
+            return True
+
+        return False
+
+
+    def enqueue(self, config: dict[str, object], pipeline: dict[str, object], run: dict[str, object]) -> bool:
+        """
+        Prepare an analysis and add it to the queue, unless it should be skipped.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param pipeline: Pipeline config.
+        :type pipeline: dict[str, object]
+        :param run: Run, as yielded by `core.scan`.
+        :type run: dict[str, object]
+        :return: Whether or not the analysis was queued.
+        :rtype: bool
+        """
+        analysis = core.prepare_analysis(config, pipeline, run)
+        if analysis is None:
+            return False
+        analysis['key'] = get_analysis_key(run, pipeline)
+        analysis['config'] = config
+        self.find_reusable_analysis(config, analysis)
+        analysis['base_priority'] = priority.get_base_priority(config, run)
+        analysis['sequence'] = next(self.sequence)
+        self.queued.append(analysis)
+        logging.info(json.dumps({
+            "event_type": "analysis_queued",
+            "sequencing_run_id": run['run_id'],
+            "pipeline_name": pipeline['pipeline_name'],
+            "pipeline_version": pipeline['pipeline_version'],
+            "priority": self.get_priority(config, analysis),
+            "num_analyses_queued": len(self.queued),
+        }))
+
+        return True
+
+
+    def find_reusable_analysis(self, config: dict[str, object], analysis: dict[str, object]):
+        """
+        If `input_reuse` is enabled, fingerprint the analysis's input (see `auto_hcv.reuse.get_input_fingerprint`;
+        fingerprints are cached in the run state store) and store it in the analysis as `input_fingerprint`, along
+        with its `reuse_key`, then look up the `reuse_key` in the run state store. If the same input has already been
+        analyzed by the same pipeline (under another run ID), and that analysis is still complete, the analysis is
+        changed to reuse its outputs (see `auto_hcv.reuse.ReuseExecutor`) instead of running the pipeline. Retries
+        are never reused.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param analysis: Analysis, as returned by `core.prepare_analysis`.
+        :type analysis: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        if self.run_state is None or not (config.get('input_reuse', None) or {}).get('enabled', False):
+            return
+        input_fingerprint = reuse.get_input_fingerprint(self.run_state, analysis['run'])
+        if input_fingerprint is None:
+            return
+        analysis['input_fingerprint'] = input_fingerprint
+        analysis['reuse_key'] = reuse.get_reuse_key(analysis['pipeline'], input_fingerprint)
+        if analysis.get('attempt', 1) > 1:
+            return
+        previous_analysis = self.run_state.find_analysis_input(analysis['reuse_key'])
+        if previous_analysis is None or previous_analysis['run_id'] == analysis['sequencing_run_id']:
+            return
+        if not os.path.exists(os.path.join(previous_analysis['analysis_pipeline_output_dir'], 'analysis_complete.json')):
+            return
+        analysis['reused_analysis'] = previous_analysis
+        analysis['executor'] = reuse.ReuseExecutor(previous_analysis, reuse.get_reuse_mode(config))
+        analysis['shards'] = None
+        logging.info(json.dumps({
+            "event_type": "analysis_input_already_analyzed",
+            "sequencing_run_id": analysis['sequencing_run_id'],
+            "pipeline_name": analysis['pipeline']['pipeline_name'],
+            "pipeline_version": analysis['pipeline']['pipeline_version'],
+            "input_fingerprint": analysis['input_fingerprint'],
+            "previous_sequencing_run_id": previous_analysis['run_id'],
+            "previous_analysis_pipeline_output_dir": previous_analysis['analysis_pipeline_output_dir'],
+        }))
+
+
+    def submit_run(self, config: dict[str, object], run: dict[str, object]) -> int:
+        """
+        Queue an analysis of the run for each of the configured pipelines. Analyses that are already
+        scheduled are not queued again. Analyses that depend on upstream analyses of this run that
+        are still scheduled will wait until those have finished.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param run: Run, as yielded by `core.scan`.
+        :type run: dict[str, object]
+        :return: Number of analyses queued or waiting.
+        :rtype: int
+        """
+        num_scheduled = 0
+        # Pipelines are sorted by dependencies when the config is loaded, so upstream
+        # analyses are always scheduled before the analyses that depend on them.
+        for pipeline in config['pipelines']:
+            key = get_analysis_key(run, pipeline)
+            if self.is_scheduled(key):
+                continue
+            dependencies = pipeline.get('dependencies', None) or []
+            upstream_keys = [(run['run_id'],) + auto_hcv.config.get_pipeline_key(dependency) for dependency in dependencies]
+            pending_upstream_keys = [upstream_key for upstream_key in upstream_keys if self.is_scheduled(upstream_key)]
+            if len(pending_upstream_keys) > 0:
+                self.waiting.append({
+                    "key": key,
+                    "config": config,
+                    "pipeline": pipeline,
+                    "run": run,
+                    "upstream_keys": upstream_keys,
+                })
+                num_scheduled += 1
+                logging.info(json.dumps({
+                    "event_type": "analysis_waiting_for_dependencies",
+                    "sequencing_run_id": run['run_id'],
+                    "pipeline_name": pipeline['pipeline_name'],
+                    "pipeline_version": pipeline['pipeline_version'],
+                    "pending_dependencies": [{"pipeline_name": k[1], "pipeline_version": k[2]} for k in pending_upstream_keys],
+                }))
+            elif self.enqueue(config, pipeline, run):
+                num_scheduled += 1
+
+        # If there was nothing to do for this run, its analyses were all started before
+        # (possibly before the run state store existed), so bring its status up to date.
+        if num_scheduled == 0 and self.run_state is not None:
+            core.refresh_run_state(config, self.run_state, run['run_id'])
+
+        return num_scheduled
+
+
+    def release_waiting(self) -> int:
+        """
+        Queue any waiting analyses whose upstream analyses are no longer scheduled. Whether or not the upstream
+        analyses succeeded is checked when the analysis is prepared, so an analysis whose dependencies
+        failed will be skipped.
+
+        :return: Number of analyses released from waiting.
+        :rtype: int
+        """
+        ready = []
+        still_waiting = []
+        for waiting_analysis in self.waiting:
+            if any(self.is_scheduled(upstream_key) for upstream_key in waiting_analysis['upstream_keys']):
+                still_waiting.append(waiting_analysis)
+            else:
+                ready.append(waiting_analysis)
+        self.waiting = still_waiting
+        for waiting_analysis in ready:
+            self.enqueue(waiting_analysis['config'], waiting_analysis['pipeline'], waiting_analysis['run'])
+
+        return len(ready)
+
+
+    def count_running(self, pipeline: dict[str, object]) -> int:
+        """
+        :param pipeline: Pipeline config.
+        :type pipeline: dict[str, object]
+        :return: Number of running analyses for the pipeline.
+        :rtype: int
+        """
+        num_running = 0
+        for analysis in self.running.values():
+            if analysis['pipeline']['pipeline_name'] == pipeline['pipeline_name'] and analysis['pipeline']['pipeline_version'] == pipeline['pipeline_version']:
+                num_running += 1
+
+        return num_running
+
+
+    def cancel(self, key: tuple[str, str, str]) -> bool:
+        """
+        Cancel a running analysis, through its executor. The analysis is finished (as a failure) by
+        the next call to `reap`, once its executor reports that the pipeline has exited.
+
+        :param key: Analysis key, from `get_analysis_key`.
+        :type key: tuple[str, str, str]
+        :return: Whether or not the analysis was running.
+        :rtype: bool
+        """
+        analysis = self.running.get(key, None)
+        if analysis is None:
+            return False
+        logging.warning(json.dumps({"event_type": "analysis_cancelled", "sequencing_run_id": analysis['sequencing_run_id'], "pipeline_name": analysis['pipeline']['pipeline_name'], "job_id": analysis['process'].job_id}))
+        analysis['process'].cancel()
+
+        return True
+
+
+    def run_post_analysis(self, analysis: dict[str, object]):
+        """
+        Run the post-analysis tasks (see `auto_hcv.post_analysis`) for an analysis that completed successfully.
+
+        :param analysis: Analysis that completed.
+        :type analysis: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        # Put any logic/actions you need to perform after running this pipeline here.
+        post_analysis.post_analysis(analysis['config'], analysis['pipeline'], analysis['run'], analysis_work_dir=analysis['analysis_work_dir'], cleaner=self.cleaner, input_bytes=analysis.get('input_bytes', None), reused=analysis.get('reused_analysis', None) is not None)
+        self.record_analysis_status(analysis, state.RUN_STATUS_REPORTED)
+
+
+    def reap(self, max_finished: Optional[int]=None) -> int:
+        """
+        Check all running analyses (without waiting), and finish any whose pipeline process has exited.
+        Progress is logged for analyses that are still running, and post-analysis tasks are run (or passed to
+        the `post_analysis_handler`) for each analysis that completed successfully.
+
+        :param max_finished: Finish at most this many analyses. The rest are finished by a later call.
+        :type max_finished: Optional[int]
+        :return: Number of analyses finished.
+        :rtype: int
+        """
+        finished_keys = []
+        for key, analysis in self.running.items():
+            if max_finished is not None and len(finished_keys) >= max_finished:
+                break
+            returncode = analysis['process'].poll()
+            if returncode is not None:
+                finished_keys.append(key)
+            else:
+                analysis['output_capture'].log_progress(analysis)
+        for key in finished_keys:
+            analysis = self.running.pop(key)
+            analysis_succeeded = core.finish_analysis(analysis['config'], analysis, analysis['process'].returncode)
+            pipeline_labels = {'pipeline_name': analysis['pipeline']['pipeline_name'], 'pipeline_version': analysis['pipeline']['pipeline_version']}
+            metrics.ANALYSIS_DURATION_SECONDS.observe(time.monotonic() - analysis['launch_time'], **pipeline_labels)
+            if not analysis_succeeded:
+                metrics.ANALYSES_FAILED.inc(**pipeline_labels)
+                self.record_analysis_status(analysis, state.RUN_STATUS_FAILED)
+                continue
+            metrics.ANALYSES_COMPLETED.inc(**pipeline_labels)
+            self.record_analysis_status(analysis, state.RUN_STATUS_COMPLETE)
+            if analysis.get('reused_analysis', None) is not None:
+                metrics.ANALYSES_REUSED.inc(**pipeline_labels)
+            elif self.run_state is not None and analysis.get('reuse_key', None) is not None:
+                self.run_state.record_analysis_input(analysis['reuse_key'], analysis['input_fingerprint'], analysis['sequencing_run_id'], analysis['pipeline'], analysis['analysis_pipeline_output_dir'])
+            if self.post_analysis_handler is not None:
+                self.post_analysis_handler(analysis)
+            else:
+                self.run_post_analysis(analysis)
+
+        return len(finished_keys)
+
+
+    def get_priority(self, config: dict[str, object], analysis: dict[str, object], today: Optional[datetime.date]=None) -> float:
+        """
+        Get the current priority of a queued analysis: its base priority (from the `run_priority.rules` that its
+        run matches, and the `priority` in its `symlinks_complete.json`), plus the priority its run has gained
+        with age, plus any adjustment from the priority control file.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param analysis: Queued analysis.
+        :type analysis: dict[str, object]
+        :param today: Today's date.
+        :type today: Optional[datetime.date]
+        :return: Priority. Higher priorities are started first.
+        :rtype: float
+        """
+        run_id = analysis['sequencing_run_id']
+
+        return analysis['base_priority'] + priority.get_age_priority(config, run_id, today) + self.priority_overrides.get(run_id)
+
+
+    def refresh_priority_overrides(self, config: dict[str, object]):
+        """
+        Re-read the priority control file (`run_priority.control_file`) if it (or its path in the config) has changed.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        run_priority_config = config.get('run_priority', None) or {}
+        control_file_path = run_priority_config.get('control_file', None)
+        if control_file_path != self.priority_overrides.control_file_path:
+            self.priority_overrides = priority.PriorityOverrides(control_file_path)
+        self.priority_overrides.refresh()
+
+
+    def log_held(self, analysis: dict[str, object], shortages: list[dict[str, object]]):
+        """
+        Log an `analysis_held` event for an analysis that can't be started because resources are short.
+        The event is only logged when the set of resources that are short changes, not on every poll.
+
+        :param analysis: Queued analysis.
+        :type analysis: dict[str, object]
+        :param shortages: Resources that are short, as returned by `auto_hcv.admission.AdmissionController.check`.
+        :type shortages: list[dict[str, object]]
+        :return: None
+        :rtype: NoneType
+        """
+        held_resources = sorted(shortage['resource'] for shortage in shortages)
+        if held_resources == analysis.get('held_resources', None):
+            return
+        analysis['held_resources'] = held_resources
+        for resource in held_resources:
+            metrics.ANALYSES_HELD.inc(resource=resource)
+        logging.warning(json.dumps({
+            "event_type": "analysis_held",
+            "sequencing_run_id": analysis['sequencing_run_id'],
+            "pipeline_name": analysis['pipeline']['pipeline_name'],
+            "pipeline_version": analysis['pipeline']['pipeline_version'],
+            "shortages": shortages,
+            "num_analyses_running": len(self.running),
+        }))
+
+
+    def launch(self, config: dict[str, object]) -> int:
+        """
+        Start queued analyses, in order of priority, until there are no free slots.
+        Analyses whose pipeline has no free slots stay in the queue.
+
+        If there aren't enough resources to start an analysis, it is held in the queue (and the reason is logged),
+        along with every analysis after it, so that smaller runs can't keep a large run from ever starting.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: Number of analyses started.
+        :rtype: int
+        """
+        max_concurrent_analyses = int(config.get('max_concurrent_analyses', DEFAULT_MAX_CONCURRENT_ANALYSES))
+        num_started = 0
+        self.refresh_priority_overrides(config)
+        today = datetime.date.today()
+        self.queued = collections.deque(sorted(self.queued, key=lambda a: (-self.get_priority(config, a, today), a['sequence'])))
+        still_queued = collections.deque()
+        held = False
+        while len(self.queued) > 0:
+            analysis = self.queued.popleft()
+            pipeline = analysis['pipeline']
+            pipeline_max_concurrent_analyses = pipeline.get('max_concurrent_analyses', None)
+            no_free_slots = len(self.running) >= max_concurrent_analyses
+            no_free_pipeline_slots = pipeline_max_concurrent_analyses is not None and self.count_running(pipeline) >= int(pipeline_max_concurrent_analyses)
+            if held or no_free_slots or no_free_pipeline_slots:
+                still_queued.append(analysis)
+                continue
+            # Reused analyses only link or copy outputs, so they don't need room for a work dir.
+            if self.admission_controller is not None and analysis.get('reused_analysis', None) is None:
+                shortages = self.admission_controller.check(config, analysis, list(self.running.values()))
+                if len(shortages) > 0:
+                    held = True
+                    still_queued.append(analysis)
+                    self.log_held(analysis, shortages)
+                    continue
+                analysis.pop('held_resources', None)
+            try:
+                analysis['process'] = core.start_analysis(analysis)
+            except OSError as e:
+                logging.error(json.dumps({"event_type": "analysis_failed", "sequencing_run_id": analysis['sequencing_run_id'], "pipeline_command": " ".join(analysis['pipeline_command']), "error": str(e)}))
+                # The attempt is recorded as failed, so that it can be retried rather than being taken for one that is still running.
+                core.record_launch_failure(analysis, str(e))
+                metrics.ANALYSES_FAILED.inc(pipeline_name=pipeline['pipeline_name'], pipeline_version=pipeline['pipeline_version'])
+                self.record_analysis_status(analysis, state.RUN_STATUS_FAILED)
+                continue
+            analysis['launch_time'] = time.monotonic()
+            self.running[analysis['key']] = analysis
+            metrics.ANALYSES_STARTED.inc(pipeline_name=pipeline['pipeline_name'], pipeline_version=pipeline['pipeline_version'])
+            logging.debug(json.dumps({"event_type": "analysis_launched", "sequencing_run_id": analysis['sequencing_run_id'], "pipeline_name": pipeline['pipeline_name'], "priority": self.get_priority(config, analysis, today)}))
+            self.record_analysis_status(analysis, state.RUN_STATUS_STARTED)
+            num_started += 1
+        self.queued = still_queued
+
+        return num_started
+
+
+    def poll(self, config: dict[str, object], launch_new_analyses: bool=True, max_finished: Optional[int]=None):
+        """
+        Finish any analyses that have exited, queue the analyses that were waiting on them, then
+        (optionally) start queued analyses in the free slots.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param launch_new_analyses: Whether or not to start queued analyses. When shutting down, in-flight analyses are drained without starting new ones.
+        :type launch_new_analyses: bool
+        :param max_finished: Finish at most this many analyses (see `reap`).
+        :type max_finished: Optional[int]
+        :return: None
+        :rtype: NoneType
+        """
+        self.reap(max_finished=max_finished)
+        self.release_waiting()
+        if launch_new_analyses:
+            self.launch(config)
+        self.update_metrics(config)
+
+
+    def update_metrics(self, config: dict[str, object]):
+        """
+        Update the queue depth and running analysis metrics.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        metrics.ANALYSES_WAITING.set(len(self.waiting))
+        metrics.ANALYSES_QUEUED.set(len(self.queued))
+        pipelines = list(config.get('pipelines', []))
+        pipelines += [analysis['pipeline'] for analysis in self.running.values()]
+        for pipeline in pipelines:
+            metrics.ANALYSES_RUNNING.set(self.count_running(pipeline), pipeline_name=pipeline['pipeline_name'], pipeline_version=pipeline['pipeline_version'])
@@ -0,0 +1,354 @@
+import json
+import logging
+import os
+import re
+import shutil
+
+from typing import Optional
+
+import auto_hcv.nextflow_output as nextflow_output
+
+SHARDS_DIR_NAME = 'shards'
+
+# Illumina-style fastq names (`<sample>_S1_L001_R1_001.fastq.gz`), and simpler ones (`<sample>_R1.fastq.gz`)
+FASTQ_FILENAME_REGEX = re.compile(r'^(?P<sample>.+?)(_S\d+)?(_L\d{3})?_(?P<read>R[12])(_001)?\.f(ast)?q(\.gz)?$')
+
+# Flags in the pipeline command whose values are paths that each shard needs its own copy of
+SHARD_PATH_FLAGS = ['-log', '-work-dir', '-with-report', '-with-trace', '-with-timeline', '--outdir']
+
+
+def find_fastq_samples(fastq_input_dir: str) -> dict[str, list[str]]:
+    """
+    Group the fastq files in a run's fastq directory by sample.
+
+    :param fastq_input_dir: Run fastq directory.
+    :type fastq_input_dir: str
+    :return: Map from sample name to the paths of its fastq files.
+    :rtype: dict[str, list[str]]
+    """
+    samples = {}
+    for entry in sorted(os.scandir(fastq_input_dir), key=lambda e: e.name):
+        match = FASTQ_FILENAME_REGEX.match(entry.name)
+        if match is None:
+            continue
+        samples.setdefault(match.group('sample'), []).append(os.path.abspath(entry.path))
+
+    return samples
+
+
+def split_samples_into_shards(samples: dict[str, list[str]], num_shards: int) -> list[list[str]]:
+    """
+    Split samples into shards of roughly equal total input size. Samples are assigned largest-first,
+    each to the shard with the least input so far.
+
+    :param samples: Map from sample name to the paths of its fastq files, as returned by `find_fastq_samples`.
+    :type samples: dict[str, list[str]]
+    :param num_shards: Number of shards.
+    :type num_shards: int
+    :return: Sample names in each shard. Empty shards are dropped.
+    :rtype: list[list[str]]
+    """
+    sample_sizes = {}
+    for sample_name, fastq_paths in samples.items():
+        sample_sizes[sample_name] = sum(os.stat(path).st_size for path in fastq_paths)
+    shards = [[] for _ in range(num_shards)]
+    shard_sizes = [0] * num_shards
+    for sample_name in sorted(sample_sizes, key=lambda s: (-sample_sizes[s], s)):
+        smallest_shard = shard_sizes.index(min(shard_sizes))
+        shards[smallest_shard].append(sample_name)
+        shard_sizes[smallest_shard] += sample_sizes[sample_name]
+
+    return [sorted(shard) for shard in shards if len(shard) > 0]
+
+
+def get_shard_command(pipeline_command: list[str], fastq_input_flag: str, shard: dict[str, object]) -> list[str]:
+    """
+    Adapt the pipeline command for an analysis to run on one shard: the shard reads from its own input dir,
+    and writes its outputs, work dir, report, trace, timeline and log under the shard dir.
+
+    :param pipeline_command: Pipeline command for the whole run.
+    :type pipeline_command: list[str]
+    :param fastq_input_flag: Flag that the fastq input dir is passed with (for example, `--fastq_input`).
+    :type fastq_input_flag: str
+    :param shard: Shard, as built by `plan_shards`.
+    :type shard: dict[str, object]
+    :return: Pipeline command for the shard.
+    :rtype: list[str]
+    """
+    shard_command = list(pipeline_command)
+    for i, arg in enumerate(shard_command[:-1]):
+        value = shard_command[i + 1]
+        if arg == fastq_input_flag:
+            shard_command[i + 1] = shard['input_dir']
+        elif arg == '--outdir':
+            shard_command[i + 1] = shard['output_dir']
+        elif arg == '-work-dir':
+            shard_command[i + 1] = shard['work_dir']
+        elif arg in SHARD_PATH_FLAGS:
+            shard_command[i + 1] = os.path.join(shard['output_dir'], os.path.basename(value))
+
+    return shard_command
+
+
+def plan_shards(pipeline: dict[str, object], run: dict[str, object], analysis_work_dir: str, pipeline_command: list[str]) -> Optional[list[dict[str, object]]]:
+    """
+    Decide how to split the analysis of a run into shards, using the pipeline's `num_shards` config.
+    Each shard has its own dir under `<analysis_work_dir>/shards/`, which is also its nextflow launch dir.
+    The plan only depends on the run's fastq files, so a retry of the analysis gets the same shards and can resume them.
+
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param run: Run, as yielded by `auto_hcv.core.scan`.
+    :type run: dict[str, object]
+    :param analysis_work_dir: Work dir for the analysis.
+    :type analysis_work_dir: str
+    :param pipeline_command: Pipeline command for the whole run.
+    :type pipeline_command: list[str]
+    :return: Shards (with keys `shard_index`, `samples`, `fastq_paths`, `shard_dir`, `input_dir`, `output_dir`, `work_dir` and `pipeline_command`), or None if the run shouldn't be sharded.
+    :rtype: Optional[list[dict[str, object]]]
+    """
+    num_shards = int(pipeline.get('num_shards', 1) or 1)
+    fastq_input_dir = run['analysis_parameters'].get('fastq_input', None)
+    if num_shards < 2 or fastq_input_dir is None:
+        return None
+    samples = find_fastq_samples(fastq_input_dir)
+    sample_shards = split_samples_into_shards(samples, num_shards)
+    if len(sample_shards) < 2:
+        return None
+    shards = []
+    for shard_index, shard_samples in enumerate(sample_shards):
+        shard_dir = os.path.join(analysis_work_dir, SHARDS_DIR_NAME, 'shard-' + str(shard_index))
+        shard = {
+            "shard_index": shard_index,
+            "samples": shard_samples,
+            "fastq_paths": [path for sample_name in shard_samples for path in samples[sample_name]],
+            "shard_dir": shard_dir,
+            "input_dir": os.path.join(shard_dir, 'input'),
+            "output_dir": os.path.join(shard_dir, 'output'),
+            "work_dir": os.path.join(shard_dir, 'work'),
+        }
+        shard['pipeline_command'] = get_shard_command(pipeline_command, '--fastq_input', shard)
+        shards.append(shard)
+
+    return shards
+
+
+def create_shard_input_dir(shard: dict[str, object]):
+    """
+    Create the shard's input dir, with a symlink to each of the shard's fastq files.
+    Symlinks that already exist (from a previous attempt) are kept.
+
+    :param shard: Shard, as built by `plan_shards`.
+    :type shard: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    os.makedirs(shard['input_dir'], exist_ok=True)
+    os.makedirs(shard['output_dir'], exist_ok=True)
+    for fastq_path in shard['fastq_paths']:
+        link_path = os.path.join(shard['input_dir'], os.path.basename(fastq_path))
+        if not os.path.lexists(link_path):
+            os.symlink(fastq_path, link_path)
+
+
+class ShardedProcess:
+    """
+    The pipeline jobs for all of the shards of an analysis (see `auto_hcv.executor`), presented as a single job: it has
+    exited once every shard has exited, and its return code is the first non-zero return code of any shard.
+    """
+    def __init__(self, processes: list):
+        self.processes = processes
+        self.returncode = None
+
+
+    @property
+    def job_id(self) -> str:
+        return ','.join(process.job_id for process in self.processes)
+
+
+    def poll(self) -> Optional[int]:
+        returncodes = [process.poll() for process in self.processes]
+        if any(returncode is None for returncode in returncodes):
+            return None
+        failed_returncodes = [returncode for returncode in returncodes if returncode != 0]
+        self.returncode = failed_returncodes[0] if len(failed_returncodes) > 0 else 0
+
+        return self.returncode
+
+
+    def wait(self) -> int:
+        for process in self.processes:
+            process.wait()
+
+        return self.poll()
+
+
+    def cancel(self):
+        for process in self.processes:
+            process.cancel()
+
+
+class ShardedOutputCapture:
+    """
+    Combines the output captures of all of the shards of an analysis, with the same interface as
+    `auto_hcv.nextflow_output.NextflowOutputCapture`. Progress counts are summed over the shards.
+    """
+    def __init__(self, captures: list[nextflow_output.NextflowOutputCapture]):
+        self.captures = captures
+        self.last_logged_counts = None
+
+
+    @property
+    def failed_process(self) -> Optional[str]:
+        failed_processes = [capture.failed_process for capture in self.captures if capture.failed_process is not None]
+        if len(failed_processes) == 0:
+            return None
+
+        return failed_processes[0]
+
+
+    def get_progress(self) -> dict[str, int]:
+        progress = {}
+        for capture in self.captures:
+            for key, count in capture.get_progress().items():
+                progress[key] = progress.get(key, 0) + count
+
+        return progress
+
+
+    def log_progress(self, analysis: dict[str, object], force: bool=False):
+        progress = self.get_progress()
+        if progress == self.last_logged_counts and not force:
+            return
+        self.last_logged_counts = progress
+        logging.info(json.dumps(dict({
+            "event_type": "analysis_progress",
+            "sequencing_run_id": analysis['sequencing_run_id'],
+            "pipeline_name": analysis['pipeline']['pipeline_name'],
+            "pipeline_version": analysis['pipeline']['pipeline_version'],
+            "num_shards": len(self.captures),
+        }, **progress)))
+
+
+    def get_stderr_tail(self) -> list[str]:
+        """
+        :return: The last lines written to stderr by each shard whose process failed, prefixed with the shard index.
+        :rtype: list[str]
+        """
+        stderr_tail = []
+        for shard_index, capture in enumerate(self.captures):
+            if capture.process.returncode in [None, 0]:
+                continue
+            stderr_tail += ['[shard-' + str(shard_index) + '] ' + line for line in capture.get_stderr_tail()]
+
+        return stderr_tail
+
+
+    def join(self, timeout: float=nextflow_output.READER_JOIN_TIMEOUT_SECONDS):
+        for capture in self.captures:
+            capture.join(timeout)
+
+
+def start_shards(analysis: dict[str, object]) -> ShardedProcess:
+    """
+    Start the pipeline for each shard of an analysis, with the analysis's executor. The capture of the shards' output
+    is stored in the analysis as `output_capture`.
+
+    :param analysis: Analysis, as returned by `auto_hcv.core.prepare_analysis`, with `shards`.
+    :type analysis: dict[str, object]
+    :return: The running pipeline jobs.
+    :rtype: ShardedProcess
+    :raises OSError: If a shard couldn't be launched. Shards that were already launched are cancelled.
+    """
+    processes = []
+    captures = []
+    for shard in analysis['shards']:
+        create_shard_input_dir(shard)
+        logging.info(json.dumps({"event_type": "analysis_shard_started", "sequencing_run_id": analysis['sequencing_run_id'], "shard_index": shard['shard_index'], "num_samples": len(shard['samples']), "pipeline_command": " ".join(shard['pipeline_command'])}))
+        try:
+            process, capture = analysis['executor'].launch(
+                shard['pipeline_command'],
+                shard['shard_dir'],
+                os.path.join(analysis['analysis_pipeline_output_dir'], 'nextflow_stdout.shard-' + str(shard['shard_index']) + '.log'),
+                os.path.join(analysis['analysis_pipeline_output_dir'], 'nextflow_stderr.shard-' + str(shard['shard_index']) + '.log'),
+                trace_path=os.path.join(shard['output_dir'], os.path.basename(analysis['analysis_trace_path'])),
+                stderr_tail_lines=analysis.get('stderr_tail_lines', nextflow_output.DEFAULT_STDERR_TAIL_LINES),
+            )
+        except OSError as e:
+            for process in processes:
+                process.cancel()
+            raise
+        processes.append(process)
+        captures.append(capture)
+    analysis['output_capture'] = ShardedOutputCapture(captures)
+
+    return ShardedProcess(processes)
+
+
+def append_table(src_path: str, dest_path: str, shard_index: int):
+    """
+    Append the rows of a CSV or TSV file (without its header) to another file with the same columns.
+    nextflow task IDs are only unique within a shard, so the `task_id` column (if any) is prefixed with the shard index.
+
+    :param src_path: File to append.
+    :type src_path: str
+    :param dest_path: File to append to.
+    :type dest_path: str
+    :param shard_index: Index of the shard that `src_path` came from.
+    :type shard_index: int
+    :return: None
+    :rtype: NoneType
+    """
+    delimiter = '\t' if src_path.endswith('.tsv') else ','
+    with open(src_path, 'r') as src, open(dest_path, 'a') as dest:
+        header = src.readline()
+        prefix_task_id = header.split(delimiter)[0].strip() == 'task_id'
+        for line in src:
+            if prefix_task_id:
+                line = str(shard_index) + '.' + line
+            dest.write(line)
+
+
+def merge_shard_output(src_dir: str, dest_dir: str, shard_index: int):
+    """
+    Merge the output of one shard into the analysis output dir. Files and dirs that only one shard produced
+    (such as each sample's output dir) are moved into place. Dirs that several shards produced are merged,
+    CSV and TSV files that several shards produced are concatenated, and any other files that clash are kept
+    with a `.shard-<n>` suffix. The shard output dir is in the work dir, which is often on a different filesystem
+    from the analysis output dir, so files are moved with `shutil.move` (which copies them, if they can't be renamed).
+
+    :param src_dir: Shard output dir (or a dir inside it).
+    :type src_dir: str
+    :param dest_dir: Analysis output dir (or the matching dir inside it).
+    :type dest_dir: str
+    :param shard_index: Index of the shard.
+    :type shard_index: int
+    :return: None
+    :rtype: NoneType
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    for entry in os.scandir(src_dir):
+        dest_path = os.path.join(dest_dir, entry.name)
+        if not os.path.lexists(dest_path):
+            shutil.move(entry.path, dest_path)
+        elif entry.is_dir(follow_symlinks=False) and os.path.isdir(dest_path):
+            merge_shard_output(entry.path, dest_path, shard_index)
+        elif entry.name.endswith('.csv') or entry.name.endswith('.tsv'):
+            append_table(entry.path, dest_path, shard_index)
+        else:
+            shutil.move(entry.path, dest_path + '.shard-' + str(shard_index))
+
+
+def merge_shards(analysis: dict[str, object]):
+    """
+    Merge the outputs of all of the shards of an analysis into the standard analysis output dir, so that
+    post-analysis tasks and reports work the same way as for an analysis that wasn't sharded.
+
+    :param analysis: Analysis, as returned by `auto_hcv.core.prepare_analysis`, with `shards`.
+    :type analysis: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    for shard in analysis['shards']:
+        merge_shard_output(shard['output_dir'], analysis['analysis_pipeline_output_dir'], shard['shard_index'])
+    logging.info(json.dumps({"event_type": "analysis_shards_merged", "sequencing_run_id": analysis['sequencing_run_id'], "num_shards": len(analysis['shards']), "analysis_pipeline_output_dir": analysis['analysis_pipeline_output_dir']}))
@@ -0,0 +1,348 @@
+import datetime
+import os
+import sqlite3
+import threading
+
+from typing import Optional
+
+# Run statuses, in the order that a run moves through them.
+RUN_STATUS_IGNORED = 'ignored'
+RUN_STATUS_DISCOVERED = 'discovered'
+RUN_STATUS_READY = 'ready'
+RUN_STATUS_STARTED = 'started'
+RUN_STATUS_COMPLETE = 'complete'
+RUN_STATUS_FAILED = 'failed'
+RUN_STATUS_REPORTED = 'reported'
+
+# Runs with these statuses don't need to be looked at again, as long as the
+# configured pipelines haven't changed since the status was recorded.
+FINISHED_RUN_STATUSES = [RUN_STATUS_COMPLETE, RUN_STATUS_FAILED, RUN_STATUS_REPORTED]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    fastq_directory TEXT,
+    status TEXT NOT NULL,
+    dir_mtime REAL,
+    marker_mtime REAL,
+    pipelines_key TEXT,
+    timestamp_updated TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_status_idx ON runs (status);
+CREATE TABLE IF NOT EXISTS analyses (
+    run_id TEXT NOT NULL,
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    status TEXT NOT NULL,
+    analysis_pipeline_output_dir TEXT,
+    timestamp_updated TEXT,
+    PRIMARY KEY (run_id, pipeline_name, pipeline_version)
+);
+CREATE TABLE IF NOT EXISTS analysis_inputs (
+    reuse_key TEXT PRIMARY KEY,
+    input_fingerprint TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    analysis_pipeline_output_dir TEXT NOT NULL,
+    timestamp_updated TEXT
+);
+CREATE TABLE IF NOT EXISTS input_fingerprints (
+    run_id TEXT PRIMARY KEY,
+    fastq_input TEXT NOT NULL,
+    dir_mtime REAL NOT NULL,
+    input_fingerprint TEXT NOT NULL,
+    timestamp_updated TEXT
+);
+"""
+
+
+def get_pipelines_key(config: dict[str, object]) -> str:
+    """
+    Summarize the configured pipelines, so that we can tell when the status of a run was determined
+    using a different set of pipelines than the ones that are currently configured.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Sorted, comma-separated list of `pipeline_name@pipeline_version`.
+    :rtype: str
+    """
+    pipelines = ['@'.join([p['pipeline_name'], p['pipeline_version']]) for p in config.get('pipelines', [])]
+
+    return ','.join(sorted(pipelines))
+
+
+class RunStateStore:
+    """
+    Local SQLite store of the status of each sequencing run, and of each analysis of those runs.
+
+    The store lets a scan skip runs that have already been analyzed with a single lookup,
+    and skip directories that haven't changed since they were last looked at, instead of
+    re-checking the filesystem for every run directory on every scan. It is only a cache of
+    what is on the filesystem, and can be rebuilt at any time with `auto_hcv.core.rebuild_run_state`.
+    The inputs of completed analyses are also indexed, so that re-delivered runs can reuse their outputs
+    (see `auto_hcv.reuse`).
+
+    The database should be kept on a local filesystem (not NFS).
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def clear(self):
+        """
+        Delete all run, analysis, analysis input and input fingerprint records.
+
+        :return: None
+        :rtype: NoneType
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM input_fingerprints")
+            self.conn.execute("DELETE FROM analysis_inputs")
+            self.conn.execute("DELETE FROM analyses")
+            self.conn.execute("DELETE FROM runs")
+
+
+    def get_runs(self) -> dict[str, dict[str, object]]:
+        """
+        Get all of the runs in the store.
+
+        :return: Map from run ID to run record.
+        :rtype: dict[str, dict[str, object]]
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM runs").fetchall()
+
+        return {row['run_id']: dict(row) for row in rows}
+
+
+    def get_run(self, run_id: str) -> Optional[dict[str, object]]:
+        """
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :return: Run record, or None if the run isn't in the store.
+        :rtype: Optional[dict[str, object]]
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+
+        return dict(row)
+
+
+    def get_analyses(self, run_id: str) -> dict[tuple[str, str], dict[str, object]]:
+        """
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :return: Map from (pipeline_name, pipeline_version) to analysis record, for all analyses of the run.
+        :rtype: dict[tuple[str, str], dict[str, object]]
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM analyses WHERE run_id = ?", (run_id,)).fetchall()
+
+        return {(row['pipeline_name'], row['pipeline_version']): dict(row) for row in rows}
+
+
+    def set_run_status(self, run_id: str, status: str, fastq_directory: Optional[str]=None, dir_mtime: Optional[float]=None, marker_mtime: Optional[float]=None, pipelines_key: Optional[str]=None):
+        """
+        Insert or update a run record. Fields that are passed as None keep their existing values.
+
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :param status: Run status (`discovered`, `ready`, `started`, `complete`, `failed`, `reported` or `ignored`)
+        :type status: str
+        :param fastq_directory: Path to the run's fastq directory.
+        :type fastq_directory: Optional[str]
+        :param dir_mtime: Modification time of the run's fastq directory, when the status was determined.
+        :type dir_mtime: Optional[float]
+        :param marker_mtime: Modification time of the run's `symlinks_complete.json`, when the status was determined.
+        :type marker_mtime: Optional[float]
+        :param pipelines_key: Pipelines that the status was determined with, as returned by `get_pipelines_key`.
+        :type pipelines_key: Optional[str]
+        :return: None
+        :rtype: NoneType
+        """
+        timestamp_updated = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO runs (run_id, fastq_directory, status, dir_mtime, marker_mtime, pipelines_key, timestamp_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (run_id) DO UPDATE SET
+                  fastq_directory = COALESCE(excluded.fastq_directory, fastq_directory),
+                  status = excluded.status,
+                  dir_mtime = COALESCE(excluded.dir_mtime, dir_mtime),
+                  marker_mtime = COALESCE(excluded.marker_mtime, marker_mtime),
+                  pipelines_key = COALESCE(excluded.pipelines_key, pipelines_key),
+                  timestamp_updated = excluded.timestamp_updated
+                """,
+                (run_id, fastq_directory, status, dir_mtime, marker_mtime, pipelines_key, timestamp_updated)
+            )
+
+
+    def set_analysis_status(self, config: dict[str, object], run_id: str, pipeline: dict[str, object], status: str, analysis_pipeline_output_dir: Optional[str]=None):
+        """
+        Insert or update an analysis record, then update the status of the run to reflect
+        the status of all of its analyses by the configured pipelines.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :param pipeline: Pipeline config.
+        :type pipeline: dict[str, object]
+        :param status: Analysis status (`started`, `complete`, `failed` or `reported`)
+        :type status: str
+        :param analysis_pipeline_output_dir: Path to the analysis output dir.
+        :type analysis_pipeline_output_dir: Optional[str]
+        :return: None
+        :rtype: NoneType
+        """
+        timestamp_updated = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO analyses (run_id, pipeline_name, pipeline_version, status, analysis_pipeline_output_dir, timestamp_updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (run_id, pipeline_name, pipeline_version) DO UPDATE SET
+                  status = excluded.status,
+                  analysis_pipeline_output_dir = COALESCE(excluded.analysis_pipeline_output_dir, analysis_pipeline_output_dir),
+                  timestamp_updated = excluded.timestamp_updated
+                """,
+                (run_id, pipeline['pipeline_name'], pipeline['pipeline_version'], status, analysis_pipeline_output_dir, timestamp_updated)
+            )
+            rows = self.conn.execute("SELECT * FROM analyses WHERE run_id = ?", (run_id,)).fetchall()
+
+        analysis_statuses = {(row['pipeline_name'], row['pipeline_version']): row['status'] for row in rows}
+        run_status = summarize_analysis_statuses(config, analysis_statuses)
+        if run_status is not None:
+            self.set_run_status(run_id, run_status, pipelines_key=get_pipelines_key(config))
+
+
+    def record_analysis_input(self, reuse_key: str, input_fingerprint: str, run_id: str, pipeline: dict[str, object], analysis_pipeline_output_dir: str):
+        """
+        Record the input of an analysis that completed, so that its outputs can be reused by later analyses of the
+        same input (see `auto_hcv.reuse`). If the input was analyzed before, the latest analysis replaces the record.
+
+        :param reuse_key: Key of the pipeline and input, as returned by `auto_hcv.reuse.get_reuse_key`.
+        :type reuse_key: str
+        :param input_fingerprint: Input fingerprint, as returned by `auto_hcv.reuse.fingerprint_fastq_input`.
+        :type input_fingerprint: str
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :param pipeline: Pipeline config.
+        :type pipeline: dict[str, object]
+        :param analysis_pipeline_output_dir: Path to the analysis output dir.
+        :type analysis_pipeline_output_dir: str
+        :return: None
+        :rtype: NoneType
+        """
+        timestamp_updated = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO analysis_inputs (reuse_key, input_fingerprint, run_id, pipeline_name, pipeline_version, analysis_pipeline_output_dir, timestamp_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (reuse_key, input_fingerprint, run_id, pipeline['pipeline_name'], pipeline['pipeline_version'], analysis_pipeline_output_dir, timestamp_updated)
+            )
+
+
+    def find_analysis_input(self, reuse_key: str) -> Optional[dict[str, object]]:
+        """
+        :param reuse_key: Key of the pipeline and input, as returned by `auto_hcv.reuse.get_reuse_key`.
+        :type reuse_key: str
+        :return: Record of the analysis that last completed with the same pipeline and input, or None if there isn't one.
+        :rtype: Optional[dict[str, object]]
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM analysis_inputs WHERE reuse_key = ?", (reuse_key,)).fetchone()
+        if row is None:
+            return None
+
+        return dict(row)
+
+
+    def get_input_fingerprint(self, run_id: str, fastq_input: str, dir_mtime: float) -> Optional[str]:
+        """
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :param fastq_input: Fastq input dir that the fingerprint is of.
+        :type fastq_input: str
+        :param dir_mtime: Current modification time of the fastq input dir.
+        :type dir_mtime: float
+        :return: The run's cached input fingerprint, or None if there isn't one for this dir and modification time.
+        :rtype: Optional[str]
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM input_fingerprints WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None or row['fastq_input'] != fastq_input or row['dir_mtime'] != dir_mtime:
+            return None
+
+        return row['input_fingerprint']
+
+
+    def set_input_fingerprint(self, run_id: str, fastq_input: str, dir_mtime: float, input_fingerprint: str):
+        """
+        Cache a run's input fingerprint, along with the fastq input dir and modification time it was computed for.
+
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :param fastq_input: Fastq input dir that the fingerprint is of.
+        :type fastq_input: str
+        :param dir_mtime: Modification time of the fastq input dir, when the fingerprint was computed.
+        :type dir_mtime: float
+        :param input_fingerprint: Input fingerprint, as returned by `auto_hcv.reuse.fingerprint_fastq_input`.
+        :type input_fingerprint: str
+        :return: None
+        :rtype: NoneType
+        """
+        timestamp_updated = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO input_fingerprints (run_id, fastq_input, dir_mtime, input_fingerprint, timestamp_updated)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (run_id, fastq_input, dir_mtime, input_fingerprint, timestamp_updated)
+            )
+
+
+def summarize_analysis_statuses(config: dict[str, object], analysis_statuses: dict[tuple[str, str], str]) -> Optional[str]:
+    """
+    Determine the status of a run from the status of its analyses by each of the configured pipelines.
+    A run is only `complete` (or `reported`) once all of the configured pipelines have completed, and
+    is `failed` once every configured pipeline has either completed or failed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_statuses: Map from (pipeline_name, pipeline_version) to analysis status.
+    :type analysis_statuses: dict[tuple[str, str], str]
+    :return: Run status, or None if none of the configured pipelines have been started.
+    :rtype: Optional[str]
+    """
+    statuses = []
+    for pipeline in config.get('pipelines', []):
+        statuses.append(analysis_statuses.get((pipeline['pipeline_name'], pipeline['pipeline_version']), None))
+    if len(statuses) == 0 or all(status is None for status in statuses):
+        return None
+    if all(status == RUN_STATUS_REPORTED for status in statuses):
+        return RUN_STATUS_REPORTED
+    if all(status in [RUN_STATUS_COMPLETE, RUN_STATUS_REPORTED] for status in statuses):
+        return RUN_STATUS_COMPLETE
+    if all(status in FINISHED_RUN_STATUSES for status in statuses):
+        return RUN_STATUS_FAILED
+
+    return RUN_STATUS_STARTED
@@ -0,0 +1,357 @@
+import csv
+import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from typing import Optional
+
+import pandas as pd
+
+DEFAULT_TRACE_REPORT_TOP_N = 10
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS process_traces (
+    run_id TEXT NOT NULL,
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    hash TEXT,
+    process TEXT,
+    tag TEXT,
+    status TEXT,
+    exit TEXT,
+    realtime_ms REAL,
+    pct_cpu REAL,
+    peak_rss_bytes REAL,
+    peak_vmem_bytes REAL,
+    rchar_bytes REAL,
+    wchar_bytes REAL,
+    timestamp_ingested TEXT,
+    PRIMARY KEY (run_id, pipeline_name, pipeline_version, task_id)
+);
+CREATE INDEX IF NOT EXISTS process_traces_process_idx ON process_traces (pipeline_name, process);
+"""
+
+TRACE_COLUMNS = ['run_id', 'pipeline_name', 'pipeline_version', 'task_id', 'hash', 'process', 'tag', 'status', 'exit', 'realtime_ms', 'pct_cpu', 'peak_rss_bytes', 'peak_vmem_bytes', 'rchar_bytes', 'wchar_bytes']
+
+DURATION_UNITS_MS = {'ms': 1, 's': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000}
+MEMORY_UNITS_BYTES = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4, 'PB': 1024 ** 5}
+DURATION_PART_REGEX = re.compile(r'([0-9.]+)\s*(ms|s|m|h|d)')
+MEMORY_REGEX = re.compile(r'^([0-9.]+)\s*([KMGTP]?B)$')
+PROCESS_TAG_REGEX = re.compile(r'^(?P<process>.+?)(?: \((?P<tag>.*)\))?$')
+
+
+def parse_duration_ms(value: str) -> Optional[float]:
+    """
+    :param value: Duration, as formatted in a nextflow trace file (for example, `1h 2m 3s`, `4.5s` or `120ms`).
+    :type value: str
+    :return: Duration in milliseconds, or None if the value is missing.
+    :rtype: Optional[float]
+    """
+    parts = DURATION_PART_REGEX.findall(value or '')
+    if len(parts) == 0:
+        return None
+
+    return sum(float(number) * DURATION_UNITS_MS[unit] for number, unit in parts)
+
+
+def parse_memory_bytes(value: str) -> Optional[float]:
+    """
+    :param value: Amount of memory or data, as formatted in a nextflow trace file (for example, `1.2 GB` or `512 KB`).
+    :type value: str
+    :return: Number of bytes, or None if the value is missing.
+    :rtype: Optional[float]
+    """
+    match = MEMORY_REGEX.match((value or '').strip())
+    if match is None:
+        return None
+
+    return float(match.group(1)) * MEMORY_UNITS_BYTES[match.group(2)]
+
+
+def parse_percent(value: str) -> Optional[float]:
+    """
+    :param value: Percentage, as formatted in a nextflow trace file (for example, `95.3%`).
+    :type value: str
+    :return: Percentage, or None if the value is missing.
+    :rtype: Optional[float]
+    """
+    try:
+        return float((value or '').strip().rstrip('%'))
+    except ValueError as e:
+        return None
+
+
+def parse_trace(trace_path: str, run_id: str, pipeline: dict[str, object]) -> list[dict[str, object]]:
+    """
+    Parse a nextflow trace file (as written by `-with-trace`), with one row per task.
+
+    :param trace_path: Path to the trace file.
+    :type trace_path: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :return: One record per task, with the keys in `TRACE_COLUMNS`.
+    :rtype: list[dict[str, object]]
+    """
+    records = []
+    with open(trace_path, 'r', newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            name_match = PROCESS_TAG_REGEX.match(row.get('name', '') or '')
+            process = row.get('process', None) or name_match.group('process')
+            tag = row.get('tag', None) or name_match.group('tag')
+            records.append({
+                'run_id': run_id,
+                'pipeline_name': pipeline['pipeline_name'],
+                'pipeline_version': pipeline['pipeline_version'],
+                'task_id': row.get('task_id', None) or str(len(records) + 1),
+                'hash': row.get('hash', None),
+                'process': process,
+                'tag': tag,
+                'status': row.get('status', None),
+                'exit': row.get('exit', None),
+                'realtime_ms': parse_duration_ms(row.get('realtime', None)),
+                'pct_cpu': parse_percent(row.get('%cpu', None)),
+                'peak_rss_bytes': parse_memory_bytes(row.get('peak_rss', None)),
+                'peak_vmem_bytes': parse_memory_bytes(row.get('peak_vmem', None)),
+                'rchar_bytes': parse_memory_bytes(row.get('rchar', None)),
+                'wchar_bytes': parse_memory_bytes(row.get('wchar', None)),
+            })
+
+    return records
+
+
+class TraceStore:
+    """
+    Local SQLite store of the resource usage of every pipeline process, across all runs, collected from
+    nextflow trace files. Used to find slow and memory-hungry processes, and to compare pipeline versions.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def replace_run_traces(self, run_id: str, pipeline: dict[str, object], records: list[dict[str, object]]):
+        """
+        Replace all of the trace records for the analysis of a run by a pipeline.
+
+        :param run_id: Sequencing run ID.
+        :type run_id: str
+        :param pipeline: Pipeline config.
+        :type pipeline: dict[str, object]
+        :param records: Trace records, as returned by `parse_trace`.
+        :type records: list[dict[str, object]]
+        :return: None
+        :rtype: NoneType
+        """
+        timestamp_ingested = datetime.datetime.now().isoformat()
+        placeholders = ', '.join(['?'] * (len(TRACE_COLUMNS) + 1))
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM process_traces WHERE run_id = ? AND pipeline_name = ? AND pipeline_version = ?",
+                (run_id, pipeline['pipeline_name'], pipeline['pipeline_version'])
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO process_traces (" + ', '.join(TRACE_COLUMNS) + ", timestamp_ingested) VALUES (" + placeholders + ")",
+                [[record[column] for column in TRACE_COLUMNS] + [timestamp_ingested] for record in records]
+            )
+
+
+    def get_traces(self, pipeline_name: Optional[str]=None) -> pd.DataFrame:
+        """
+        :param pipeline_name: Only include traces for this pipeline.
+        :type pipeline_name: Optional[str]
+        :return: Trace records for completed tasks.
+        :rtype: pd.DataFrame
+        """
+        query = "SELECT * FROM process_traces WHERE status IN ('COMPLETED', 'CACHED')"
+        params = []
+        if pipeline_name is not None:
+            query += " AND pipeline_name = ?"
+            params.append(pipeline_name)
+        with self.lock:
+            df = pd.read_sql_query(query, self.conn, params=params)
+
+        return df
+
+
+def get_trace_db_path(config: dict[str, object]) -> Optional[str]:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the trace store: `trace_db` if it is set, otherwise `run_state_db`. None if neither is set.
+    :rtype: Optional[str]
+    """
+    return config.get('trace_db', None) or config.get('run_state_db', None)
+
+
+def get_trace_path(config: dict[str, object], pipeline: dict[str, object], run_id: str) -> str:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :return: Path to the trace file written by the analysis of the run by the pipeline.
+    :rtype: str
+    """
+    pipeline_short_name = pipeline['pipeline_name'].split('/')[1]
+    pipeline_minor_version = ''.join(pipeline['pipeline_version'].rsplit('.', 1)[0])
+    pipeline_path_name = '-'.join([pipeline_short_name, pipeline_minor_version, 'output'])
+
+    return os.path.join(config['analysis_output_dir'], run_id, pipeline_path_name, run_id + '_' + pipeline_short_name + '_trace.tsv')
+
+
+def ingest_trace(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object], trace_store: Optional[TraceStore]=None) -> Optional[int]:
+    """
+    Add the trace of the analysis of a run by a pipeline to the trace store. Ingesting the same trace
+    again replaces the records from the last time it was ingested.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: Pipeline config.
+    :type pipeline: dict[str, object]
+    :param run: Run.
+    :type run: dict[str, object]
+    :param trace_store: Trace store. If not provided, the store at `get_trace_db_path(config)` is used.
+    :type trace_store: Optional[TraceStore]
+    :return: Number of tasks ingested, or None if there is no trace store configured or the trace couldn't be read.
+    :rtype: Optional[int]
+    """
+    run_id = run['run_id']
+    trace_path = get_trace_path(config, pipeline, run_id)
+    close_trace_store = False
+    if trace_store is None:
+        db_path = get_trace_db_path(config)
+        if db_path is None:
+            return None
+        trace_store = TraceStore(db_path)
+        close_trace_store = True
+    try:
+        records = parse_trace(trace_path, run_id, pipeline)
+        trace_store.replace_run_traces(run_id, pipeline, records)
+    except (OSError, csv.Error, sqlite3.Error) as e:
+        logging.warning(json.dumps({"event_type": "ingest_trace_failed", "sequencing_run_id": run_id, "pipeline_name": pipeline['pipeline_name'], "trace_path": trace_path, "error": str(e)}))
+        return None
+    finally:
+        if close_trace_store:
+            trace_store.close()
+    logging.info(json.dumps({"event_type": "trace_ingested", "sequencing_run_id": run_id, "pipeline_name": pipeline['pipeline_name'], "pipeline_version": pipeline['pipeline_version'], "trace_path": trace_path, "num_tasks": len(records)}))
+
+    return len(records)
+
+
+def summarize_processes(traces: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarize the resource usage of each process, for each pipeline version.
+
+    :param traces: Trace records, as returned by `TraceStore.get_traces`.
+    :type traces: pd.DataFrame
+    :return: One row per (pipeline_name, pipeline_version, process), with task counts and median/max realtime, CPU and memory.
+    :rtype: pd.DataFrame
+    """
+    summary = traces.groupby(['pipeline_name', 'pipeline_version', 'process']).agg(
+        num_runs=('run_id', 'nunique'),
+        num_tasks=('task_id', 'count'),
+        median_realtime_s=('realtime_ms', lambda x: x.median() / 1000),
+        max_realtime_s=('realtime_ms', lambda x: x.max() / 1000),
+        median_pct_cpu=('pct_cpu', 'median'),
+        median_peak_rss_mb=('peak_rss_bytes', lambda x: x.median() / 1024 ** 2),
+        max_peak_rss_mb=('peak_rss_bytes', lambda x: x.max() / 1024 ** 2),
+        median_rchar_mb=('rchar_bytes', lambda x: x.median() / 1024 ** 2),
+        median_wchar_mb=('wchar_bytes', lambda x: x.median() / 1024 ** 2),
+    ).reset_index()
+
+    return summary.round(2)
+
+
+def find_regressions(traces: pd.DataFrame, threshold: float=DEFAULT_REGRESSION_THRESHOLD) -> pd.DataFrame:
+    """
+    Compare each pipeline version with the version before it, and find processes whose median realtime
+    or peak memory grew by more than `threshold` times. Versions are ordered by the earliest run that
+    they analyzed (run IDs start with the sequencing date).
+
+    :param traces: Trace records, as returned by `TraceStore.get_traces`.
+    :type traces: pd.DataFrame
+    :param threshold: Ratio (new / old) above which a change is reported.
+    :type threshold: float
+    :return: One row per process and metric that regressed.
+    :rtype: pd.DataFrame
+    """
+    summary = summarize_processes(traces)
+    regressions = []
+    for pipeline_name, pipeline_traces in traces.groupby('pipeline_name'):
+        versions = pipeline_traces.groupby('pipeline_version')['run_id'].min().sort_values().index.tolist()
+        pipeline_summary = summary[summary['pipeline_name'] == pipeline_name].set_index(['pipeline_version', 'process'])
+        for old_version, new_version in zip(versions, versions[1:]):
+            for process in pipeline_summary.loc[new_version].index:
+                if (old_version, process) not in pipeline_summary.index:
+                    continue
+                old = pipeline_summary.loc[(old_version, process)]
+                new = pipeline_summary.loc[(new_version, process)]
+                for metric in ['median_realtime_s', 'median_peak_rss_mb']:
+                    if pd.isna(old[metric]) or pd.isna(new[metric]) or old[metric] <= 0:
+                        continue
+                    ratio = new[metric] / old[metric]
+                    if ratio > threshold:
+                        regressions.append({
+                            'pipeline_name': pipeline_name,
+                            'process': process,
+                            'metric': metric,
+                            'old_version': old_version,
+                            'new_version': new_version,
+                            'old_value': old[metric],
+                            'new_value': new[metric],
+                            'ratio': round(ratio, 2),
+                        })
+
+    return pd.DataFrame(regressions, columns=['pipeline_name', 'process', 'metric', 'old_version', 'new_version', 'old_value', 'new_value', 'ratio'])
+
+
+def trace_report(traces: pd.DataFrame, top_n: int=DEFAULT_TRACE_REPORT_TOP_N, regression_threshold: float=DEFAULT_REGRESSION_THRESHOLD) -> str:
+    """
+    Build a plain-text report of the slowest and most memory-hungry processes across all runs,
+    and of processes that got slower or used more memory between pipeline versions.
+
+    :param traces: Trace records, as returned by `TraceStore.get_traces`.
+    :type traces: pd.DataFrame
+    :param top_n: Number of processes to list in each section.
+    :type top_n: int
+    :param regression_threshold: Ratio (new / old) above which a change between versions is reported.
+    :type regression_threshold: float
+    :return: Report.
+    :rtype: str
+    """
+    if len(traces) == 0:
+        return "No traces have been ingested.\n"
+    summary = summarize_processes(traces)
+    sections = [
+        ("Slowest processes (by median realtime)", summary.nlargest(top_n, 'median_realtime_s')),
+        ("Most memory-hungry processes (by max peak RSS)", summary.nlargest(top_n, 'max_peak_rss_mb')),
+        ("Regressions between pipeline versions (ratio > " + str(regression_threshold) + ")", find_regressions(traces, regression_threshold)),
+    ]
+    lines = []
+    for title, df in sections:
+        lines.append(title)
+        lines.append('=' * len(title))
+        lines.append(df.to_string(index=False) if len(df) > 0 else 'None')
+        lines.append('')
+
+    return '\n'.join(lines)
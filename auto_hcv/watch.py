@@ -0,0 +1,196 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+
+from typing import Optional
+
+import auto_hcv.core as core
+
+# Flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+FASTQ_BY_RUN_DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO
+RUN_DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+SYMLINKS_COMPLETE_FILENAME = 'symlinks_complete.json'
+
+
+class RunDirWatcher:
+    """
+    Watches the `fastq_by_run_dir` for new run directories, and for `symlinks_complete.json` files being
+    created in run directories that aren't yet ready to analyze, using Linux inotify.
+
+    inotify doesn't report changes made by other hosts on network filesystems (such as NFS), so
+    events may be missed. The watcher is meant to be used alongside a (less frequent) full scan.
+    """
+    def __init__(self, fastq_by_run_dir: str):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fastq_by_run_dir = os.path.abspath(fastq_by_run_dir)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.run_ids_by_watch_descriptor = {}
+        self.root_watch_descriptor = self.add_watch(self.fastq_by_run_dir, FASTQ_BY_RUN_DIR_WATCH_MASK)
+        self.full_scan_needed = False
+        for subdir in os.scandir(self.fastq_by_run_dir):
+            if not subdir.is_dir() or not core.matches_illumina_run_id_format(subdir.name):
+                continue
+            if os.path.exists(os.path.join(subdir.path, SYMLINKS_COMPLETE_FILENAME)):
+                continue
+            self.watch_run_dir(subdir.name)
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        :param path: Path to watch.
+        :type path: str
+        :param mask: inotify event mask.
+        :type mask: int
+        :return: Watch descriptor.
+        :rtype: int
+        :raises OSError: If the watch could not be added (for example, if the `fs.inotify.max_user_watches` limit was reached).
+        """
+        watch_descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+        return watch_descriptor
+
+
+    def watch_run_dir(self, run_id: str):
+        """
+        Start watching a run directory for its `symlinks_complete.json` file. If the watch can't be added,
+        the run will be picked up by the next full scan.
+
+        :param run_id: Sequencing run ID (name of the run directory).
+        :type run_id: str
+        :return: None
+        :rtype: NoneType
+        """
+        run_dir = os.path.join(self.fastq_by_run_dir, run_id)
+        try:
+            watch_descriptor = self.add_watch(run_dir, RUN_DIR_WATCH_MASK)
+            self.run_ids_by_watch_descriptor[watch_descriptor] = run_id
+        except OSError as e:
+            logging.warning(json.dumps({"event_type": "watch_run_dir_failed", "fastq_directory": run_dir, "error": str(e)}))
+
+
+    def unwatch_run_dir(self, watch_descriptor: int):
+        """
+        :param watch_descriptor: Watch descriptor of a run directory.
+        :type watch_descriptor: int
+        :return: None
+        :rtype: NoneType
+        """
+        self.run_ids_by_watch_descriptor.pop(watch_descriptor, None)
+        self.libc.inotify_rm_watch(self.fd, watch_descriptor)
+
+
+    def wait(self, timeout: float) -> list[str]:
+        """
+        Wait for up to `timeout` seconds for filesystem events, and return the IDs of runs that may have become
+        ready to analyze. If the kernel's event queue overflowed, `full_scan_needed` is set.
+
+        :param timeout: Maximum time to wait, in seconds.
+        :type timeout: float
+        :return: Sequencing run IDs, in the order that their events arrived.
+        :rtype: list[str]
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        run_ids = []
+        while True:
+            try:
+                buf = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError as e:
+                break
+            offset = 0
+            while offset < len(buf):
+                watch_descriptor, mask, cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = buf[offset:offset + name_length].rstrip(b'\0').decode('utf-8', errors='replace')
+                offset += name_length
+                run_id = self.handle_event(watch_descriptor, mask, name)
+                if run_id is not None and run_id not in run_ids:
+                    run_ids.append(run_id)
+
+        return run_ids
+
+
+    def handle_event(self, watch_descriptor: int, mask: int, name: str) -> Optional[str]:
+        """
+        :param watch_descriptor: Watch descriptor that the event was reported for.
+        :type watch_descriptor: int
+        :param mask: Event mask.
+        :type mask: int
+        :param name: Name of the file (or directory) that the event refers to, within the watched directory.
+        :type name: str
+        :return: ID of the run that may have become ready, or None.
+        :rtype: Optional[str]
+        """
+        if mask & IN_Q_OVERFLOW:
+            logging.warning(json.dumps({"event_type": "watch_event_queue_overflow", "fastq_by_run_dir": self.fastq_by_run_dir}))
+            self.full_scan_needed = True
+            return None
+        if mask & IN_IGNORED or mask & IN_DELETE_SELF:
+            self.run_ids_by_watch_descriptor.pop(watch_descriptor, None)
+            return None
+        if watch_descriptor == self.root_watch_descriptor:
+            if not (mask & IN_ISDIR) or not core.matches_illumina_run_id_format(name):
+                return None
+            logging.debug(json.dumps({"event_type": "watch_run_dir_created", "sequencing_run_id": name}))
+            self.watch_run_dir(name)
+            # The marker file may have been created before the watch was added.
+            return name
+        run_id = self.run_ids_by_watch_descriptor.get(watch_descriptor, None)
+        if run_id is not None and name == SYMLINKS_COMPLETE_FILENAME:
+            logging.debug(json.dumps({"event_type": "watch_symlinks_complete_created", "sequencing_run_id": run_id}))
+            self.unwatch_run_dir(watch_descriptor)
+            return run_id
+
+        return None
+
+
+def create_watcher(config: dict[str, object]) -> Optional[RunDirWatcher]:
+    """
+    Create a watcher for the `fastq_by_run_dir`, if `watch_for_new_runs` is enabled in the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Watcher, or None if watching is disabled or isn't supported on this system.
+    :rtype: Optional[RunDirWatcher]
+    """
+    if not config.get('watch_for_new_runs', False):
+        return None
+    try:
+        watcher = RunDirWatcher(config['fastq_by_run_dir'])
+        logging.info(json.dumps({"event_type": "watch_started", "fastq_by_run_dir": os.path.abspath(config['fastq_by_run_dir']), "num_run_dirs_watched": len(watcher.run_ids_by_watch_descriptor)}))
+    except (OSError, AttributeError) as e:
+        # AttributeError is raised if the C library doesn't provide inotify (not Linux).
+        logging.warning(json.dumps({"event_type": "watch_not_available", "fastq_by_run_dir": os.path.abspath(config['fastq_by_run_dir']), "error": str(e)}))
+        watcher = None
+
+    return watcher
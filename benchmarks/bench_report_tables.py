@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark the report table engine (`auto_hcv.report_html.write_table_if_exists`) against the previous
+implementation (read every column, build the amplicon column row by row, sort the whole table, then
+`DataFrame.to_html`), on synthetic BLAST result tables.
+
+Usage:
+
+    python benchmarks/bench_report_tables.py --rows 100000 250000 --repeats 3
+"""
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from auto_hcv.report_html import write_table_if_exists
+
+AMPLICONS = ['core', 'ns5b']
+
+
+def legacy_table_if_exists(table_path, table_type=None, **kwargs):
+    """
+    The table rendering path used before the vectorized engine, kept here as the baseline.
+    """
+    if table_path.exists():
+        try:
+            df = pd.read_csv(table_path, **kwargs)
+            if table_type == 'genotype':
+                df = df.drop(['subject_strand','e_value'],axis=1)
+                df['amplicon'] = df.apply(lambda row: row['query_seq_id'].split('|')[1], axis=1)
+                df = df.sort_values(['amplicon', 'bitscore'], ascending=[True, False])
+                df = df.groupby('amplicon').head(10).reset_index(drop=True)
+
+            if table_type == 'blastn':
+                df = df.sort_values(['amplicon', 'bitscore'], ascending=[True, False])
+                df = df.groupby('amplicon').head(10).reset_index(drop=True)
+
+            return df.to_html(index=False, classes='data-table', border=0)
+        except Exception as e:
+            return f"<div style='color:red'>Error reading {table_path.name}: {e}</div>"
+    return f"<div style='color:#888'>Table file missing: {table_path.name}</div>"
+
+
+def write_blast_table(path, num_rows, table_type, seed=0):
+    """
+    Write a synthetic BLAST result table, with the columns of the hcv-nf genotype calls (`genotype`) or prefiltered BLAST results (`blastn`).
+    Bitscores are unique, so that the order of the top hits is well-defined.
+    """
+    rng = np.random.default_rng(seed)
+    amplicons = rng.choice(AMPLICONS, num_rows)
+    df = pd.DataFrame({
+        'query_seq_id': ['sample-01|' + amplicon + '|consensus' for amplicon in amplicons],
+        'subject_seq_id': ['ref_' + str(i) for i in rng.integers(0, 5000, num_rows)],
+        'subject_strand': rng.choice(['plus', 'minus'], num_rows),
+        'query_length': rng.integers(300, 400, num_rows),
+        'percent_identity': rng.uniform(80, 100, num_rows).round(3),
+        'alignment_length': rng.integers(250, 400, num_rows),
+        'e_value': 10.0 ** -rng.uniform(50, 180, num_rows),
+        'bitscore': rng.permutation(num_rows) / 10.0 + 100.0,
+        'subject_names': ['HCV genotype ' + str(g) + ' <isolate ' + str(i) + '>' for g, i in zip(rng.integers(1, 8, num_rows), rng.integers(0, 1000, num_rows))],
+    })
+    if table_type == 'blastn':
+        df = df.drop(columns=['subject_strand', 'e_value'])
+        df['amplicon'] = amplicons
+    df.to_csv(path)
+
+
+def normalize_html(table_html):
+    # Newer versions of pandas omit `border="0"`.
+    return re.sub(r'<table( border="0")? class=', '<table border="0" class=', table_html)
+
+
+def time_call(fn, repeats):
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+
+    return min(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 250000], help='Table sizes to benchmark')
+    parser.add_argument('--repeats', type=int, default=3, help='Timings are the best of this many repeats')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_rows in args.rows:
+            for table_type in ['genotype', 'blastn']:
+                table_path = Path(tmpdir) / (table_type + '_' + str(num_rows) + '.csv')
+                write_blast_table(table_path, num_rows, table_type)
+
+                def render():
+                    f = io.StringIO()
+                    write_table_if_exists(f, table_path, table_type=table_type, index_col=0)
+                    return f.getvalue()
+
+                legacy_seconds, legacy_html = time_call(lambda: legacy_table_if_exists(table_path, table_type=table_type, index_col=0), args.repeats)
+                seconds, table_html = time_call(render, args.repeats)
+                result = {
+                    'table_type': table_type,
+                    'rows': num_rows,
+                    'legacy_seconds': round(legacy_seconds, 4),
+                    'seconds': round(seconds, 4),
+                    'speedup': round(legacy_seconds / seconds, 1),
+                    'output_matches': normalize_html(legacy_html) == normalize_html(table_html),
+                }
+                results.append(result)
+                print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
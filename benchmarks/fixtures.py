@@ -0,0 +1,191 @@
+"""
+Synthetic fixtures for the benchmarks: `fastq_by_run_dir` trees, hcv-nf output trees, and a stub `nextflow`.
+"""
+import datetime
+import os
+import stat
+
+import numpy as np
+import pandas as pd
+
+AMPLICONS = ['core', 'ns5b']
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+STUB_NEXTFLOW = """#!/bin/bash
+# Stub nextflow: creates the output dir and a one-task trace file, optionally after a delay.
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --outdir) outdir="$2"; shift;;
+        -with-trace) trace="$2"; shift;;
+        -work-dir) work_dir="$2"; shift;;
+    esac
+    shift
+done
+mkdir -p "$outdir"
+if [ -n "$work_dir" ]; then
+    mkdir -p "$work_dir/ab/cdef12"
+    echo stub > "$work_dir/ab/cdef12/.command.log"
+fi
+if [ -n "$trace" ]; then
+    printf 'task_id\\thash\\tname\\tstatus\\texit\\trealtime\\t%%cpu\\tpeak_rss\\n1\\tab/cdef12\\tHCV_NF:STUB (1)\\tCOMPLETED\\t0\\t1s\\t100.0%%\\t1 MB\\n' > "$trace"
+fi
+sleep "${STUB_NEXTFLOW_SECONDS:-0}"
+"""
+
+
+def get_run_id(index: int, run_date: datetime.date) -> str:
+    """
+    :return: A MiSeq run ID, unique for each index.
+    :rtype: str
+    """
+    return run_date.strftime('%y%m%d') + '_M00123_' + str(index).zfill(4) + '_000000000-' + format(index, '05X')
+
+
+def write_stub_nextflow(bin_dir: str) -> str:
+    """
+    Write a stub `nextflow` executable to `bin_dir`, to put on the `PATH` in place of nextflow.
+
+    :return: Path to the stub.
+    :rtype: str
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, 'nextflow')
+    with open(path, 'w') as f:
+        f.write(STUB_NEXTFLOW)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return path
+
+
+def make_fastq_by_run_dir(fastq_by_run_dir: str, num_runs: int, samples_per_run: int=4, ready_fraction: float=0.9, fastq_bytes: int=1024, num_other_dirs: int=0) -> list[str]:
+    """
+    Create a synthetic `fastq_by_run_dir` tree. Each run dir holds paired fastq files for its samples, and all
+    but `1 - ready_fraction` of them have a `symlinks_complete.json`. The fastq files of every run are hard links
+    to one pair of files, so that large trees can be made quickly. `num_other_dirs` directories that aren't
+    named like sequencing runs are added too.
+
+    :return: IDs of the runs that are ready to analyze.
+    :rtype: list[str]
+    """
+    os.makedirs(fastq_by_run_dir, exist_ok=True)
+    fastq_template_dir = os.path.join(fastq_by_run_dir, '..', 'fastq_templates')
+    os.makedirs(fastq_template_dir, exist_ok=True)
+    templates = []
+    for read in ['R1', 'R2']:
+        template_path = os.path.join(fastq_template_dir, read + '.fastq.gz')
+        with open(template_path, 'wb') as f:
+            f.write(os.urandom(fastq_bytes))
+        templates.append(template_path)
+
+    ready_run_ids = []
+    num_ready = int(round(num_runs * ready_fraction))
+    first_run_date = datetime.date(2023, 1, 1)
+    for i in range(num_runs):
+        run_id = get_run_id(i, first_run_date + datetime.timedelta(days=i % 365))
+        run_dir = os.path.join(fastq_by_run_dir, run_id)
+        os.makedirs(run_dir, exist_ok=True)
+        for sample_index in range(samples_per_run):
+            sample_name = 'S' + str(sample_index).zfill(3) + '-' + str(i)
+            for read, template_path in zip(['R1', 'R2'], templates):
+                fastq_path = os.path.join(run_dir, sample_name + '_S' + str(sample_index + 1) + '_L001_' + read + '_001.fastq.gz')
+                if not os.path.exists(fastq_path):
+                    os.link(template_path, fastq_path)
+        if i < num_ready:
+            with open(os.path.join(run_dir, 'symlinks_complete.json'), 'w') as f:
+                f.write('{}')
+            ready_run_ids.append(run_id)
+    for i in range(num_other_dirs):
+        os.makedirs(os.path.join(fastq_by_run_dir, 'not_a_run_' + str(i)), exist_ok=True)
+
+    return ready_run_ids
+
+
+def write_png(path: str, num_bytes: int, rng):
+    """
+    Write a file of roughly `num_bytes` that starts like a PNG (reports only read and encode the bytes).
+    """
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(rng.bytes(max(0, num_bytes - len(PNG_SIGNATURE))))
+
+
+def write_genotype_calls(path: str, sample_name: str, num_rows: int, rng):
+    amplicons = rng.choice(AMPLICONS, num_rows)
+    df = pd.DataFrame({
+        'query_seq_id': [sample_name + '|' + amplicon + '|consensus' for amplicon in amplicons],
+        'subject_seq_id': ['ref_' + str(i) for i in rng.integers(0, 5000, num_rows)],
+        'subject_strand': rng.choice(['plus', 'minus'], num_rows),
+        'percent_identity': rng.uniform(80, 100, num_rows).round(3),
+        'e_value': 10.0 ** -rng.uniform(50, 180, num_rows),
+        'bitscore': rng.uniform(100, 700, num_rows).round(1),
+        'genotype': rng.choice(['1a', '1b', '2b', '3a'], num_rows),
+    })
+    df.to_csv(path)
+
+
+def write_blastn_results(path: str, num_rows: int, rng):
+    df = pd.DataFrame({
+        'amplicon': rng.choice(AMPLICONS, num_rows),
+        'subject_seq_id': ['ref_' + str(i) for i in rng.integers(0, 237, num_rows)],
+        'percent_identity': rng.uniform(80, 100, num_rows).round(3),
+        'bitscore': rng.uniform(100, 700, num_rows).round(1),
+    })
+    df.to_csv(path)
+
+
+def make_hcv_nf_output(analysis_run_output_dir: str, run_id: str, num_samples: int, table_rows: int=100, png_bytes: int=100000, seed: int=0) -> list[str]:
+    """
+    Create a synthetic hcv-nf output tree for a run, with the files that are used to build reports and that are transferred.
+
+    :param analysis_run_output_dir: Pipeline output dir for the run.
+    :type analysis_run_output_dir: str
+    :param run_id: Sequencing run ID.
+    :type run_id: str
+    :param num_samples: Number of samples.
+    :type num_samples: int
+    :param table_rows: Number of rows in each BLAST result table.
+    :type table_rows: int
+    :param png_bytes: Size of each image.
+    :type png_bytes: int
+    :return: Sample names.
+    :rtype: list[str]
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(analysis_run_output_dir, exist_ok=True)
+    sample_names = ['S' + str(i).zfill(4) + '-A' for i in range(num_samples)]
+    for sample_name in sample_names:
+        sample_dir = os.path.join(analysis_run_output_dir, sample_name)
+        os.makedirs(os.path.join(sample_dir, 'demix'), exist_ok=True)
+        with open(os.path.join(sample_dir, sample_name + '_consensus_seqs_report.tsv'), 'w') as f:
+            f.write('seq_id\tsegment\tcoverage\n')
+            f.write(sample_name + '_core\tcore\t3.53\n' + sample_name + '_ns5b\tns5b\t3.35\n')
+        with open(os.path.join(sample_dir, sample_name + '_parsed_genome_results.csv'), 'w') as f:
+            f.write(',reference,mapped_reads,mean_depth\n0,core,' + str(rng.integers(1000, 100000)) + ',512.3\n')
+        with open(os.path.join(sample_dir, 'demix', sample_name + '_demixing_results.tsv'), 'w') as f:
+            f.write('\tsummarized\tlineages\tabundances\n0\t1a\t1a\t1.0\n')
+        with open(os.path.join(sample_dir, sample_name + '_consensus_seqs.fa'), 'w') as f:
+            for amplicon in AMPLICONS:
+                f.write('>' + sample_name + '|' + amplicon + '\n' + ''.join(rng.choice(list('ACGT'), 400)) + '\n')
+        for tree in ['core', 'ns5b']:
+            with open(os.path.join(sample_dir, 'RAxML_bestTree.' + sample_name + '_' + tree), 'w') as f:
+                f.write('((' + sample_name + ':0.01,ref_1:0.02):0.01,ref_2:0.03);\n')
+        with open(os.path.join(sample_dir, sample_name + '_' + run_id[:6] + '_provenance.yml'), 'w') as f:
+            f.write('- pipeline_name: BCCDC-PHL/hcv-nf\n- pipeline_version: 0.1.0\n- sample_name: ' + sample_name + '\n')
+        write_genotype_calls(os.path.join(sample_dir, sample_name + '_genotype_calls_nt.csv'), sample_name, table_rows, rng)
+        write_blastn_results(os.path.join(sample_dir, sample_name + '_blast_results_prefilter.csv'), table_rows, rng)
+        png_names = [
+            sample_name.replace('-', 'o') + '_depth_plots.png',
+            sample_name + '_core_db_depth_plots.png',
+            sample_name + '_ns5b_db_depth_plots.png',
+            sample_name + '_core_tree.png',
+            sample_name + '_ns5b_tree.png',
+            sample_name + '_core_subtype_tree.png',
+            sample_name + '_ns5b_subtype_tree.png',
+        ]
+        for png_name in png_names:
+            write_png(os.path.join(sample_dir, png_name), png_bytes, rng)
+    with open(os.path.join(analysis_run_output_dir, run_id + '_run_summary_report.csv'), 'w') as f:
+        f.write('sample_name,genotype\n')
+        f.writelines(sample_name + ',1a\n' for sample_name in sample_names)
+
+    return sample_names
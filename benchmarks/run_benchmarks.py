@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Benchmark how the stages of auto-hcv scale: scanning `fastq_by_run_dir`, the bookkeeping around each analysis
+(`analyze_run`, with a stub `nextflow`), `build_report_html` and `transfer_hcv_results`.
+
+Synthetic fixtures are generated in a temporary directory (see `fixtures.py`). Each stage is timed, and its peak
+Python memory use is measured with tracemalloc. Results are written as JSON, which can be compared with the results
+from another version:
+
+    python benchmarks/run_benchmarks.py --runs 5000 --samples 96 --output results-new.json
+    python benchmarks/run_benchmarks.py --runs 5000 --samples 96 --compare results-old.json
+
+tracemalloc slows down Python code, so use `--no-tracemalloc` for timings alone.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import auto_hcv.core as core
+import auto_hcv.post_analysis as post_analysis
+import auto_hcv.report_html as report_html
+import auto_hcv.state as state
+
+import fixtures
+
+HCV_NF_PIPELINE = {
+    'pipeline_name': 'BCCDC-PHL/hcv-nf',
+    'pipeline_version': '0.1.0',
+    'pipeline_parameters': {},
+}
+# A pipeline with no post-analysis tasks, so that the analyze_run stage measures only the bookkeeping around the analysis.
+STUB_PIPELINE = {
+    'pipeline_name': 'BCCDC-PHL/stub-nf',
+    'pipeline_version': '0.1.0',
+    'pipeline_parameters': {},
+}
+
+
+def get_version() -> dict[str, object]:
+    """
+    :return: The git commit of the code being benchmarked, and whether the working tree has uncommitted changes.
+    :rtype: dict[str, object]
+    """
+    repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError) as e:
+        return {'commit': None, 'dirty': None}
+
+    return {'commit': commit, 'dirty': dirty}
+
+
+class StageTimer:
+    """
+    Times the stages of the benchmark, and measures the peak Python memory use of each with tracemalloc.
+    """
+    def __init__(self, use_tracemalloc: bool=True):
+        self.use_tracemalloc = use_tracemalloc
+        self.stages = {}
+        if use_tracemalloc:
+            tracemalloc.start()
+
+
+    @contextlib.contextmanager
+    def stage(self, name: str, num_items: int, **details):
+        print('Running stage: ' + name, file=sys.stderr)
+        if self.use_tracemalloc:
+            tracemalloc.reset_peak()
+            baseline_bytes = tracemalloc.get_traced_memory()[0]
+        # Some stages print progress to stdout.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            yield
+            seconds = time.perf_counter() - start
+        result = {
+            'seconds': round(seconds, 4),
+            'num_items': num_items,
+            'seconds_per_item': round(seconds / num_items, 6) if num_items > 0 else None,
+            'peak_memory_bytes': None,
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'max_rss_children_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        }
+        if self.use_tracemalloc:
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1] - baseline_bytes
+        result.update(details)
+        self.stages[name] = result
+        print('  ' + json.dumps(result), file=sys.stderr)
+
+
+def benchmark_scan(timer: StageTimer, work_dir: str, args):
+    fastq_by_run_dir = os.path.join(work_dir, 'fastq_by_run')
+    fixtures.make_fastq_by_run_dir(fastq_by_run_dir, args.runs, samples_per_run=args.samples_per_run, ready_fraction=args.ready_fraction, num_other_dirs=args.other_dirs)
+    config = {
+        'fastq_by_run_dir': fastq_by_run_dir,
+        'pipelines': [STUB_PIPELINE],
+    }
+    num_dirs = args.runs + args.other_dirs
+
+    with timer.stage('scan', num_dirs):
+        num_found = sum(1 for run in core.find_fastq_dirs(config) if run is not None)
+
+    run_state = state.RunStateStore(os.path.join(work_dir, 'run_state.db'))
+    with timer.stage('scan_run_state_initial', num_dirs):
+        sum(1 for run in core.find_fastq_dirs(config, run_state=run_state) if run is not None)
+    with timer.stage('scan_run_state_rescan', num_dirs):
+        sum(1 for run in core.find_fastq_dirs(config, run_state=run_state) if run is not None)
+
+    return fastq_by_run_dir, num_found
+
+
+def benchmark_analyze_run(timer: StageTimer, work_dir: str, fastq_by_run_dir: str, args):
+    bin_dir = os.path.join(work_dir, 'bin')
+    fixtures.write_stub_nextflow(bin_dir)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    config = {
+        'fastq_by_run_dir': fastq_by_run_dir,
+        'analysis_output_dir': os.path.join(work_dir, 'analysis_output'),
+        'analysis_work_dir': os.path.join(work_dir, 'analysis_work'),
+        'pipelines': [STUB_PIPELINE],
+    }
+    run_ids = sorted(d for d in os.listdir(fastq_by_run_dir) if core.matches_illumina_run_id_format(d))[:args.analyze_runs]
+    runs = []
+    for run_id in run_ids:
+        run_fastq_directory = os.path.join(fastq_by_run_dir, run_id)
+        runs.append({'run_id': run_id, 'fastq_directory': run_fastq_directory, 'analysis_parameters': {'fastq_input': run_fastq_directory}})
+
+    with timer.stage('analyze_run', len(runs)):
+        for run in runs:
+            core.analyze_run(config, run)
+
+
+def benchmark_reports(timer: StageTimer, work_dir: str, args):
+    run_id = fixtures.get_run_id(0, datetime.date(2023, 1, 1))
+    config = {
+        'analysis_output_dir': os.path.join(work_dir, 'hcv_nf_output'),
+        'analysis_report_dir': os.path.join(work_dir, 'transfer'),
+        'report_workers': args.report_workers,
+        'report_image_mode': args.report_image_mode,
+    }
+    pipeline = dict(HCV_NF_PIPELINE, transfer={'enabled': True, 'workers': args.transfer_workers})
+    analysis_run_output_dir = os.path.join(config['analysis_output_dir'], run_id, core.get_analysis_output_dir_name(pipeline))
+    fixtures.make_hcv_nf_output(analysis_run_output_dir, run_id, args.samples, table_rows=args.table_rows, png_bytes=args.png_bytes)
+    run = {'run_id': run_id}
+    details = {'table_rows': args.table_rows, 'png_bytes': args.png_bytes}
+
+    with timer.stage('build_report_html', args.samples, report_workers=args.report_workers, report_image_mode=args.report_image_mode, **details):
+        report_html.build_report_html(config, pipeline, run, force=True)
+    with timer.stage('build_report_html_unchanged', args.samples, report_workers=args.report_workers, report_image_mode=args.report_image_mode, **details):
+        report_html.build_report_html(config, pipeline, run)
+    with timer.stage('transfer_hcv_results', args.samples, transfer_workers=args.transfer_workers, **details):
+        post_analysis.transfer_hcv_results(config, pipeline, run)
+
+
+def compare(results: dict[str, object], baseline: dict[str, object]):
+    """
+    Print the time and peak memory of each stage relative to a baseline.
+    """
+    print('{:<30} {:>12} {:>12} {:>8} {:>14} {:>14}'.format('stage', 'baseline_s', 'seconds', 'ratio', 'baseline_mem', 'peak_mem'))
+    for stage_name, stage in results['stages'].items():
+        baseline_stage = baseline['stages'].get(stage_name, None)
+        if baseline_stage is None:
+            continue
+        ratio = stage['seconds'] / baseline_stage['seconds'] if baseline_stage['seconds'] > 0 else float('nan')
+        print('{:<30} {:>12.4f} {:>12.4f} {:>8.2f} {:>14} {:>14}'.format(stage_name, baseline_stage['seconds'], stage['seconds'], ratio, str(baseline_stage['peak_memory_bytes']), str(stage['peak_memory_bytes'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=2000, help='Number of run dirs in the synthetic fastq_by_run_dir')
+    parser.add_argument('--samples-per-run', type=int, default=4, help='Number of samples in each run dir')
+    parser.add_argument('--ready-fraction', type=float, default=0.9, help='Fraction of run dirs that are ready to analyze')
+    parser.add_argument('--other-dirs', type=int, default=100, help='Number of dirs in fastq_by_run_dir that are not runs')
+    parser.add_argument('--analyze-runs', type=int, default=20, help='Number of runs to analyze with the stub nextflow')
+    parser.add_argument('--samples', type=int, default=96, help='Number of samples in the synthetic hcv-nf output')
+    parser.add_argument('--table-rows', type=int, default=1000, help='Number of rows in each BLAST result table')
+    parser.add_argument('--png-bytes', type=int, default=100000, help='Size of each image')
+    parser.add_argument('--report-workers', type=int, default=1)
+    parser.add_argument('--report-image-mode', default='inline', choices=report_html.REPORT_IMAGE_MODES)
+    parser.add_argument('--transfer-workers', type=int, default=post_analysis.DEFAULT_TRANSFER_WORKERS)
+    parser.add_argument('--stages', nargs='+', default=['scan', 'analyze_run', 'reports'], choices=['scan', 'analyze_run', 'reports'], help='Stages to run (analyze_run also runs scan, to create the fixtures)')
+    parser.add_argument('--no-tracemalloc', action='store_true', help="Don't measure peak memory use")
+    parser.add_argument('--work-dir', help='Create fixtures here, and keep them (default: a temporary dir that is deleted)')
+    parser.add_argument('--output', help='Write results as JSON to this file (default: stdout)')
+    parser.add_argument('--compare', help='Compare with results from another run of this script')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    timer = StageTimer(use_tracemalloc=not args.no_tracemalloc)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='auto-hcv-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        if 'scan' in args.stages or 'analyze_run' in args.stages:
+            fastq_by_run_dir, num_found = benchmark_scan(timer, work_dir, args)
+        if 'analyze_run' in args.stages:
+            benchmark_analyze_run(timer, work_dir, fastq_by_run_dir, args)
+        if 'reports' in args.stages:
+            benchmark_reports(timer, work_dir, args)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'version': get_version(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'tracemalloc': not args.no_tracemalloc,
+        'parameters': {key: value for key, value in vars(args).items() if key not in ['output', 'compare', 'work_dir']},
+        'stages': timer.stages,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()